@@ -16,7 +16,8 @@ with open('README.md') as rd:
 
 install_requires = [
     'gspread>=3.0.1',
-    'oauth2client>=4.1.3'
+    'oauth2client>=4.1.3',
+    'requests',
 ]
 
 setuptools.setup(
@@ -36,6 +37,10 @@ setuptools.setup(
 
     # Specify dependencies
     install_requires=install_requires,
+    extras_require={
+        'http2': ['httpx[http2]'],
+        'test': ['pytest'],
+    },
 
     classifiers=[
         'Programming Language :: Python :: 3 :: Only',
@@ -12,5 +12,15 @@ from .__version__ import (
 from .sheet_disk import (
     upload,
     download,
+    upload_from,
+    download_into,
+    download_bytes,
+    batch,
     main,
 )
+
+from .client import (
+    ClientPool,
+    get_client,
+    set_client,
+)
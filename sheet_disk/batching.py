@@ -0,0 +1,215 @@
+'''Choosing how many cells go in each range request.
+
+Cells of a sheet are split into requests of a target size, instead of
+evenly over the worker threads, so the size of a request doesn't depend
+on how full the sheet is or on --concurrency.
+
+The target is either fixed, or tuned while transferring: each finished
+request adds its bytes per second to the size it was made with, and the
+sizer moves to whichever neighbouring size moves data fastest. Throughput
+is measured per request, so it doesn't change with the no of requests
+in flight, which only decides how many of them run at once.'''
+
+import threading
+from math import ceil
+from .utils import CELL_CHAR_LIMIT, CELLS_PER_SHEET
+from .my_logging import get_logger
+
+logger = get_logger()
+
+# Sizes tried by the tuner, in cells per request. Each cell holds
+# CELL_CHAR_LIMIT chars, so these go from ~0.2 MB to ~6.3 MB per request.
+# Larger requests get close to the payload limits of the API
+LADDER = (4, 8, 16, 32, 64, 128)
+
+# Size to start with, about a full sheet split over 11 workers
+DEFAULT_REQUEST_BYTES = 4500 * 1000
+
+# Requests timed at a size before it is compared with its neighbours
+SAMPLES_PER_STEP = 6
+# Weight of a new sample in the average throughput of a size
+EWMA_WEIGHT = 0.3
+# A neighbour has to be this much faster to move to it, so noise doesn't
+# make the size flap between two which are about as good
+MIN_GAIN = 1.05
+# Once settled, the neighbours are timed again after this many steps,
+# in case the best size has changed
+REPROBE_STEPS = 20
+
+
+def parse_size(text, what='Request size'):
+    '''
+    Parse '4M', '512K', '2000000' or 'auto' into bytes, None for auto
+
+    what = Name of the value, used in error messages
+    '''
+    number = text.strip().upper()
+    if number == 'AUTO':
+        return None
+
+    units = {'K': 10 ** 3, 'M': 10 ** 6}
+    multiplier = 1
+    if number[-1:] in units:
+        multiplier = units[number[-1]]
+        number = number[:-1]
+    try:
+        size = int(float(number) * multiplier)
+    except ValueError:
+        raise ValueError(what + ' must be like 4M or 512K, not ' + text)
+    if size <= 0:
+        raise ValueError(what + ' must be positive')
+    return size
+
+def cells_for_bytes(n_bytes):
+    '''No of cells in a request of about n_bytes, at least 1'''
+    # Requests carry cells of base64 text
+    return max(1, min(CELLS_PER_SHEET, round(n_bytes / CELL_CHAR_LIMIT)))
+
+
+class RequestSizer:
+    '''
+    Picks the no of cells per request for one kind of request
+
+    kind = 'read' or 'write', used in log messages
+    request_bytes = Fixed size of each request, None to tune it
+    '''
+
+    def __init__(self, kind, request_bytes=None):
+        self.kind = kind
+        self.fixed = None if request_bytes is None else cells_for_bytes(request_bytes)
+
+        start = cells_for_bytes(DEFAULT_REQUEST_BYTES)
+        # Rung of LADDER closest to start
+        self._rung = min(range(len(LADDER)), key=lambda i: abs(LADDER[i] - start))
+
+        # Average bytes per second of a request, and no of samples, of each rung
+        self._rate = [None] * len(LADDER)
+        self._samples = [0] * len(LADDER)
+        # Samples at the current rung since the last step
+        self._step_samples = 0
+        self._steps_settled = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cells(self):
+        '''Cells per request to use now'''
+        if self.fixed is not None:
+            return self.fixed
+        return LADDER[self._rung]
+
+    def split(self, no_of_cells, cells):
+        '''
+        Yield (range_no, start, end) covering cells 1 to no_of_cells (1-indexed),
+        in ranges of about cells cells each, which are as even as possible
+        '''
+        n_ranges = max(1, ceil(no_of_cells / cells))
+        for i in range(n_ranges):
+            start = no_of_cells * i // n_ranges + 1
+            end = no_of_cells * (i + 1) // n_ranges
+            yield i, start, end
+
+    def record(self, planned, cells, n_bytes, seconds):
+        '''
+        Add a finished request to the stats of its size
+
+        planned = Cells per request the range was split with
+        cells = Cells in the request
+        n_bytes = Bytes sent or received
+        seconds = Time of the request's HTTP exchange, without quota waits,
+                requests which weren't measured (0) are left out
+        '''
+        if self.fixed is not None or planned not in LADDER or seconds <= 0:
+            return
+        if cells < planned / 2:
+            # Tail of a sheet, its throughput says little about the size
+            return
+
+        rate = n_bytes / seconds
+        with self._lock:
+            rung = LADDER.index(planned)
+            old = self._rate[rung]
+            self._rate[rung] = rate if old is None else \
+                (1 - EWMA_WEIGHT) * old + EWMA_WEIGHT * rate
+            self._samples[rung] += 1
+
+            if rung == self._rung:
+                self._step_samples += 1
+                if self._step_samples >= SAMPLES_PER_STEP:
+                    self._step()
+
+    def _step(self):
+        # Called with self._lock held, after enough samples at the current rung
+        self._step_samples = 0
+        current = self._rung
+        # Larger first, they use less of the per minute quota
+        neighbours = [i for i in (current + 1, current - 1) if 0 <= i < len(LADDER)]
+
+        timed = [i for i in neighbours if self._samples[i] >= SAMPLES_PER_STEP]
+        best = max(timed + [current], key=lambda i: self._rate[i])
+        if best != current and self._rate[best] > MIN_GAIN * self._rate[current]:
+            self._steps_settled = 0
+            self._move(best, 'moving to')
+            return
+
+        if self._steps_settled >= REPROBE_STEPS:
+            self._steps_settled = 0
+            for i in neighbours:
+                self._samples[i] = 0
+
+        untimed = [i for i in neighbours if self._samples[i] < SAMPLES_PER_STEP]
+        if untimed:
+            self._move(untimed[0], 'trying')
+            return
+        self._steps_settled += 1
+
+    def _move(self, rung, verb):
+        logger.debug(self.kind + ' requests: ' + verb + ' ' + str(LADDER[rung])
+                     + ' cells, from ' + str(LADDER[self._rung]) + ' ('
+                     + ', '.join(str(LADDER[i]) + '=' + '{:.1f}'.format(rate / 10 ** 6) + 'MB/s'
+                                 for i, rate in enumerate(self._rate) if rate) + ')')
+        self._rung = rung
+
+    def stats(self):
+        '''Return {'cells': int, 'rates': {cells: bytes per second}}'''
+        with self._lock:
+            return {
+                'cells': self.cells,
+                'rates': {LADDER[i]: rate for i, rate in enumerate(self._rate) if rate},
+            }
+
+
+# kind -> process wide RequestSizer
+_sizers = {}
+_sizers_lock = threading.Lock()
+# Fixed bytes per request for sizers created from now on, None to tune
+_request_bytes = None
+
+def set_request_size(request_bytes):
+    '''Use request_bytes per request from now on, None to tune the size'''
+    global _request_bytes
+    with _sizers_lock:
+        _request_bytes = request_bytes
+        _sizers.clear()
+
+def get_sizer(kind):
+    '''Return the process wide RequestSizer of 'read' or 'write' requests'''
+    with _sizers_lock:
+        sizer = _sizers.get(kind)
+        if sizer is None:
+            sizer = _sizers[kind] = RequestSizer(kind, _request_bytes)
+        return sizer
+
+def log_request_sizes():
+    '''Log the request size of every sizer, and the throughput it measured'''
+    with _sizers_lock:
+        sizers = list(_sizers.values())
+
+    for sizer in sizers:
+        stats = sizer.stats()
+        msg = 'Using ' + str(stats['cells']) + ' cells per ' + sizer.kind + ' request ' \
+              + '(' + '{:.1f}'.format(stats['cells'] * CELL_CHAR_LIMIT / 10 ** 6) + ' MB)'
+        if stats['rates']:
+            msg += ', measured ' + ', '.join(
+                str(cells) + ' cells: ' + '{:.1f}'.format(rate / 10 ** 6) + ' MB/s'
+                for cells, rate in sorted(stats['rates'].items()))
+        logger.info(msg)
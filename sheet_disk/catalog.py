@@ -0,0 +1,213 @@
+'''Catalog of uploaded files, kept in index spreadsheets, so files
+can be listed and found without their JSON files.
+
+Row 1 of a catalog is a header, and each upload adds one row:
+    A = name, B = time of upload, C = file size, D = id (key of the first sheet),
+    E to Z = manifest as JSON, split into cells of at most CELL_CHAR_LIMIT chars
+
+Rows are only appended. A row without a manifest removes the file with its id.
+
+A copy of every catalog is cached locally, and refreshing it
+only reads the rows added since the last refresh.'''
+
+import os, json, datetime, threading
+from fnmatch import fnmatch
+from .manifest import Manifest
+from .client import as_client_pool, get_cache_dir
+from .utils import CELL_CHAR_LIMIT
+from .my_logging import get_logger
+
+logger = get_logger()
+
+HEADER = ['name', 'uploaded', 'file_size', 'id', 'manifest']
+
+# Columns E to Z hold the manifest
+FIRST_COL = 'A'
+LAST_COL = 'Z'
+MAX_CHUNKS = ord(LAST_COL) - ord('E') + 1
+
+# Catalog keys from set_catalog_keys(), used instead of SH_DISK_CATALOG
+_catalog_keys = None
+
+
+def get_catalog_keys():
+    '''
+    Return the list of catalog keys, from set_catalog_keys(),
+    or SH_DISK_CATALOG which can hold several keys separated by os.pathsep
+    '''
+    if _catalog_keys:
+        return list(_catalog_keys)
+    keys = os.environ.get('SH_DISK_CATALOG', '')
+    return [key for key in keys.split(os.pathsep) if key]
+
+def set_catalog_keys(keys):
+    '''Use these catalogs instead of the ones in SH_DISK_CATALOG'''
+    global _catalog_keys
+    _catalog_keys = list(keys) if keys else None
+
+def get_catalog(client=None):
+    '''Return the Catalog of the configured keys, None if there are none'''
+    keys = get_catalog_keys()
+    if not keys:
+        return None
+    return Catalog(keys, client)
+
+def create_catalog(client=None):
+    '''Create an empty catalog spreadsheet, and return its key'''
+    from .client import get_client_pool
+    client = as_client_pool(client or get_client_pool()).default
+
+    sh = client.create('sheet_disk catalog')
+    sh.values_append(
+        'A1',
+        params={'valueInputOption': 'RAW'},
+        body={'values': [HEADER]})
+    logger.debug('Created catalog ' + sh.id)
+    return sh.id
+
+def _cache_path(key):
+    return os.path.join(get_cache_dir(), 'catalog', key + '.json')
+
+def _to_row(manifest):
+    '''Return the catalog row of a Manifest'''
+    json_str = json.dumps(manifest.to_dict(), separators=(',', ':'))
+    chunks = [json_str[i:i + CELL_CHAR_LIMIT]
+              for i in range(0, len(json_str), CELL_CHAR_LIMIT)]
+    if len(chunks) > MAX_CHUNKS:
+        raise ValueError('Manifest of ' + manifest.name + ' is too big for the catalog')
+
+    uploaded = str(datetime.datetime.now()).split('.')[0]
+    file_size = '' if manifest.file_size is None else str(manifest.file_size)
+    return [manifest.name, uploaded, file_size, manifest.key_list[0]] + chunks
+
+
+class Catalog:
+    '''
+    keys = Keys of the catalog spreadsheets, new rows are added to the first
+    client = gspread client or ClientPool which can open the catalogs
+    '''
+
+    def __init__(self, keys, client=None):
+        from .client import get_client_pool
+        self.keys = list(keys)
+        self.client = as_client_pool(client or get_client_pool()).default
+
+        # key -> list of rows, including the header
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def _load_cache(self, key):
+        try:
+            with open(_cache_path(key)) as f:
+                return json.load(f)['rows']
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def _save_cache(self, key, rows):
+        path = _cache_path(key)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+        # Write to a temporary file and rename it,
+        # so other processes never read a half written file
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'rows': rows}, f)
+        os.replace(tmp_path, path)
+
+    def _read_rows(self, key, start):
+        '''Read the rows of catalog key from row start (1-indexed) onwards'''
+        sh = self.client.open_by_key(key)
+        response = sh.values_get(FIRST_COL + str(start) + ':' + LAST_COL)
+        return response.get('values', [])
+
+    def refresh(self):
+        '''Read the rows added to every catalog since the last refresh'''
+        with self._lock:
+            for key in self.keys:
+                rows = self._rows.get(key) or self._load_cache(key)
+
+                if rows:
+                    # Read again from the last known row, to check it hasn't changed
+                    new_rows = self._read_rows(key, len(rows))
+                    if new_rows[:1] != rows[-1:]:
+                        logger.debug('Catalog ' + key + ' has changed, reading all of it')
+                        rows = []
+                        new_rows = self._read_rows(key, 1)
+                    else:
+                        new_rows = new_rows[1:]
+                else:
+                    new_rows = self._read_rows(key, 1)
+
+                logger.debug('Read ' + str(len(new_rows)) + ' new rows from catalog ' + key)
+                if new_rows or key not in self._rows:
+                    rows = rows + new_rows
+                    self._rows[key] = rows
+                    self._save_cache(key, rows)
+
+    def entries(self, refresh=True):
+        '''
+        Return a list of the files in the catalogs, oldest first.
+        Each is a dict with name, uploaded, file_size, id, catalog and manifest.
+        '''
+        if refresh or not self._rows:
+            self.refresh()
+
+        entries = {}
+        for key in self.keys:
+            for row in self._rows.get(key, [])[1:]:
+                row = row + [''] * (len(HEADER) - len(row))
+                name, uploaded, file_size, sheet_id = row[:4]
+                if not row[4]:
+                    # Removed file
+                    entries.pop(sheet_id, None)
+                    continue
+
+                entries[sheet_id] = {
+                    'name': name,
+                    'uploaded': uploaded,
+                    'file_size': int(file_size) if file_size else None,
+                    'id': sheet_id,
+                    'catalog': key,
+                    'manifest': ''.join(row[4:]),
+                }
+
+        return sorted(entries.values(), key=lambda entry: entry['uploaded'])
+
+    def search(self, pattern, refresh=True):
+        '''
+        Return the entries whose name matches pattern.
+        Patterns with *, ? or [ are shell style, others match any part of the name.
+        Case is ignored.
+        '''
+        pattern = pattern.lower()
+        if not any(c in pattern for c in '*?['):
+            pattern = '*' + pattern + '*'
+        return [entry for entry in self.entries(refresh)
+                if fnmatch(entry['name'].lower(), pattern)]
+
+    def find(self, name, refresh=True):
+        '''Return the Manifest of the latest upload called name, None if there isn't one'''
+        found = [entry for entry in self.entries(refresh) if entry['name'] == name]
+        if not found:
+            return None
+        return Manifest.from_dict(json.loads(found[-1]['manifest']))
+
+    def add(self, manifests):
+        '''Add the Manifests of complete uploads, with a single request'''
+        rows = [_to_row(manifest) for manifest in manifests]
+        if rows:
+            self._append(rows)
+            logger.info('Added ' + str(len(rows)) + ' file(s) to the catalog')
+
+    def remove(self, ids):
+        '''Remove files from the catalogs, ids are the keys of their first sheets'''
+        rows = [['', '', '', sheet_id] for sheet_id in ids]
+        if rows:
+            self._append(rows)
+
+    def _append(self, rows):
+        sh = self.client.open_by_key(self.keys[0])
+        sh.values_append(
+            FIRST_COL + '1',
+            params={'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'},
+            body={'values': rows})
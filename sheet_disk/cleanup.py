@@ -0,0 +1,174 @@
+'''Deleting uploaded files, and garbage collecting sheets
+which no manifest refers to, eg. sheets left behind by failed uploads.
+
+Deletes run in parallel, and go through the same rate limiters
+as every other request.'''
+
+import os, datetime
+from concurrent.futures import ThreadPoolExecutor
+from .manifest import Manifest, EXTENSIONS
+from .client import as_client_pool, get_client_pool
+from .utils import N_THREADS
+from .metrics import timed
+from .my_logging import get_logger
+
+logger = get_logger()
+
+# No of sheets deleted between progress messages
+DELETE_BATCH = 100
+
+# Sheets created less than this many hours ago are left alone by gc,
+# since they may belong to an upload which is still running
+MIN_AGE = 24
+
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files'
+CREATED_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _delete_one(client, key):
+    '''Delete one spreadsheet, returns False if it couldn't be deleted'''
+    try:
+        with timed('del_spreadsheet'):
+            client.del_spreadsheet(key)
+    except Exception as e:
+        if getattr(getattr(e, 'response', None), 'status_code', None) == 404:
+            logger.debug(key + ' was already deleted')
+            return True
+        logger.error('Could not delete ' + key + ': ' + repr(e))
+        return False
+    return True
+
+def delete_sheets(sheets, client=None, concurrency=N_THREADS):
+    '''
+    Delete spreadsheets in parallel batches.
+    Returns the list of (key, account) which couldn't be deleted.
+
+    sheets = List of (key, account), account None for the default account
+    client = gspread client or ClientPool, defaults to get_client_pool()
+    concurrency = Max no of delete requests in flight
+    '''
+    clients = as_client_pool(client or get_client_pool())
+    sheets = list(sheets)
+    failed = []
+
+    def delete(sheet):
+        key, account = sheet
+        return _delete_one(clients.get(account), key)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(sheets), DELETE_BATCH):
+            batch = sheets[start:start + DELETE_BATCH]
+            for sheet, deleted in zip(batch, executor.map(delete, batch)):
+                if not deleted:
+                    failed.append(sheet)
+
+            done = start + len(batch)
+            logger.info('Deleted ' + str(done - len(failed)) + '/' + str(len(sheets)) + ' sheets')
+
+    return failed
+
+def delete_file(json_file, client=None, concurrency=N_THREADS, catalog=None):
+    '''
+    Delete every sheet of an uploaded file.
+    Returns the list of (key, account) which couldn't be deleted.
+
+    json_file = Path of a JSON/manifest file, or a Manifest
+    catalog = Optional Catalog, the file is removed from it once deleted
+    '''
+    manifest = json_file if isinstance(json_file, Manifest) else Manifest.load(json_file)
+    logger.info('Deleting ' + str(len(manifest.key_list)) + ' sheets of ' + manifest.name + '...')
+
+    failed = delete_sheets(
+            zip(manifest.key_list, manifest.account_list),
+            client, concurrency)
+
+    if catalog and manifest.key_list and not failed:
+        catalog.remove([manifest.key_list[0]])
+    return failed
+
+def list_sheets(client):
+    '''
+    Return the spreadsheets owned by the account of client,
+    as dicts with id, name and createdTime
+    '''
+    params = {
+        'q': "mimeType='application/vnd.google-apps.spreadsheet' "
+             "and 'me' in owners and trashed=false",
+        'fields': 'nextPageToken, files(id, name, createdTime)',
+        'pageSize': 1000,
+    }
+
+    files = []
+    page_token = ''
+    while page_token is not None:
+        if page_token:
+            params['pageToken'] = page_token
+        res = client.request('get', DRIVE_FILES_URL, params=params).json()
+        files.extend(res['files'])
+        page_token = res.get('nextPageToken', None)
+    return files
+
+def find_manifests(paths):
+    '''
+    Yield the Manifest of every JSON/manifest file in paths,
+    directories are searched recursively
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    if name.endswith(tuple(EXTENSIONS.values())) \
+                            and Manifest.is_manifest(file_path):
+                        yield Manifest.load(file_path)
+        else:
+            yield Manifest.load(path)
+
+def gc(manifest_paths, client=None, concurrency=N_THREADS, catalog=None,
+       min_age=MIN_AGE, dry_run=False):
+    '''
+    Delete the spreadsheets of every account which aren't in any known manifest.
+    Returns (unreferenced, failed), both lists of (key, account).
+
+    manifest_paths = JSON/manifest files, or directories holding them
+    catalog = Optional Catalog, its files and its own spreadsheets are kept
+    min_age = Only delete sheets created at least this many hours ago
+    dry_run = Only list the sheets which would be deleted
+    '''
+    if not manifest_paths and catalog is None:
+        # Every sheet would be deleted
+        msg = 'gc needs manifest files/directories or a catalog, to know which sheets to keep'
+        logger.error(msg)
+        raise ValueError(msg)
+
+    clients = as_client_pool(client or get_client_pool())
+
+    keep = set()
+    for manifest in find_manifests(manifest_paths):
+        keep.update(manifest.key_list)
+    if catalog is not None:
+        import json
+        keep.update(catalog.keys)
+        for entry in catalog.entries():
+            keep.update(json.loads(entry['manifest'])['key_list'])
+    logger.info('Found ' + str(len(keep)) + ' sheets in use')
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=min_age)
+    unreferenced = []
+    for account, account_client in clients.clients.items():
+        for f in list_sheets(account_client):
+            if f['id'] in keep:
+                continue
+            created = datetime.datetime.strptime(f['createdTime'][:19], CREATED_FORMAT)
+            if created > cutoff:
+                logger.debug('Keeping new sheet ' + f['name'])
+                continue
+            logger.info(('Would delete ' if dry_run else 'Deleting ')
+                        + f['name'] + ' (' + account + ')')
+            unreferenced.append((f['id'], account))
+
+    logger.info(str(len(unreferenced)) + ' sheets aren\'t used by any manifest')
+    if dry_run or not unreferenced:
+        return unreferenced, []
+
+    return unreferenced, delete_sheets(unreferenced, clients, concurrency)
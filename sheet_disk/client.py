@@ -0,0 +1,314 @@
+'''Lazily created gspread clients, one per service account,
+with an on-disk cache of OAuth access tokens shared between processes'''
+
+import os, json, datetime, hashlib, threading, functools
+from collections import OrderedDict
+from .my_logging import get_logger
+from .utils import N_THREADS
+
+logger = get_logger()
+
+scope = ['https://spreadsheets.google.com/feeds',
+         'https://www.googleapis.com/auth/drive']
+
+# Tokens are refreshed if they expire within this many seconds
+TOKEN_MARGIN = 60
+
+# Format of token_expiry in the cache file
+EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# ClientPool used when the caller doesn't pass one
+_pool = None
+_client_lock = threading.Lock()
+# Held while a refused token is replaced, so it is fetched once
+_refresh_lock = threading.Lock()
+
+# Credentials files which override SH_DISK_CREDS
+_creds_files = None
+
+# Options for the session of the default client
+_transport = {
+    'pool_size': N_THREADS,
+    'http2': False,
+}
+
+
+def get_creds_file():
+    '''Return the credentials file path from SH_DISK_CREDS'''
+    creds_file = os.environ.get('SH_DISK_CREDS', None)
+
+    if creds_file is None:
+        raise KeyError(
+            '''Set up environment variable: 'SH_DISK_CREDS'
+            with the path to your Google Sheets API JSON file.
+
+            Refer to README.md for more info.''')
+    return creds_file
+
+def get_creds_files():
+    '''
+    Return the list of credentials files, from set_creds_files(),
+    or SH_DISK_CREDS which can hold several paths separated by os.pathsep
+    '''
+    if _creds_files:
+        return list(_creds_files)
+    return [path for path in get_creds_file().split(os.pathsep) if path]
+
+def set_creds_files(creds_files):
+    '''Use these credentials files for the default ClientPool, instead of SH_DISK_CREDS'''
+    global _creds_files
+    _creds_files = list(creds_files) if creds_files else None
+
+def get_cache_dir():
+    '''Return the cache directory, from SH_DISK_CACHE if it is set'''
+    cache_dir = os.environ.get('SH_DISK_CACHE', None)
+    if cache_dir is None:
+        base = os.environ.get('XDG_CACHE_HOME', None) or \
+               os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(base, 'sheet_disk')
+    return cache_dir
+
+def _token_path(creds):
+    # One file per service account
+    account = creds.service_account_email.encode('utf-8')
+    name = hashlib.sha1(account).hexdigest() + '.json'
+    return os.path.join(get_cache_dir(), 'tokens', name)
+
+def load_token(creds):
+    '''Copy a cached, unexpired access token into creds. Returns True if one was found'''
+    path = _token_path(creds)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        expiry = datetime.datetime.strptime(cached['token_expiry'], EXPIRY_FORMAT)
+    except (OSError, ValueError, KeyError):
+        return False
+
+    margin = datetime.timedelta(seconds=TOKEN_MARGIN)
+    if expiry - margin <= datetime.datetime.utcnow():
+        logger.debug('Cached token has expired')
+        return False
+
+    creds.access_token = cached['access_token']
+    creds.token_expiry = expiry
+    logger.debug('Using cached token')
+    return True
+
+def save_token(creds):
+    '''Write the access token of creds to the cache'''
+    path = _token_path(creds)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+    cached = {
+        'access_token': creds.access_token,
+        'token_expiry': creds.token_expiry.strftime(EXPIRY_FORMAT),
+    }
+
+    # Write to a temporary file and rename it,
+    # so other processes never read a half written file
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cached, f)
+    os.replace(tmp_path, path)
+    logger.debug('Saved token to cache')
+
+def token_expiring(creds):
+    '''Return True if the token of creds is missing, or expires soon'''
+    if not creds.access_token or not creds.token_expiry:
+        return True
+    margin = datetime.timedelta(seconds=TOKEN_MARGIN)
+    return creds.token_expiry - margin <= datetime.datetime.utcnow()
+
+def refresh_client(client):
+    '''
+    Get a new access token for client if its token expires soon.
+    Clients which weren't made by authorize() are left alone.
+    '''
+    creds = getattr(client, 'auth', None)
+    if creds is None or not hasattr(creds, 'service_account_email'):
+        return
+
+    if token_expiring(creds):
+        # A process may have refreshed it already
+        if not load_token(creds):
+            import httplib2
+            logger.debug('Fetching new access token')
+            creds.refresh(httplib2.Http())
+            save_token(creds)
+
+        # Send the new token with the next requests
+        client.login()
+
+def reauthorize(client, refused):
+    '''
+    Get a new access token for client, after the server refused
+    the Authorization header refused, eg. a cached token which expired
+    during a long transfer
+    '''
+    import httplib2
+    creds = client.auth
+    with _refresh_lock:
+        # Requests which were refused together only fetch one token
+        if client.session.headers.get('Authorization') != refused:
+            return
+
+        # A process may have refreshed it already
+        if not load_token(creds) or 'Bearer ' + creds.access_token == refused:
+            logger.debug('Fetching new access token')
+            creds.refresh(httplib2.Http())
+            save_token(creds)
+        client.login()
+
+def authorize(creds_file=None, pool_size=None, http2=None):
+    '''
+    Create a gspread client from a service account credentials file,
+    reusing a cached access token when there is one.
+
+    creds_file = Path of the credentials JSON file, defaults to SH_DISK_CREDS
+    pool_size = No of pooled connections, defaults to configure_transport()
+    http2 = Use HTTP/2, defaults to configure_transport()
+    '''
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    from .transport import make_session
+    from .ratelimit import get_limiter
+
+    creds_file = creds_file or get_creds_file()
+    creds = ServiceAccountCredentials.from_json_keyfile_name(creds_file, scope)
+
+    with open(creds_file) as f:
+        project_id = json.load(f).get('project_id', 'unknown')
+
+    # Requests count against the quota of the account and its project
+    limiters = [
+        get_limiter('account', creds.service_account_email),
+        get_limiter('project', project_id),
+    ]
+
+    session = make_session(
+        pool_size or _transport['pool_size'],
+        _transport['http2'] if http2 is None else http2,
+        limiters)
+
+    load_token(creds)
+    client = gspread.Client(auth=creds, session=session)
+    session.reauthorize = functools.partial(reauthorize, client)
+    refresh_client(client)
+    client.login()
+    return client
+
+def account_name(client):
+    '''Return the service account email of client, 'default' if it has none'''
+    creds = getattr(client, 'auth', None)
+    return getattr(creds, 'service_account_email', None) or 'default'
+
+
+class ClientPool:
+    '''
+    One gspread client per service account, so that work can be spread
+    over the API quota of every account.
+
+    clients = List of gspread clients
+    '''
+
+    def __init__(self, clients):
+        if not clients:
+            raise ValueError('ClientPool needs at least one client')
+
+        # account -> client
+        self.clients = OrderedDict()
+        for client in clients:
+            account = account_name(client)
+            if account in self.clients:
+                # Same account given twice, or clients without accounts
+                account = account + '#' + str(len(self.clients))
+            self.clients[account] = client
+
+        self._lock = threading.Lock()
+        # Used to break ties between accounts with equal usage
+        self._turn = 0
+
+    @property
+    def default(self):
+        '''Client of the first account'''
+        return next(iter(self.clients.values()))
+
+    @property
+    def default_account(self):
+        return next(iter(self.clients))
+
+    def get(self, account=None):
+        '''
+        Return the client for account.
+        None, or an account which isn't in the pool, gives the default client,
+        which can still read sheets shared with anyone.
+        '''
+        client = self.clients.get(account)
+        if client is None:
+            if account is not None:
+                logger.debug('No credentials for ' + account + ', using default account')
+            client = self.default
+        return client
+
+    def usage(self, account):
+        '''No of requests sent by account in the last minute, 0 if unknown'''
+        usage = getattr(getattr(self.clients[account], 'session', None), 'usage', None)
+        return usage.count() if usage else 0
+
+    def pick(self):
+        '''Return the account which sent the fewest requests in the last minute'''
+        with self._lock:
+            accounts = list(self.clients)
+            self._turn = (self._turn + 1) % len(accounts)
+            # Rotate so ties go round robin
+            accounts = accounts[self._turn:] + accounts[:self._turn]
+            return min(accounts, key=self.usage)
+
+    def refresh(self):
+        for client in self.clients.values():
+            refresh_client(client)
+
+
+def as_client_pool(client):
+    '''Return client if it is a ClientPool, or wrap a single client in one'''
+    if isinstance(client, ClientPool):
+        return client
+    return ClientPool([client])
+
+def get_client_pool():
+    '''Return the default ClientPool, creating its clients on first use'''
+    global _pool
+    with _client_lock:
+        if _pool is None:
+            logger.debug('Creating clients')
+            _pool = ClientPool([authorize(path) for path in get_creds_files()])
+        else:
+            _pool.refresh()
+    return _pool
+
+def get_client():
+    '''Return the client of the first account in the default ClientPool'''
+    return get_client_pool().default
+
+def configure_transport(pool_size=None, http2=None):
+    '''
+    Set the connection pool size and HTTP/2 use of clients created
+    from now on. Has no effect on a client which already exists.
+    '''
+    with _client_lock:
+        if pool_size is not None:
+            _transport['pool_size'] = pool_size
+        if http2 is not None:
+            _transport['http2'] = http2
+
+def set_client(client):
+    '''
+    Use client as the default client, None to create one on next use.
+    client can also be a ClientPool or a list of clients.
+    '''
+    global _pool
+    if isinstance(client, (list, tuple)):
+        client = ClientPool(client)
+    with _client_lock:
+        _pool = None if client is None else as_client_pool(client)
@@ -0,0 +1,321 @@
+'''Long running daemon, which keeps a warm client and
+accepts upload/download jobs over a Unix socket.
+
+Requests and responses are single lines of JSON.'''
+
+import os, json, time, threading, itertools, heapq
+import socket, socketserver
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .my_logging import get_logger
+from .scheduler import WorkPool, MAX_FILES, priority_rank
+from .utils import N_THREADS
+from .sheet_disk import upload, download, check_job
+from .client import get_client_pool, as_client_pool
+from .catalog import get_catalog
+from .transport import transport_stats
+from .metrics import get_metrics
+
+logger = get_logger()
+
+# Seconds between status requests when waiting for a job
+POLL_INTERVAL = 0.5
+
+def get_socket_path():
+    '''Return the socket path, from SH_DISK_SOCKET if it is set'''
+    path = os.environ.get('SH_DISK_SOCKET', None)
+    if path is None:
+        run_dir = os.environ.get('XDG_RUNTIME_DIR', None) or os.path.expanduser('~')
+        path = os.path.join(run_dir, '.sheet_disk.sock')
+    return path
+
+
+class Job:
+    '''State of one upload/download submitted to the daemon'''
+
+    def __init__(self, job_id, action, user_file, json_file, json_dir, priority='normal'):
+        self.id = job_id
+        self.action = action
+        self.user_file = user_file
+        self.json_file = json_file
+        self.json_dir = json_dir
+        self.priority = priority
+
+        # queued -> running -> done/failed
+        self.state = 'queued'
+        self.error = None
+
+        # Progress of the current sheet
+        self.sheet = [0, 0]
+        self.cells = [0, 0]
+
+        self.submitted = time.time()
+        self.finished = None
+
+    def report(self, sheet_progress, completed_cells, total_cells):
+        self.sheet = list(sheet_progress)
+        self.cells = [completed_cells, total_cells]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'user_file': self.user_file,
+            'json_file': self.json_file,
+            'priority': self.priority,
+            'state': self.state,
+            'error': self.error,
+            'sheet': self.sheet,
+            'cells': self.cells,
+            'submitted': self.submitted,
+            'finished': self.finished,
+        }
+
+
+class JobManager:
+    '''
+    Runs submitted jobs with one client and one WorkPool
+
+    client = gspread client or ClientPool shared by every job
+    concurrency = Max no of range requests in flight, across all jobs
+    max_files = Max no of jobs running at the same time
+    hedge = Optional HedgePolicy for the range reads of downloads
+    catalog = Optional Catalog, complete uploads are added to it
+    metrics_file = Optional path, metrics are saved to it in the
+            Prometheus text format after every job
+    '''
+
+    def __init__(self, client, concurrency=N_THREADS, max_files=MAX_FILES, hedge=None,
+                 catalog=None, metrics_file=None):
+        self.client = client
+        self.catalog = catalog
+        self.metrics_file = metrics_file
+        self.pool = WorkPool(concurrency, hedge)
+        self.executor = ThreadPoolExecutor(max_workers=max_files)
+
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        # Heap of (rank, id, job) of the jobs waiting for a free slot,
+        # so higher priority jobs start first
+        self._queued = []
+
+    def submit(self, action, user_file, json_file=None, json_dir=None, priority='normal'):
+        if action not in ('upload', 'download'):
+            raise ValueError('Invalid action: ' + str(action))
+        check_job(action, user_file, json_file)
+        # Raises for an invalid class
+        rank = priority_rank(priority)
+
+        with self._lock:
+            job = Job(next(self._ids), action, user_file, json_file, json_dir, priority)
+            self.jobs[job.id] = job
+            heapq.heappush(self._queued, (rank, job.id, job))
+        logger.info('Job ' + str(job.id) + ': ' + action + ' ' + user_file + ' queued')
+
+        self.executor.submit(self._run_next)
+        return job
+
+    def _run_next(self):
+        # One call per submitted job, which runs the best job queued
+        # when a slot is free, not the one it was submitted for
+        with self._lock:
+            _, _, job = heapq.heappop(self._queued)
+        self._run(job)
+
+    def _run(self, job):
+        job.state = 'running'
+        lane = self.pool.lane(job.user_file, progress=False, report=job.report,
+                              priority=job.priority)
+        try:
+            with self._lock:
+                # Refreshes the access token only if it expires soon
+                self.client.refresh()
+
+            if job.action == 'upload':
+                manifest = upload(job.user_file, job.json_file, self.client, lane, job.json_dir)
+                if self.catalog and manifest and manifest.complete_upload:
+                    self.catalog.add([manifest])
+            else:
+                download(job.user_file, job.json_file, self.client, lane)
+        except Exception as e:
+            job.state = 'failed'
+            job.error = repr(e)
+            logger.error('Job ' + str(job.id) + ' failed: ' + repr(e))
+        else:
+            job.state = 'done'
+            logger.info('Job ' + str(job.id) + ' done')
+        finally:
+            job.finished = time.time()
+            if self.metrics_file:
+                try:
+                    get_metrics().write_textfile(self.metrics_file)
+                except OSError as e:
+                    logger.error('Could not save metrics: ' + repr(e))
+
+    def status(self, job_id=None):
+        with self._lock:
+            if job_id is None:
+                return [job.to_dict() for job in self.jobs.values()]
+            if job_id not in self.jobs:
+                raise KeyError('No job with id ' + str(job_id))
+            return [self.jobs[job_id].to_dict()]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = {'ok': True}
+                response.update(self.server.dispatch(request))
+            except Exception as e:
+                response = {'ok': False, 'error': repr(e)}
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, manager):
+        self.manager = manager
+        super().__init__(socket_path, _RequestHandler)
+
+    def server_bind(self):
+        # The socket is created with the mode of the umask, so it is made
+        # private as it is bound, other users could submit jobs before a chmod
+        umask = os.umask(0o077)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def dispatch(self, request):
+        op = request.get('op')
+        if op == 'submit':
+            job = self.manager.submit(
+                request['action'],
+                request['user_file'],
+                request.get('json_file'),
+                request.get('json_dir'),
+                request.get('priority', 'normal'))
+            return {'job': job.to_dict()}
+
+        if op == 'status':
+            return {
+                'jobs': self.manager.status(request.get('job_id')),
+                'transport': transport_stats(self.manager.client),
+                'metrics': get_metrics().snapshot(),
+            }
+
+        if op == 'shutdown':
+            # shutdown() blocks until serve_forever returns,
+            # so it can't be called from this thread
+            threading.Thread(target=self.shutdown).start()
+            return {}
+
+        raise ValueError('Invalid op: ' + str(op))
+
+
+def _check_unix_sockets():
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OSError('Daemon mode needs Unix sockets, '
+                      'which are not available on this platform')
+
+def serve(socket_path=None, concurrency=N_THREADS, max_files=MAX_FILES, client=None,
+          hedge=None, metrics_file=None):
+    '''Run the daemon until it gets a shutdown request'''
+    _check_unix_sockets()
+    socket_path = socket_path or get_socket_path()
+
+    if os.path.exists(socket_path):
+        try:
+            send_request({'op': 'status'}, socket_path)
+        except OSError:
+            # Left behind by a daemon which didn't exit cleanly
+            logger.debug('Removing stale socket ' + socket_path)
+            os.remove(socket_path)
+        else:
+            msg = 'A daemon is already listening on ' + socket_path
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+    client = as_client_pool(client or get_client_pool())
+    manager = JobManager(client, concurrency, max_files, hedge, get_catalog(client),
+                         metrics_file)
+    server = DaemonServer(socket_path, manager)
+
+    logger.info('Listening on ' + socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        manager.executor.shutdown(wait=True)
+        manager.pool.close()
+        logger.info('Daemon stopped')
+
+
+def send_request(request, socket_path=None):
+    '''Send one request to the daemon, and return its response'''
+    _check_unix_sockets()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path or get_socket_path())
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            response = json.loads(f.readline().decode('utf-8'))
+    finally:
+        sock.close()
+
+    if not response.pop('ok'):
+        raise RuntimeError('Daemon error: ' + response['error'])
+    return response
+
+
+def submit(action, user_file, json_file=None, wait=False, socket_path=None, priority='normal'):
+    '''
+    Submit a job to the daemon, and return its status dict.
+    Paths are made absolute, since the daemon has its own working directory.
+
+    wait = Block until the job finishes, logging its progress
+    priority = Priority class of the job, one of PRIORITIES
+    '''
+    request = {
+        'op': 'submit',
+        'action': action,
+        'user_file': os.path.abspath(user_file),
+        'json_file': os.path.abspath(json_file) if json_file else None,
+        'json_dir': os.getcwd(),
+        'priority': priority,
+    }
+    job = send_request(request, socket_path)['job']
+    logger.info('Submitted job ' + str(job['id']))
+
+    if wait:
+        job = wait_job(job['id'], socket_path)
+    return job
+
+
+def wait_job(job_id, socket_path=None):
+    '''Poll the daemon until the job finishes, raises if it failed'''
+    f_str = 'Job {:d} | Sheet {:d}/{:d} | {:d}/{:d} cells done'
+    while True:
+        job = send_request({'op': 'status', 'job_id': job_id}, socket_path)['jobs'][0]
+        if job['state'] in ('done', 'failed'):
+            break
+
+        logger.info(f_str.format(job['id'], *(job['sheet'] + job['cells'])))
+        time.sleep(POLL_INTERVAL)
+
+    if job['state'] == 'failed':
+        msg = 'Job ' + str(job_id) + ' failed: ' + job['error']
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+    logger.info('Job ' + str(job_id) + ' is complete!')
+    return job
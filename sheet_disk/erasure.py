@@ -0,0 +1,138 @@
+'''Reed-Solomon erasure coding over GF(256), for striping a file
+across k data sheets and m parity sheets.
+
+Any k of the k+m shards of a group are enough to rebuild its data.
+Parity rows come from a Cauchy matrix, so every k x k submatrix
+of [identity; parity rows] can be inverted.'''
+
+# Reducing polynomial x^8 + x^4 + x^3 + x^2 + 1
+POLY = 0x11d
+
+# Max k + m, since the Cauchy matrix needs k + m distinct field elements
+MAX_SHARDS = 256
+
+def _build_tables():
+    exp = [0] * 512
+    log = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= POLY
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+    return exp, log
+
+EXP, LOG = _build_tables()
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError('0 has no inverse in GF(256)')
+    return EXP[255 - LOG[a]]
+
+# Translation tables for multiplying every byte of a block by a constant
+_mul_tables = {}
+
+def _mul_table(c):
+    table = _mul_tables.get(c)
+    if table is None:
+        table = _mul_tables[c] = bytes(gf_mul(c, x) for x in range(256))
+    return table
+
+def _mul_block(c, block):
+    '''Return block with every byte multiplied by c'''
+    if c == 1:
+        return block
+    return block.translate(_mul_table(c))
+
+def _combine(coefs, blocks, length):
+    '''Return XOR of coefs[i] * blocks[i], all blocks having length bytes'''
+    acc = 0
+    for c, block in zip(coefs, blocks):
+        if c:
+            acc ^= int.from_bytes(_mul_block(c, block), 'little')
+    return acc.to_bytes(length, 'little')
+
+def parity_row(j, k):
+    '''Row j of the Cauchy matrix, 1 / (x_j + y_i) with x_j = k + j and y_i = i'''
+    return [gf_inv((k + j) ^ i) for i in range(k)]
+
+def check_params(k, m):
+    if k < 1 or m < 0 or k + m > MAX_SHARDS:
+        raise ValueError('Need k >= 1, m >= 0 and k + m <= ' + str(MAX_SHARDS))
+
+def encode(data_shards, m):
+    '''
+    Return the m parity shards of the data shards
+
+    data_shards = List of k byte strings, all of the same length
+    m = No of parity shards
+    '''
+    k = len(data_shards)
+    check_params(k, m)
+    length = len(data_shards[0])
+    return [_combine(parity_row(j, k), data_shards, length) for j in range(m)]
+
+def _invert(matrix):
+    '''Invert a square matrix over GF(256), with Gauss-Jordan elimination'''
+    n = len(matrix)
+    aug = [list(row) + [int(i == r) for i in range(n)] for r, row in enumerate(matrix)]
+
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if aug[r][col]), None)
+        if pivot is None:
+            raise ValueError('Shards given can\'t rebuild the data')
+        aug[col], aug[pivot] = aug[pivot], aug[col]
+
+        inv = gf_inv(aug[col][col])
+        aug[col] = [gf_mul(inv, x) for x in aug[col]]
+
+        for r in range(n):
+            if r != col and aug[r][col]:
+                f = aug[r][col]
+                aug[r] = [x ^ gf_mul(f, y) for x, y in zip(aug[r], aug[col])]
+
+    return [row[n:] for row in aug]
+
+def decode(shards, k, m):
+    '''
+    Return the k data shards, rebuilt from any k of the k+m shards
+
+    shards = Dict of shard index -> bytes, where indexes 0 to k-1 are the
+            data shards and k to k+m-1 are the parity shards
+    '''
+    check_params(k, m)
+    if len(shards) < k:
+        raise ValueError('Need ' + str(k) + ' shards, only got ' + str(len(shards)))
+
+    if all(i in shards for i in range(k)):
+        # Nothing to rebuild
+        return [shards[i] for i in range(k)]
+
+    # Prefer data shards, they need no work
+    use = sorted(shards)[:k]
+    length = len(shards[use[0]])
+
+    rows = []
+    for index in use:
+        if index < k:
+            rows.append([int(i == index) for i in range(k)])
+        else:
+            rows.append(parity_row(index - k, k))
+    inverse = _invert(rows)
+
+    blocks = [shards[index] for index in use]
+    data = []
+    for i in range(k):
+        if i in shards:
+            data.append(shards[i])
+        else:
+            data.append(_combine(inverse[i], blocks, length))
+    return data
@@ -0,0 +1,152 @@
+'''Hedged range reads for downloads.
+
+If a range read takes longer than a percentile of recent reads,
+a duplicate read is sent (optionally split into smaller ranges),
+and whichever finishes first is used.'''
+
+import threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .my_logging import get_logger, with_log_context
+
+logger = get_logger()
+
+# Reads are only hedged after this many have been timed
+MIN_SAMPLES = 10
+# No of recent reads used for the percentile
+WINDOW = 200
+# Max hedge credits saved up, ie. the largest burst of hedges
+MAX_CREDITS = 10
+
+
+class LatencyTracker:
+    '''Keeps the seconds per cell of recent range reads'''
+
+    def __init__(self, window=WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds, n_cells):
+        with self._lock:
+            self._samples.append(seconds / max(n_cells, 1))
+
+    def percentile(self, p):
+        '''Return the p-th percentile of seconds per cell, None if there are too few samples'''
+        with self._lock:
+            if len(self._samples) < MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+
+class HedgePolicy:
+    '''
+    percentile = A read is hedged once it is slower than this
+            percentile of recent reads
+    budget = Max hedge requests sent, as a fraction of all reads,
+            so hedges can't use up the quota
+    split = No of smaller ranges a hedge is split into
+    '''
+
+    def __init__(self, percentile=95, budget=0.1, split=1):
+        if not 0 < percentile < 100:
+            raise ValueError('percentile must be between 0 and 100')
+
+        self.percentile = percentile
+        self.budget = budget
+        self.split = max(1, split)
+
+        self.latency = LatencyTracker()
+        self._credits = 0.0
+        self._lock = threading.Lock()
+
+        # Reads run here, so the caller can wait on them with a timeout
+        self._executor = ThreadPoolExecutor(
+                max_workers=64, thread_name_prefix='Hedge')
+
+        self.n_reads = 0
+        self.n_hedged = 0
+        self.n_hedge_wins = 0
+
+    def _earn(self):
+        with self._lock:
+            self.n_reads += 1
+            self._credits = min(MAX_CREDITS, self._credits + self.budget)
+
+    def _spend(self, n):
+        with self._lock:
+            if self._credits >= n:
+                self._credits -= n
+                self.n_hedged += 1
+                return True
+            return False
+
+    def _timed_range(self, wks, start, end):
+        t = time.monotonic()
+        cells = wks.range('A' + str(start) + ':A' + str(end))
+        self.latency.add(time.monotonic() - t, end - start + 1)
+        return cells
+
+    def fetch(self, wks, start, end):
+        '''Return the cells start to end (1-indexed) of wks, hedging slow reads'''
+        self._earn()
+        n_cells = end - start + 1
+
+        # The primary read is measured by the caller's http_exchange()
+        primary = self._executor.submit(with_log_context(self._timed_range), wks, start, end)
+
+        per_cell = self.latency.percentile(self.percentile)
+        timeout = None if per_cell is None else per_cell * n_cells
+        done, _ = wait([primary], timeout=timeout)
+        if done:
+            return primary.result()
+
+        # Split into at most n_cells ranges
+        split = min(self.split, n_cells)
+        if not self._spend(split):
+            logger.debug('Hedge budget used up, waiting for range '
+                         + str(start) + '-' + str(end))
+            return primary.result()
+
+        logger.debug('Hedging range ' + str(start) + '-' + str(end)
+                     + ' after ' + '{:.2f}'.format(timeout) + 's')
+        hedges = [self._executor.submit(self._timed_range, wks, h_start, h_end)
+                  for h_start, h_end in _split_range(start, end, split)]
+
+        pending = set(hedges) | {primary}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            if primary.done() and primary.exception() is None:
+                return primary.result()
+
+            if all(h.done() for h in hedges):
+                if all(h.exception() is None for h in hedges):
+                    with self._lock:
+                        self.n_hedge_wins += 1
+                    cells = []
+                    for h in hedges:
+                        cells.extend(h.result())
+                    return cells
+                if primary.done():
+                    # Both failed, raise the primary's error
+                    return primary.result()
+
+            if not pending:
+                return primary.result()
+
+    def log_stats(self):
+        if self.n_hedged:
+            logger.info('Hedged ' + str(self.n_hedged) + '/' + str(self.n_reads)
+                        + ' range reads, hedges finished first '
+                        + str(self.n_hedge_wins) + ' times')
+
+
+def _split_range(start, end, n):
+    '''Split start to end into n almost equal ranges'''
+    n_cells = end - start + 1
+    for k in range(n):
+        h_start = start + (n_cells * k) // n
+        h_end = start + (n_cells * (k + 1)) // n - 1
+        yield h_start, h_end
@@ -0,0 +1,410 @@
+'''Reading and writing of the file which describes an upload.
+
+Version 1 is the original indented JSON file.
+
+Version 2 is a compact indexed file:
+
+    SHEETDISK 2
+    {header JSON, on one line}
+    one fixed width record per data sheet, in file order
+    one fixed width record per parity sheet
+
+Records have a fixed width, so record i is found by seeking, and the
+sheet holding a byte offset is found with a binary search over the data
+records, without reading the rest of the file.'''
+
+import os, json
+from collections import namedtuple
+from math import ceil
+from .utils import CELL_CHAR_LIMIT, CELLS_PER_SHEET, CHAR_PER_SHEET, BYTES_PER_CELL, BYTES_PER_SHEET
+
+MAGIC = b'SHEETDISK 2\n'
+
+# File extension for each manifest version
+EXTENSIONS = {1: '.json', 2: '.sdm'}
+
+# kind offset length cells account key
+RECORD_FORMAT = '{} {:016x} {:010x} {:04x} {:04x} {}\n'
+RECORD_FIXED = len(RECORD_FORMAT.format('D', 0, 0, 0, 0, ''))
+# Length of sheets of files uploaded before file_size was recorded
+UNKNOWN_LENGTH = 0xffffffffff
+
+SheetRecord = namedtuple(
+    'SheetRecord',
+    'index kind key account offset length cells')
+'''
+index = Position of the sheet in key_list (0-indexed)
+kind = 'D' for a data sheet, 'P' for a parity sheet
+offset = Byte offset in the stored data where the sheet's data starts,
+        for a parity sheet the start of its group. The stored data is the
+        file without its zero_extents, if it has any
+length = Bytes of the stored data in the sheet, None if unknown
+cells = No of cells used in the sheet
+'''
+
+def cells_for(n_bytes):
+    '''No of cells needed to store n_bytes'''
+    return ceil(4 * ceil(n_bytes / 3) / CELL_CHAR_LIMIT)
+
+
+class Manifest:
+    '''
+    Details of an uploaded file, read from either manifest version.
+
+    Version 2 files are read lazily, records are only read when needed.
+    '''
+
+    def __init__(self, header, records=None, path=None, records_start=None):
+        # Header has the same keys as a version 1 JSON file,
+        # except key_list and account_list
+        self.header = header
+
+        # In memory records, in key_list order
+        self._records = records
+
+        # Where to read the records of a version 2 file from
+        self._path = path
+        self._records_start = records_start
+        self._record_size = header.get('record_size')
+
+        self.n_data = header.get('n_data')
+        self.n_parity = header.get('n_parity', 0)
+        if records is not None:
+            self.n_data = sum(1 for r in records if r.kind == 'D')
+            self.n_parity = len(records) - self.n_data
+
+    # Header values
+
+    @property
+    def name(self):
+        return self.header['name']
+
+    @property
+    def complete_upload(self):
+        return self.header['complete_upload']
+
+    @property
+    def n_sheets(self):
+        return self.header['n_sheets']
+
+    @property
+    def file_size(self):
+        return self.header.get('file_size')
+
+    @property
+    def stripe(self):
+        return self.header.get('stripe')
+
+    @property
+    def zero_extents(self):
+        '''[[offset, length], ...] of the zero regions left out of the sheets'''
+        return self.header.get('zero_extents') or []
+
+    @property
+    def stored_size(self):
+        '''Bytes stored in sheets, file_size without the zero regions'''
+        return stored_size(self.header)
+
+    @property
+    def n_uploaded(self):
+        '''No of sheets uploaded'''
+        return self.n_data + self.n_parity
+
+    # Loading
+
+    @classmethod
+    def load(cls, path):
+        '''Read a manifest file of either version'''
+        with open(path, 'rb') as f:
+            first = f.readline()
+            if first == MAGIC:
+                header = json.loads(f.readline().decode('utf-8'))
+                return cls(header, path=path, records_start=f.tell())
+
+            f.seek(0)
+            return cls.from_dict(json.loads(f.read().decode('utf-8')))
+
+    @classmethod
+    def is_manifest(cls, path):
+        '''Return True if path is a manifest file of either version'''
+        if not os.path.isfile(path):
+            return False
+        try:
+            cls.load(path)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return True
+
+    @classmethod
+    def from_dict(cls, json_dict):
+        '''Build a manifest from a version 1 JSON dict'''
+        header = {key: value for key, value in json_dict.items()
+                  if key not in ('key_list', 'account_list')}
+        key_list = json_dict['key_list']
+        account_list = json_dict.get('account_list') or [None] * len(key_list)
+
+        sheets = layout(header, len(key_list))
+        records = [SheetRecord(i, kind, key, account, offset, length, cells)
+                   for i, (key, account, (kind, offset, length, cells))
+                   in enumerate(zip(key_list, account_list, sheets))]
+        return cls(header, records=records)
+
+    # Records
+
+    def _read_record(self, table_pos):
+        '''Read record table_pos of a version 2 file, with one seek'''
+        with open(self._path, 'rb') as f:
+            f.seek(self._records_start + table_pos * self._record_size)
+            line = f.read(self._record_size).decode('ascii')
+
+        # The key is last, padded with spaces to key_width
+        kind, offset, length, cells, account, key = line.split(' ', 5)
+        account = int(account, 16)
+        accounts = self.header.get('accounts', [])
+        length = int(length, 16)
+        return (kind, key.strip(), accounts[account] if account < len(accounts) else None,
+                int(offset, 16), None if length == UNKNOWN_LENGTH else length,
+                int(cells, 16))
+
+    def _table_pos(self, index):
+        '''Position in the version 2 record table of sheet index'''
+        stripe = self.stripe
+        if not stripe:
+            return index
+        k, m = stripe['k'], stripe['m']
+        group, j = divmod(index, k + m)
+        if j < k:
+            return group * k + j
+        return self.n_data + group * m + (j - k)
+
+    def _index_of_data(self, data_pos):
+        '''Sheet index of data record data_pos'''
+        stripe = self.stripe
+        if not stripe:
+            return data_pos
+        group, j = divmod(data_pos, stripe['k'])
+        return group * (stripe['k'] + stripe['m']) + j
+
+    def sheet(self, index):
+        '''Return the SheetRecord of sheet index (0-indexed)'''
+        if not 0 <= index < self.n_uploaded:
+            raise IndexError('Sheet index out of range: ' + str(index))
+        if self._records is not None:
+            return self._records[index]
+
+        kind, key, account, offset, length, cells = self._read_record(self._table_pos(index))
+        return SheetRecord(index, kind, key, account, offset, length, cells)
+
+    def _data_sheet(self, data_pos):
+        return self.sheet(self._index_of_data(data_pos))
+
+    def records(self):
+        '''Return every SheetRecord, in key_list order'''
+        if self._records is None:
+            self._records = [self.sheet(i) for i in range(self.n_uploaded)]
+        return self._records
+
+    @property
+    def key_list(self):
+        return [r.key for r in self.records()]
+
+    @property
+    def account_list(self):
+        return [r.account for r in self.records()]
+
+    def locate(self, offset):
+        '''
+        Find the data sheet and cell holding a byte offset of the file,
+        reading O(log n) records.
+
+        Returns (SheetRecord, cell_no, offset_in_cell), cell_no is 1-indexed
+        '''
+        if offset < 0 or (self.file_size is not None and offset >= self.file_size):
+            raise ValueError('Offset out of range: ' + str(offset))
+        offset = self._stored_offset(offset)
+
+        # Last data sheet starting at or before offset
+        lo, hi = 0, self.n_data - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._data_sheet(mid).offset <= offset:
+                lo = mid
+            else:
+                hi = mid - 1
+
+        record = self._data_sheet(lo)
+        local = offset - record.offset
+        if record.length is not None and local >= record.length:
+            raise ValueError('Offset ' + str(offset) + ' is not uploaded yet')
+
+        cell_no, offset_in_cell = divmod(local, BYTES_PER_CELL)
+        return record, cell_no + 1, offset_in_cell
+
+    def _stored_offset(self, offset):
+        '''Map an offset of the file to one of the stored data'''
+        zeros = 0
+        for start, length in self.zero_extents:
+            if offset < start:
+                break
+            if offset < start + length:
+                raise ValueError('Offset ' + str(offset) + ' is in a zero region, not stored')
+            zeros += length
+        return offset - zeros
+
+    # Saving
+
+    def to_dict(self):
+        '''Return the version 1 JSON dict, with key_list at the end'''
+        json_dict = dict(self.header)
+        for key in ('manifest_version', 'codec', 'geometry', 'accounts',
+                    'n_data', 'n_parity', 'key_width', 'record_size'):
+            json_dict.pop(key, None)
+
+        records = self.records()
+        if any(r.account for r in records):
+            json_dict['account_list'] = [r.account for r in records]
+        # Key list is last, since it can be very long
+        json_dict['key_list'] = [r.key for r in records]
+        return json_dict
+
+    def save(self, path, manifest_version=1):
+        if manifest_version == 1:
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=4)
+        elif manifest_version == 2:
+            self._save_v2(path)
+        else:
+            raise ValueError('Invalid manifest version: ' + str(manifest_version))
+
+    def _save_v2(self, path):
+        records = self.records()
+        accounts = []
+        for r in records:
+            if r.account is not None and r.account not in accounts:
+                accounts.append(r.account)
+
+        key_width = max([len(r.key) for r in records] + [1])
+
+        header = self.to_dict()
+        del header['key_list']
+        header.pop('account_list', None)
+        header.update({
+            'manifest_version': 2,
+            'codec': {'name': 'base64', 'cell_chars': CELL_CHAR_LIMIT, 'prefix': "'"},
+            'geometry': {
+                'cells_per_sheet': CELLS_PER_SHEET,
+                'bytes_per_cell': BYTES_PER_CELL,
+                'bytes_per_sheet': BYTES_PER_SHEET,
+            },
+            'accounts': accounts,
+            'n_data': self.n_data,
+            'n_parity': self.n_parity,
+            'key_width': key_width,
+            'record_size': RECORD_FIXED + key_width,
+        })
+
+        data = [r for r in records if r.kind == 'D']
+        parity = [r for r in records if r.kind == 'P']
+
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for r in data + parity:
+                account = accounts.index(r.account) if r.account is not None else 0xffff
+                f.write(RECORD_FORMAT.format(
+                    r.kind, r.offset,
+                    UNKNOWN_LENGTH if r.length is None else r.length, r.cells, account,
+                    r.key.ljust(key_width)).encode('ascii'))
+
+
+def sheets_needed(file_size, stripe=None):
+    '''
+    No of sheets needed to upload file_size bytes
+
+    stripe = Optional (k, m), to count the data and parity sheets of each group
+    '''
+    if stripe:
+        k, m = stripe
+        n_groups = ceil(file_size / (k * BYTES_PER_SHEET))
+        return n_groups * (k + m)
+
+    # b64 gives 4 bytes for input 3 bytes
+    b64_size = 4 * ceil(file_size / 3)
+    return ceil(b64_size / CHAR_PER_SHEET)
+
+def upload_header(file_size, stripe=None):
+    '''Header of a fresh upload of file_size bytes, enough for layout() and transfer_size()'''
+    header = {'file_size': file_size}
+    if stripe:
+        header['stripe'] = {'k': stripe[0], 'm': stripe[1], 'shard_size': BYTES_PER_SHEET}
+    return header
+
+def stored_size(header):
+    '''Bytes stored in sheets, file_size unless zero regions were left out'''
+    return header.get('stored_size', header.get('file_size'))
+
+def shard_len(stripe, file_size, group):
+    '''Bytes in each shard of group (0-indexed), the last group has shorter shards'''
+    k, shard_size = stripe['k'], stripe['shard_size']
+    return min(shard_size, -(-(file_size - group * k * shard_size) // k))
+
+def layout(header, n_uploaded):
+    '''
+    Yield (kind, offset, length, cells) of the first n_uploaded sheets,
+    from the header of a version 1 file
+    '''
+    file_size = stored_size(header)
+    stripe = header.get('stripe')
+
+    if stripe:
+        k, m, shard_size = stripe['k'], stripe['m'], stripe['shard_size']
+        for index in range(n_uploaded):
+            group, j = divmod(index, k + m)
+            group_start = group * k * shard_size
+            shard_bytes = shard_len(stripe, file_size, group)
+            cells = cells_for(shard_bytes)
+            if j < k:
+                offset = group_start + j * shard_bytes
+                length = max(0, min(shard_bytes, file_size - offset))
+                yield 'D', offset, length, cells
+            else:
+                yield 'P', group_start, shard_bytes, cells
+        return
+
+    # Files uploaded before file_size was recorded only have cell_count
+    cell_count = header.get('cell_count')
+    for index in range(n_uploaded):
+        offset = index * BYTES_PER_SHEET
+        if file_size is not None:
+            length = min(BYTES_PER_SHEET, file_size - offset)
+            cells = cells_for(length)
+        else:
+            length = None
+            cells = CELLS_PER_SHEET
+            if cell_count is not None and index == n_uploaded - 1:
+                cells = cell_count - index * CELLS_PER_SHEET
+        yield 'D', offset, length, cells
+
+def transfer_size(header, n_sheets, data_only=False):
+    '''
+    Return (n_bytes, n_cells) moved to or from the first n_sheets sheets,
+    counting the padding of shards and not the zero regions left out.
+    n_bytes is None if the file size isn't known.
+
+    data_only = Leave out parity sheets, which downloads only read when needed
+    '''
+    stripe = header.get('stripe')
+    file_size = stored_size(header)
+    n_bytes = 0 if file_size is not None else None
+    n_cells = 0
+    for index, (kind, offset, length, cells) in enumerate(layout(header, n_sheets)):
+        if kind == 'P' and data_only:
+            continue
+        n_cells += cells
+        if n_bytes is None:
+            continue
+        if stripe:
+            # Data shards are padded to the shard length
+            length = shard_len(stripe, file_size, index // (stripe['k'] + stripe['m']))
+        n_bytes += length
+    return n_bytes, n_cells
@@ -0,0 +1,409 @@
+'''Counters and timings of API calls and pipeline stages.
+
+Every gspread call made by a transfer (create, share, open_by_key, range,
+update_cells...) and every local stage (base64, Reed-Solomon, disk reads
+and writes) is timed with timed(op), along with its payload size and
+whether it failed. The transport adds the status of every HTTP response,
+retries, and time spent waiting on the rate limiters.
+
+Metrics are process wide, and can be exported as a summary in the log,
+a Prometheus textfile, or served over HTTP in the OpenMetrics format.
+
+With profiling on, each phase of a transfer (see phase()) is also run
+under cProfile, and its memory allocations are traced with tracemalloc.'''
+
+import os, time, threading, logging
+from contextlib import contextmanager
+from .my_logging import get_logger
+
+logger = get_logger()
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'sheet_disk_'
+
+# Content types of the exposition formats
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# No of allocation sites listed for each profiled phase
+TOP_ALLOCATIONS = 25
+
+
+class OpStats:
+    '''Count, errors, bytes and latency histogram of one operation'''
+    __slots__ = 'count', 'errors', 'seconds', 'bytes', 'buckets', 'max'
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        # Not cumulative, buckets[i] counts durations in (BUCKETS[i-1], BUCKETS[i]]
+        # and the last one those above BUCKETS[-1]
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.max = 0.0
+
+    def add(self, seconds, n_bytes, error):
+        self.count += 1
+        self.errors += bool(error)
+        self.seconds += seconds
+        self.bytes += n_bytes
+        self.max = max(self.max, seconds)
+
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+
+class Timer:
+    '''
+    Yielded by timed(), set bytes once the payload size is known.
+    seconds is set when the with block ends.
+    '''
+    __slots__ = 'bytes', 'seconds'
+
+    def __init__(self, n_bytes):
+        self.bytes = n_bytes
+        self.seconds = None
+
+
+def _trace(op, timer, error=False):
+    '''Log the timing of one call, only written to a trace file'''
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s took %.3fs', op, timer.seconds, extra={'trace': {
+            'op': op,
+            'seconds': timer.seconds,
+            'bytes': timer.bytes,
+            'error': error,
+        }})
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        # op -> OpStats
+        self._ops = {}
+        # (kind, status) -> OpStats of HTTP requests
+        self._http = {}
+        # kind -> no of retried requests
+        self._retries = {}
+        # kind -> seconds spent waiting for rate limiter tokens
+        self._waits = {}
+
+    def observe(self, op, seconds, n_bytes=0, error=False):
+        with self._lock:
+            stats = self._ops.get(op)
+            if stats is None:
+                stats = self._ops[op] = OpStats()
+            stats.add(seconds, n_bytes, error)
+
+    @contextmanager
+    def timed(self, op, n_bytes=0):
+        '''Time the body of the with block as one call of op'''
+        timer = Timer(n_bytes)
+        start = time.perf_counter()
+        try:
+            yield timer
+        except BaseException:
+            timer.seconds = time.perf_counter() - start
+            self.observe(op, timer.seconds, timer.bytes, error=True)
+            _trace(op, timer, error=True)
+            raise
+        timer.seconds = time.perf_counter() - start
+        self.observe(op, timer.seconds, timer.bytes)
+        _trace(op, timer)
+
+    def http_response(self, kind, status, seconds, n_bytes):
+        '''Record one HTTP response, status is 0 if the request raised'''
+        key = (kind or 'other', str(status))
+        with self._lock:
+            stats = self._http.get(key)
+            if stats is None:
+                stats = self._http[key] = OpStats()
+            stats.add(seconds, n_bytes, status == 0 or status >= 400)
+
+    def retry(self, kind):
+        kind = kind or 'other'
+        with self._lock:
+            self._retries[kind] = self._retries.get(kind, 0) + 1
+
+    def rate_wait(self, kind, seconds):
+        kind = kind or 'other'
+        with self._lock:
+            self._waits[kind] = self._waits.get(kind, 0.0) + seconds
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            for values in (self._ops, self._http, self._retries, self._waits):
+                values.clear()
+
+    def snapshot(self):
+        '''Return the metrics as a dict, eg. for the daemon's status'''
+        def op_dict(stats):
+            return {
+                'count': stats.count,
+                'errors': stats.errors,
+                'seconds': round(stats.seconds, 6),
+                'bytes': stats.bytes,
+                'max': round(stats.max, 6),
+            }
+
+        with self._lock:
+            return {
+                'ops': {op: op_dict(stats) for op, stats in self._ops.items()},
+                'http': {kind + ' ' + status: op_dict(stats)
+                         for (kind, status), stats in self._http.items()},
+                'retries': dict(self._retries),
+                'rate_wait': {kind: round(seconds, 6) for kind, seconds in self._waits.items()},
+            }
+
+    # Export
+
+    def log_summary(self):
+        '''Log a table of where time went, slowest operations first'''
+        snapshot = self.snapshot()
+        if not snapshot['ops'] and not snapshot['http']:
+            return
+
+        f_str = '{:<16s} {:>8s} {:>7s} {:>10s} {:>9s} {:>9s} {:>11s}'
+        logger.info('')
+        logger.info(f_str.format('Operation', 'Calls', 'Errors', 'Total s',
+                                 'Mean ms', 'Max ms', 'MB'))
+        ops = sorted(snapshot['ops'].items(), key=lambda item: -item[1]['seconds'])
+        for op, stats in ops:
+            logger.info(f_str.format(
+                op,
+                str(stats['count']),
+                str(stats['errors']),
+                '{:.2f}'.format(stats['seconds']),
+                '{:.1f}'.format(1000 * stats['seconds'] / max(stats['count'], 1)),
+                '{:.1f}'.format(1000 * stats['max']),
+                '{:.2f}'.format(stats['bytes'] / 10 ** 6)))
+
+        for name, stats in sorted(snapshot['http'].items()):
+            logger.info('HTTP ' + name + ': ' + str(stats['count']) + ' responses, '
+                        + '{:.2f}'.format(stats['seconds']) + 's')
+        for kind, count in sorted(snapshot['retries'].items()):
+            logger.info('Retried ' + kind + ' requests: ' + str(count))
+        for kind, seconds in sorted(snapshot['rate_wait'].items()):
+            logger.info('Waited for ' + kind + ' quota: ' + '{:.2f}'.format(seconds) + 's')
+
+    def exposition(self, openmetrics=False):
+        '''Return the metrics in the Prometheus text format, or OpenMetrics'''
+        lines = []
+        # Counters are named without _total in OpenMetrics metadata
+        total = '' if openmetrics else '_total'
+
+        def family(name, kind, help_text):
+            lines.append('# HELP ' + PREFIX + name + ' ' + help_text)
+            lines.append('# TYPE ' + PREFIX + name + ' ' + kind)
+
+        def sample(name, labels, value):
+            label_str = ','.join(key + '="' + _escape(val) + '"' for key, val in labels)
+            lines.append(PREFIX + name + ('{' + label_str + '}' if label_str else '')
+                         + ' ' + _number(value))
+
+        def histograms(name, help_text, items):
+            family(name, 'histogram', help_text)
+            for labels, stats in items:
+                cumulative = 0
+                for bound, n in zip(BUCKETS, stats.buckets):
+                    cumulative += n
+                    sample(name + '_bucket', labels + [('le', _number(bound))], cumulative)
+                sample(name + '_bucket', labels + [('le', '+Inf')], stats.count)
+                sample(name + '_count', labels, stats.count)
+                sample(name + '_sum', labels, stats.seconds)
+
+        with self._lock:
+            ops = sorted(self._ops.items())
+            http = sorted(self._http.items())
+            retries = sorted(self._retries.items())
+            waits = sorted(self._waits.items())
+
+            family('calls' + total, 'counter', 'Calls of each operation')
+            for op, stats in ops:
+                sample('calls_total', [('op', op)], stats.count)
+            family('call_errors' + total, 'counter', 'Calls of each operation which raised')
+            for op, stats in ops:
+                sample('call_errors_total', [('op', op)], stats.errors)
+            family('call_bytes' + total, 'counter', 'Payload bytes of each operation')
+            for op, stats in ops:
+                sample('call_bytes_total', [('op', op)], stats.bytes)
+            histograms('call_seconds', 'Duration of each operation',
+                       [([('op', op)], stats) for op, stats in ops])
+
+            family('http_responses' + total, 'counter', 'HTTP responses by request kind and status')
+            for (kind, status), stats in http:
+                sample('http_responses_total', [('kind', kind), ('status', status)], stats.count)
+            family('http_response_bytes' + total, 'counter', 'Bytes of HTTP response bodies')
+            for (kind, status), stats in http:
+                sample('http_response_bytes_total', [('kind', kind), ('status', status)],
+                       stats.bytes)
+            histograms('http_request_seconds', 'Duration of HTTP requests',
+                       [([('kind', kind), ('status', status)], stats)
+                        for (kind, status), stats in http])
+
+            family('http_retries' + total, 'counter', 'Requests retried after a quota or server error')
+            for kind, count in retries:
+                sample('http_retries_total', [('kind', kind)], count)
+            family('rate_limit_wait_seconds' + total, 'counter',
+                   'Seconds spent waiting for rate limiter tokens')
+            for kind, seconds in waits:
+                sample('rate_limit_wait_seconds_total', [('kind', kind)], seconds)
+
+            family('start_time_seconds', 'gauge', 'Unix time the metrics started at')
+            sample('start_time_seconds', [], self.started)
+
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        '''
+        Write the metrics to path in the Prometheus text format,
+        eg. for the textfile collector of node_exporter
+        '''
+        # Rename a temporary file, so the collector never reads half a file
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.exposition())
+        os.replace(tmp_path, path)
+        logger.debug('Wrote metrics to ' + path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+# Process wide metrics
+_metrics = Metrics()
+
+def get_metrics():
+    return _metrics
+
+def timed(op, n_bytes=0):
+    '''Time a with block as one call of op, in the process wide metrics'''
+    return _metrics.timed(op, n_bytes)
+
+
+def serve_metrics(port, host='127.0.0.1'):
+    '''
+    Serve the metrics on http://host:port/metrics from a background thread,
+    in the OpenMetrics format if the scraper asks for it.
+    Returns the server, call its shutdown() to stop it.
+    '''
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+
+            openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+            body = _metrics.exposition(openmetrics).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug('Metrics request: ' + format % args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='Metrics server')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on http://' + host + ':' + str(server.server_port) + '/metrics')
+    return server
+
+
+# Directory profiles are saved in, None if profiling is off
+_profile_dir = None
+_profile_lock = threading.Lock()
+_profile_count = 0
+# Held by the phase being profiled, only one profiler can be active at once
+_profiling = threading.Lock()
+
+def set_profile_dir(path):
+    '''Profile every phase from now on, saving the results in path. None turns it off'''
+    global _profile_dir
+    if path is None:
+        _profile_dir = None
+        return
+
+    import tracemalloc
+    os.makedirs(path, exist_ok=True)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _profile_dir = path
+
+@contextmanager
+def phase(name):
+    '''
+    Run the body of the with block as a phase of a transfer, eg. 'upload'.
+
+    With profiling on, the phase is profiled with cProfile, which sees
+    the thread running the phase (encoding, decoding, disk I/O and waiting
+    on the workers), and the allocations made during the phase, by any
+    thread, are saved from tracemalloc.
+
+    Only one phase is profiled at a time, so phases which start while
+    another is profiled (eg. other files of a batch, or nested phases)
+    run without profiling.
+    '''
+    if _profile_dir is None:
+        yield
+        return
+
+    if not _profiling.acquire(blocking=False):
+        logger.debug('Not profiling ' + name + ', another phase is being profiled')
+        yield
+        return
+    try:
+        with _profile_phase(name):
+            yield
+    finally:
+        _profiling.release()
+
+@contextmanager
+def _profile_phase(name):
+    '''Profile the body of the with block, called with _profiling held'''
+    import cProfile, tracemalloc
+    global _profile_count
+    with _profile_lock:
+        _profile_count += 1
+        base = os.path.join(_profile_dir, '{:03d}-{}'.format(_profile_count, name))
+
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+
+        profiler.dump_stats(base + '.prof')
+        with open(base + '.mem.txt', 'w') as f:
+            f.write('Peak traced memory: ' + '{:.1f}'.format(peak / 10 ** 6) + ' MB\n\n')
+            for stat in after.compare_to(before, 'lineno')[:TOP_ALLOCATIONS]:
+                f.write(str(stat) + '\n')
+        logger.info('Profile of ' + name + ' saved to ' + base + '.prof and ' + base + '.mem.txt')
@@ -1,24 +1,178 @@
-'''Logging utilities are stored in this file'''
+'''Logging utilities are stored in this file
+
+Records are put on a queue by the thread which logs them, and a
+listener thread formats and writes them, so worker threads never
+wait on the console or a log file.'''
+
+import logging, logging.handlers
+import datetime, sys, json, queue, atexit, contextvars, functools
+from contextlib import contextmanager
 
-import logging
-import datetime, sys
-        
 # On module init
 logger_made = False
 g_logger = None
 
+# Listener which writes the queued records, None once it is stopped
+_listener = None
+_queue = None
+
+# Transfer being worked on by the current thread, eg.
+# {'file': 'a.bin', 'sheet': 2, 'range': '1-200'}, added to every record
+_context = contextvars.ContextVar('log_context', default={})
+
 class MyConsoleHandler(logging.StreamHandler):
-    # Modify this when printing progress bar
-    terminator = logging.StreamHandler.terminator
-    @classmethod
-    def change_terminator(cls, repl):
-        cls.terminator = repl
-    @classmethod
-    def restore_terminator(cls):
-        cls.terminator = logging.StreamHandler.terminator
+    # Progress bars write to the same stream,
+    # see get_console_stream()
+    pass
+
+class ContextFilter(logging.Filter):
+    '''Adds the transfer context of the logging thread to records, as record.context'''
+
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+class MyQueueHandler(logging.handlers.QueueHandler):
+    # The queue doesn't leave the process, so records are queued as they are
+    # and formatted by the listener, instead of by the thread which logs them
+    def prepare(self, record):
+        return record
+
+class ConsoleText(str):
+    '''Text put on the queue to be written to the console as is, eg. a progress bar'''
+
+class MyQueueListener(logging.handlers.QueueListener):
+
+    def handle(self, record):
+        try:
+            if isinstance(record, ConsoleText):
+                _write_console(record)
+            else:
+                super().handle(record)
+        except Exception:
+            # A broken handler mustn't stop the thread,
+            # records would pile up and flush_logs() would never return
+            pass
+
+class TraceFormatter(logging.Formatter):
+    '''Formats records as JSON lines, with their transfer context and timings'''
+
+    def format(self, record):
+        event = {
+            'time': record.created,
+            'level': record.levelname,
+            'thread': record.threadName,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        event.update(getattr(record, 'context', None) or {})
+        # eg. {'op': 'range', 'seconds': 0.8, 'bytes': 371250}, from metrics.timed()
+        event.update(getattr(record, 'trace', None) or {})
+        if record.exc_info:
+            event['exc'] = self.formatException(record.exc_info)
+        return json.dumps(event)
+
+@contextmanager
+def log_context(**values):
+    '''Add values to the context of records logged in the with block, eg. file='a.bin' '''
+    token = _context.set({**_context.get(), **values})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def with_log_context(fn):
+    '''Return fn bound to the log context of the calling thread, to be run by another thread'''
+    return functools.partial(contextvars.copy_context().run, fn)
+
+def _handlers():
+    '''Return the handlers which write records'''
+    if _listener is not None:
+        return _listener.handlers
+    return get_logger().handlers
+
+def _update_level():
+    # Records no handler wants aren't even created,
+    # so debug calls are cheap when nothing logs them
+    get_logger().setLevel(min(handler.level for handler in _handlers()))
+
+def flush_logs():
+    '''
+    Wait until every record logged so far has been written.
+    Blocks while other threads keep logging, so not for worker threads
+    '''
+    if _listener is not None:
+        _queue.join()
+
+def _write_console(text):
+    stream = get_console_stream()
+    if stream is None:
+        return
+    try:
+        stream.write(text)
+        stream.flush()
+    except (OSError, ValueError):
+        pass
+
+def write_console(text):
+    '''
+    Write text to the console as is, after the records already queued,
+    without waiting for them to be written
+    '''
+    if _listener is not None:
+        _queue.put_nowait(ConsoleText(text))
+    else:
+        _write_console(text)
+
+def _stop_listener():
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+
+    # Records logged while exiting are written right away
+    logger = get_logger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for handler in listener.handlers:
+        handler.addFilter(ContextFilter())
+        logger.addHandler(handler)
+
+def log_to_stderr():
+    '''Print console messages to stderr, so stdout can carry file data'''
+    # Records already queued for stdout go there first
+    flush_logs()
+    for handler in _handlers():
+        if isinstance(handler, MyConsoleHandler):
+            handler.setStream(sys.stderr)
+
+def get_console_stream():
+    '''Return the stream console messages are printed to, None if there is no console'''
+    for handler in _handlers():
+        if isinstance(handler, MyConsoleHandler):
+            return handler.stream
+    return None
+
+def set_trace_file(path):
+    '''
+    Write every record, including debug ones, to path as JSON lines,
+    with the transfer context and the timings of API calls and stages
+    '''
+    handler = logging.FileHandler(path, mode='w', encoding='utf-8')
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(TraceFormatter())
+
+    if _listener is not None:
+        # The listener thread reads handlers for each record
+        _listener.handlers = _listener.handlers + (handler,)
+    else:
+        handler.addFilter(ContextFilter())
+        get_logger().addHandler(handler)
+    _update_level()
 
 def get_logger():
-    global g_logger, logger_made
+    global g_logger, logger_made, _listener, _queue
     if not logger_made:
         # if logger is not created, then create it
 
@@ -31,9 +185,9 @@ def get_logger():
 
         # Logging setup
         logger = logging.getLogger('Sheet-Disk')
-        logger.setLevel(logging.DEBUG)
+        handlers = []
+
 
-        
         if console:
             # Handlers
             c_handler = MyConsoleHandler(sys.stdout)
@@ -44,8 +198,8 @@ def get_logger():
             c_handler.setFormatter(c_format)
 
             # Add the handler
-            logger.addHandler(c_handler)
-        
+            handlers.append(c_handler)
+
         if file_log:
             # Handlers
             f_handler = logging.FileHandler('RunLog ' + cur_time + '.log', mode='w')
@@ -56,10 +210,22 @@ def get_logger():
             f_handler.setFormatter(f_format)
 
             # Add the handler
-            logger.addHandler(f_handler)
+            handlers.append(f_handler)
+
+        # Unbounded, so logging never blocks
+        _queue = queue.Queue()
+        q_handler = MyQueueHandler(_queue)
+        q_handler.addFilter(ContextFilter())
+        logger.addHandler(q_handler)
 
+        _listener = MyQueueListener(
+                _queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        # Writes the records still queued at exit
+        atexit.register(_stop_listener)
 
         g_logger = logger
         logger_made = True
+        _update_level()
 
-    return g_logger
\ No newline at end of file
+    return g_logger
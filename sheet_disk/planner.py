@@ -0,0 +1,363 @@
+'''Planning of uploads and downloads, without touching the network.
+
+A plan uses the same layout as a real transfer: the sheets of the file
+from manifest.layout(), the cells of each sheet, and the range requests
+the request sizer splits each sheet into. Time is estimated from the
+throughput of past runs, which every upload/download/batch command saves
+in the cache directory when it ends.
+
+The estimate is the slowest of three limits: requests in flight
+(concurrency and the time of each request), the API quotas, and the
+bandwidth cap.'''
+
+import os, json, time
+from math import ceil
+from .manifest import Manifest, EXTENSIONS, layout, sheets_needed, upload_header
+from .batching import get_sizer
+from .ratelimit import PROJECT_QUOTA, ACCOUNT_QUOTA, QUOTA_USE, get_bandwidth_limiter
+from .metrics import get_metrics
+from .client import get_cache_dir, get_creds_files
+from .utils import CELL_CHAR_LIMIT
+from .my_logging import get_logger
+
+logger = get_logger()
+
+# Past runs kept in the history file
+HISTORY_RUNS = 50
+
+# Used for what no past run has measured.
+# Bytes per second of one range request, by kind
+DEFAULT_RATE = {'read': 2 * 10 ** 6, 'write': 10 ** 6}
+# Seconds of one call
+DEFAULT_SECONDS = {'create': 1.5, 'share': 1.0, 'open_by_key': 0.5}
+
+# Metrics op of the range requests of each kind
+RANGE_OPS = {'read': 'range', 'write': 'update_cells'}
+
+
+def get_history_path():
+    return os.path.join(get_cache_dir(), 'history.jsonl')
+
+def save_run(concurrency):
+    '''Add the throughput measured by this run to the history file'''
+    ops = get_metrics().snapshot()['ops']
+    run = {'time': round(time.time()), 'concurrency': concurrency}
+
+    for kind, op in RANGE_OPS.items():
+        stats = ops.get(op)
+        # Uploads read each empty sheet once, which moves no data
+        if stats and stats['bytes']:
+            run[kind] = {
+                'requests': stats['count'],
+                'seconds': stats['seconds'],
+                'bytes': stats['bytes'],
+                'cells': get_sizer(kind).cells,
+            }
+    for op in DEFAULT_SECONDS:
+        stats = ops.get(op)
+        if stats and stats['count']:
+            run[op] = {'count': stats['count'], 'seconds': stats['seconds']}
+
+    if len(run) == 2:
+        # Nothing was transferred
+        return
+
+    path = get_history_path()
+    runs = load_history() + [run]
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for past in runs[-HISTORY_RUNS:]:
+            f.write(json.dumps(past, separators=(',', ':')) + '\n')
+    os.replace(tmp_path, path)
+    logger.debug('Saved throughput of the run to ' + path)
+
+def load_history():
+    '''Return the past runs in the history file, oldest first'''
+    runs = []
+    try:
+        with open(get_history_path()) as f:
+            for line in f:
+                try:
+                    runs.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return runs
+
+def measured(runs):
+    '''
+    Combine past runs into
+    {'rate': {kind: bytes per second of one request}, 'seconds': {op: seconds},
+     'cells': {kind: cells per request}, 'runs': no of runs}
+    Values not measured by any run are left out.
+    '''
+    rate, seconds, cells = {}, {}, {}
+    for kind in RANGE_OPS:
+        samples = [run[kind] for run in runs if kind in run]
+        total = sum(s['seconds'] for s in samples)
+        if total > 0:
+            rate[kind] = sum(s['bytes'] for s in samples) / total
+            # Size the tuner settled on last time
+            cells[kind] = samples[-1]['cells']
+    for op in DEFAULT_SECONDS:
+        samples = [run[op] for run in runs if op in run]
+        count = sum(s['count'] for s in samples)
+        if count:
+            seconds[op] = sum(s['seconds'] for s in samples) / count
+    return {'rate': rate, 'seconds': seconds, 'cells': cells, 'runs': len(runs)}
+
+
+class Planner:
+    '''
+    Predicts the sheets, requests, quota and time of transfers
+
+    concurrency = Max no of range requests in flight
+    max_files = Max no of files transferred at the same time
+    history = Output of measured(), defaults to the saved history
+    '''
+
+    def __init__(self, concurrency, max_files=1, history=None):
+        self.concurrency = concurrency
+        self.max_files = max_files
+        self.history = history if history is not None else measured(load_history())
+
+        try:
+            self.n_accounts = len(get_creds_files())
+        except KeyError:
+            self.n_accounts = 1
+
+    # Inputs
+
+    def rate(self, kind):
+        return self.history['rate'].get(kind, DEFAULT_RATE[kind])
+
+    def seconds(self, op):
+        return self.history['seconds'].get(op, DEFAULT_SECONDS[op])
+
+    def cells_per_request(self, kind):
+        '''Cells per range request, as the sizer would pick them'''
+        sizer = get_sizer(kind)
+        if sizer.fixed is not None:
+            return sizer.fixed
+        return self.history['cells'].get(kind, sizer.cells)
+
+    def quota_per_minute(self, kind):
+        '''Requests per minute of kind the rate limiters allow'''
+        return QUOTA_USE * min(ACCOUNT_QUOTA[kind] * self.n_accounts, PROJECT_QUOTA[kind])
+
+    # Plans
+
+    def plan_upload(self, path, stripe=None, sparse=False):
+        '''Return the plan of uploading the file at path'''
+        file_size = os.stat(path).st_size
+        stored = file_size
+        if sparse:
+            # Only holes can be found without reading the file,
+            # zero runs in its data make the upload smaller still
+            from .sparse import data_regions
+            with open(path, 'rb') as f:
+                regions = data_regions(f, file_size)
+            if not regions or regions[0][1] is not None:
+                stored = sum(end - start for start, end in regions)
+
+        header = upload_header(stored, stripe)
+        n_sheets = sheets_needed(stored, stripe)
+        sheets = [(kind, cells) for kind, _, _, cells in layout(header, n_sheets)]
+
+        plan = self._plan('upload', os.path.basename(path), file_size, stored, sheets, stripe)
+        requests = plan['requests']
+        # Each sheet is created, shared, opened for its metadata,
+        # and its empty cells are read
+        requests['create'] = requests['share'] = requests['open'] = requests['read'] = n_sheets
+        plan['quota'] = self._quota({'drive': 2 * n_sheets,
+                                     'read': requests['open'] + requests['read'],
+                                     'write': requests['write']})
+        return self._finish(plan)
+
+    def plan_download(self, manifest):
+        '''Return the plan of downloading a file, from its Manifest'''
+        stripe = manifest.stripe
+        sheets = [(r.kind, r.cells) for r in manifest.records()]
+        plan = self._plan('download', manifest.name, manifest.file_size,
+                          manifest.stored_size, sheets,
+                          (stripe['k'], stripe['m']) if stripe else None)
+
+        requests = plan['requests']
+        # Striped downloads open every sheet of a group, but read only k
+        requests['open'] = len(sheets)
+        plan['quota'] = self._quota({'read': requests['open'] + requests['read']})
+        return self._finish(plan)
+
+    def _plan(self, action, name, file_size, stored, sheets, stripe):
+        '''
+        Work out the range requests of sheets, a list of (kind, cells),
+        and the time they take with self.concurrency in flight
+        '''
+        kind = 'write' if action == 'upload' else 'read'
+        planned = self.cells_per_request(kind)
+        sizer = get_sizer(kind)
+        rate = self.rate(kind)
+
+        def request_seconds(cells):
+            return cells * CELL_CHAR_LIMIT / rate
+
+        n_requests = 0
+        n_cells = 0
+        busy = 0.0
+
+        if stripe and action == 'download':
+            # Groups are read one at a time, with the k data shards
+            # of a group read at once
+            k, m = stripe
+            for group in range(0, len(sheets), k + m):
+                data = [cells for sheet_kind, cells in sheets[group:group + k + m]
+                        if sheet_kind == 'D']
+                ranges = [end - start + 1 for cells in data
+                          for _, start, end in sizer.split(cells, planned)]
+                n_requests += len(ranges)
+                n_cells += sum(data)
+                busy += self.seconds('open_by_key') \
+                    + ceil(len(ranges) / self.concurrency) * request_seconds(max(ranges))
+        else:
+            # Sheets are transferred one at a time, with their ranges at once.
+            # Reading the empty cells of a new sheet takes about as long as opening one
+            fixed = self.seconds('create') + self.seconds('share') + self.seconds('open_by_key') \
+                if action == 'upload' else self.seconds('open_by_key')
+            for _, cells in sheets:
+                ranges = [end - start + 1 for _, start, end in sizer.split(cells, planned)]
+                n_requests += len(ranges)
+                n_cells += cells
+                busy += fixed + ceil(len(ranges) / self.concurrency) * request_seconds(max(ranges))
+
+        return {
+            'action': action,
+            'name': name,
+            'file_size': file_size,
+            'stored_size': stored,
+            'sheets': len(sheets),
+            'cells': n_cells,
+            'cells_per_request': planned,
+            # base64 text of the cells, as sent or received
+            'wire_bytes': n_cells * CELL_CHAR_LIMIT,
+            'requests': {kind: n_requests},
+            'busy_seconds': round(busy, 1),
+        }
+
+    def _quota(self, requests):
+        '''Return {kind: minutes of quota used} for {kind: no of requests}'''
+        return {kind: round(n / self.quota_per_minute(kind), 3)
+                for kind, n in requests.items() if n}
+
+    def _finish(self, plan):
+        kind = 'write' if plan['action'] == 'upload' else 'read'
+        plan['seconds'], plan['limited_by'] = self._wall_time(
+                plan['busy_seconds'], plan['quota'], plan['wire_bytes'])
+        plan['suggested_concurrency'] = self.suggest_concurrency(kind, plan['cells_per_request'])
+        return plan
+
+    def _wall_time(self, busy, quota, wire_bytes):
+        '''Return (seconds, limit) of the slowest of the limits of a transfer'''
+        limits = {'requests in flight': busy}
+        if quota:
+            kind, minutes = max(quota.items(), key=lambda item: item[1])
+            limits[kind + ' quota'] = 60 * minutes
+        limiter = get_bandwidth_limiter()
+        if limiter is not None:
+            limits['bandwidth cap'] = wire_bytes / limiter.rate
+
+        limit = max(limits, key=limits.get)
+        return round(limits[limit], 1), limit
+
+    def suggest_concurrency(self, kind, cells):
+        '''
+        Requests in flight which keep the quota of kind busy, with requests of cells cells.
+        More only wait on the rate limiters
+        '''
+        per_second = self.quota_per_minute(kind) / 60
+        return max(1, ceil(per_second * cells * CELL_CHAR_LIMIT / self.rate(kind)))
+
+    def total(self, plans):
+        '''Return the sums of plans, with the time of running them as a batch'''
+        requests, quota = {}, {}
+        for plan in plans:
+            for kind, n in plan['requests'].items():
+                requests[kind] = requests.get(kind, 0) + n
+            for kind, minutes in plan['quota'].items():
+                quota[kind] = round(quota.get(kind, 0) + minutes, 3)
+
+        # Files share the workers, up to max_files at a time
+        parallel = max(1, min(self.max_files, len(plans)))
+        busy = sum(plan['busy_seconds'] for plan in plans) / parallel
+        wire_bytes = sum(plan['wire_bytes'] for plan in plans)
+        seconds, limited_by = self._wall_time(busy, quota, wire_bytes)
+
+        return {
+            'files': len(plans),
+            'sheets': sum(plan['sheets'] for plan in plans),
+            'requests': requests,
+            'wire_bytes': wire_bytes,
+            'quota': quota,
+            'seconds': seconds,
+            'limited_by': limited_by,
+        }
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(ceil(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{:d}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+    if minutes:
+        return '{:d}m{:02d}s'.format(minutes, seconds)
+    return '{:d}s'.format(seconds)
+
+def log_plan(plan):
+    '''Log a plan from Planner.plan_upload()/plan_download() or Planner.total()'''
+    mb = 10 ** 6
+    if 'name' in plan:
+        line = plan['action'].capitalize() + ' ' + plan['name']
+        if plan['file_size'] is not None:
+            line += ' ({:.1f} MB'.format(plan['file_size'] / mb)
+            if plan['stored_size'] != plan['file_size']:
+                line += ', {:.1f} MB stored'.format(plan['stored_size'] / mb)
+            line += ')'
+        logger.info('')
+        logger.info(line)
+    else:
+        logger.info('')
+        logger.info('Total for ' + str(plan['files']) + ' files')
+
+    logger.info('  Sheets: ' + str(plan['sheets']))
+    logger.info('  Requests: ' + ', '.join(
+            str(n) + ' ' + op for op, n in sorted(plan['requests'].items())))
+    logger.info('  Cells sent/received: {:.1f} MB'.format(plan['wire_bytes'] / mb))
+    logger.info('  Quota: ' + (', '.join(
+            '{:.2f} min of {}'.format(minutes, kind)
+            for kind, minutes in sorted(plan['quota'].items())) or 'none'))
+    logger.info('  Time: about ' + format_seconds(plan['seconds'])
+                + ', limited by ' + plan['limited_by'])
+    if 'suggested_concurrency' in plan:
+        logger.info('  Suggested --concurrency ' + str(plan['suggested_concurrency'])
+                    + ' for ' + str(plan['cells_per_request']) + ' cells per request')
+
+def plan_paths(paths, concurrency, max_files=1, stripe=None, sparse=False):
+    '''
+    Return (plans, total) for paths, where JSON/manifest files are
+    planned as downloads and any other file as an upload
+    '''
+    planner = Planner(concurrency, max_files)
+    if planner.history['runs']:
+        logger.info('Using the throughput of ' + str(planner.history['runs']) + ' past runs')
+    else:
+        logger.info('No past runs saved yet, using default throughput')
+
+    plans = []
+    for path in paths:
+        # Checking the extension first, so big files aren't read
+        if path.endswith(tuple(EXTENSIONS.values())) and Manifest.is_manifest(path):
+            plans.append(planner.plan_download(Manifest.load(path)))
+        else:
+            plans.append(planner.plan_upload(path, stripe, sparse))
+    return plans, planner.total(plans)
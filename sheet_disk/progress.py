@@ -0,0 +1,287 @@
+'''Progress of transfers, driven by events from the workers.
+
+Each transfer has a Tracker, which workers tell about every range of
+cells they finish. The Tracker keeps bytes and cells done for the whole
+file, and from them the current and average speed and the ETA.
+
+Progress is shown as a bar on the console, and can also be written as
+JSON lines to a file descriptor, for other programs to read.'''
+
+import os, json, time, threading
+from collections import deque
+from .my_logging import get_logger, get_console_stream, write_console
+
+logger = get_logger()
+
+# Seconds of history used for the current speed
+RATE_WINDOW = 5.0
+# Min seconds between redraws of the console bar
+CONSOLE_INTERVAL = 0.1
+# Min seconds between 'progress' events of one transfer in the JSON stream
+JSON_INTERVAL = 0.5
+
+BAR_LENGTH = 20
+MB = 10 ** 6
+
+
+class JsonLinesSink:
+    '''Writes progress events as JSON lines, shared by every transfer'''
+
+    def __init__(self, f):
+        self.f = f
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self._lock:
+            try:
+                self.f.write(line)
+                self.f.flush()
+            except (OSError, ValueError) as e:
+                # Reader has gone away, don't fail the transfer
+                logger.debug('Could not write progress: ' + repr(e))
+
+# Process wide sink, None if progress isn't streamed
+_sink = None
+
+def set_progress_fd(fd):
+    '''Write progress events as JSON lines to file descriptor fd, None to stop'''
+    global _sink
+    if fd is None:
+        _sink = None
+        return
+    _sink = JsonLinesSink(os.fdopen(fd, 'w', buffering=1, closefd=False))
+
+def get_sink():
+    return _sink
+
+
+def format_bytes(n):
+    return '{:.1f} MB'.format(n / MB)
+
+def format_eta(seconds):
+    if seconds is None:
+        return '--:--'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+    return '{:02d}:{:02d}'.format(minutes, seconds)
+
+
+class Tracker:
+    '''
+    Progress of one file being uploaded or downloaded
+
+    name = Name of the transfer
+    action = 'upload' or 'download'
+    total_bytes = Bytes to transfer, None if not known (eg. stdin)
+    total_cells = Cells to transfer, None if not known
+    n_sheets = No of sheets, None if not known
+    console = Whether to draw a progress bar on the console
+    report = Optional callable, called as
+            report(sheet_progress, completed_cells, total_cells)
+            for the current sheet, when progress is made
+    unit = What a 'sheet' is called on the console, eg. 'Group' for striped files
+    '''
+
+    def __init__(self, name, action, total_bytes=None, total_cells=None, n_sheets=None,
+                 console=True, report=None, unit='Sheet'):
+        self.name = name
+        self.action = action
+        self.total_bytes = total_bytes
+        self.total_cells = total_cells
+        self.n_sheets = n_sheets
+        self.console = console
+        self.report = report
+        self.unit = unit
+        self.sink = get_sink()
+
+        self.done_bytes = 0
+        self.done_cells = 0
+        # Done before this run, eg. sheets of a resumed upload
+        self.skipped_bytes = 0
+
+        # Current sheet
+        self.sheet_no = 0
+        self.sheet_cells = 0
+        self.sheet_done_cells = 0
+
+        self.started = time.monotonic()
+        # (time, done_bytes) for the current speed
+        self._history = deque([(self.started, 0)])
+        self._lock = threading.Lock()
+        self._last_draw = 0
+        self._last_emit = 0
+        self._line_len = 0
+
+        self._emit('start', force=True)
+
+    # Events
+
+    def start_sheet(self, sheet_no, n_sheets, cells):
+        '''A sheet with cells cells has started, n_sheets is 0 if not known'''
+        with self._lock:
+            self.sheet_no = sheet_no
+            self.n_sheets = n_sheets or self.n_sheets
+            self.sheet_cells = cells
+            self.sheet_done_cells = 0
+        self._emit('sheet', force=True)
+        self._report()
+
+    def add(self, cells, n_bytes):
+        '''cells holding n_bytes of the file have been transferred, called by workers'''
+        now = time.monotonic()
+        with self._lock:
+            self.done_cells += cells
+            self.done_bytes += n_bytes
+            self.sheet_done_cells += cells
+            self._history.append((now, self.done_bytes))
+            while len(self._history) > 2 and now - self._history[0][0] > RATE_WINDOW:
+                self._history.popleft()
+
+        self._draw()
+        self._emit('progress')
+        self._report()
+
+    def skip(self, cells, n_bytes):
+        '''Count work done before this run, without changing the speed'''
+        with self._lock:
+            self.done_cells += cells
+            self.done_bytes += n_bytes
+            self.skipped_bytes += n_bytes
+            self._history = deque([(time.monotonic(), self.done_bytes)])
+
+    def end_sheet(self):
+        '''The current sheet is done, ends the console line so other messages start on a new one'''
+        self._draw(force=True, end='\n')
+
+    def finish(self, error=None):
+        with self._lock:
+            if error is None and self.total_bytes is None:
+                # Known now, eg. at the end of stdin
+                self.total_bytes = self.done_bytes
+                self.total_cells = self.done_cells
+        self._emit('failed' if error else 'done', force=True, error=error)
+
+    # Stats
+
+    def rate(self):
+        '''Bytes per second over the last RATE_WINDOW seconds'''
+        with self._lock:
+            (t0, b0), (t1, b1) = self._history[0], self._history[-1]
+        now = time.monotonic()
+        if now - t0 <= 0:
+            return 0.0
+        return (b1 - b0) / (now - t0)
+
+    def avg_rate(self):
+        '''Bytes per second since the start, not counting skipped work'''
+        elapsed = time.monotonic() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return (self.done_bytes - self.skipped_bytes) / elapsed
+
+    def eta(self):
+        '''Seconds until the whole file is done, None if it can't be known'''
+        if self.total_bytes is None:
+            return None
+        # Current speed reacts to changes, average is steadier at the start
+        rate = self.rate() or self.avg_rate()
+        if rate <= 0:
+            return None
+        return max(0, self.total_bytes - self.done_bytes) / rate
+
+    def snapshot(self):
+        return {
+            'name': self.name,
+            'action': self.action,
+            'bytes': self.done_bytes,
+            'total_bytes': self.total_bytes,
+            'cells': self.done_cells,
+            'total_cells': self.total_cells,
+            'sheet': self.sheet_no,
+            'n_sheets': self.n_sheets,
+            'rate': round(self.rate(), 1),
+            'avg_rate': round(self.avg_rate(), 1),
+            'eta': None if self.eta() is None else round(self.eta(), 1),
+            'elapsed': round(time.monotonic() - self.started, 3),
+        }
+
+    # Output
+
+    def _report(self):
+        if self.report:
+            self.report((self.sheet_no, self.n_sheets or 0),
+                        self._sheet_done(), self.sheet_cells)
+
+    def _sheet_done(self):
+        # Cells of a sheet read ahead are counted with the current one
+        return min(self.sheet_done_cells, self.sheet_cells)
+
+    def _emit(self, event, force=False, error=None):
+        if self.sink is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_emit < JSON_INTERVAL:
+            return
+        self._last_emit = now
+
+        data = {'event': event, 'time': round(time.time(), 3)}
+        data.update(self.snapshot())
+        if error is not None:
+            data['error'] = repr(error)
+        self.sink.emit(data)
+
+    def line(self):
+        '''Return the console progress line'''
+        if self.total_bytes:
+            fraction = min(1.0, self.done_bytes / self.total_bytes)
+            filled = int(BAR_LENGTH * fraction)
+            bar = '#' * filled + '-' * (BAR_LENGTH - filled)
+            done = format_bytes(self.done_bytes) + '/' + format_bytes(self.total_bytes) \
+                   + ' {:3.0f}%'.format(100 * fraction)
+        else:
+            bar = '?' * BAR_LENGTH
+            done = format_bytes(self.done_bytes)
+
+        return (self.unit + ' ' + str(self.sheet_no) + '/' + str(self.n_sheets or '?')
+                + ' | ' + bar + ' | ' + done
+                + ' | ' + str(self._sheet_done()) + '/' + str(self.sheet_cells) + ' cells'
+                + ' | ' + format_bytes(self.rate()) + '/s'
+                + ' (avg ' + format_bytes(self.avg_rate()) + '/s)'
+                + ' | ETA ' + format_eta(self.eta()))
+
+    def _draw(self, force=False, end=''):
+        if not self.console:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_draw < CONSOLE_INTERVAL:
+            return
+        self._last_draw = now
+
+        if get_console_stream() is None:
+            return
+        line = self.line()
+        with self._lock:
+            # Pad, to clear a longer previous line
+            padding = ' ' * max(0, self._line_len - len(line))
+            self._line_len = 0 if end else len(line)
+            # Written by the logging thread, in order with the log lines
+            write_console('\r' + line + padding + end)
+
+
+def lane_tracker(lane, name, action, total_bytes=None, total_cells=None, n_sheets=None,
+                 unit='Sheet'):
+    '''
+    Return a Tracker for a transfer running on lane,
+    which draws a progress bar only if the lane prints its own progress
+    '''
+    return Tracker(
+            name, action,
+            total_bytes=total_bytes,
+            total_cells=total_cells,
+            n_sheets=n_sheets,
+            console=lane.progress if lane else True,
+            report=lane.report if lane else None,
+            unit=unit)
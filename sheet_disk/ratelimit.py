@@ -0,0 +1,233 @@
+'''Token bucket rate limiting, to keep requests just under
+the Sheets and Drive API quotas, and to cap the bandwidth used.
+
+Limiters are process wide: one per Google Cloud project,
+and one per service account, and one bandwidth limiter
+shared by every worker thread.'''
+
+import threading, time, itertools, heapq
+from urllib.parse import urlsplit
+from .my_logging import get_logger
+
+logger = get_logger()
+
+# Requests per minute, the default quotas given by Google
+PROJECT_QUOTA = {'read': 300, 'write': 300, 'drive': 12000}
+ACCOUNT_QUOTA = {'read': 60, 'write': 60, 'drive': 12000}
+
+# Fraction of the quota that is used
+# Burst + one minute of refill stays under this fraction
+QUOTA_USE = 0.95
+# Fraction of QUOTA_USE which can be sent in a burst
+BURST_FRACTION = 0.05
+
+# Kinds of request
+KINDS = ('read', 'write', 'drive')
+
+# Seconds of bandwidth which can be used at once, after being idle
+BANDWIDTH_BURST = 1.0
+
+
+class TokenBucket:
+    '''
+    rate = Tokens added per second
+    capacity = Max tokens the bucket holds, ie. the largest burst
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, quota):
+        '''Bucket which sends at most QUOTA_USE * quota requests in any minute'''
+        usable = quota * QUOTA_USE
+        capacity = max(1.0, usable * BURST_FRACTION)
+        rate = (usable - capacity) / 60
+        return cls(max(rate, quota / 600), capacity)
+
+    def _refill(self):
+        # Called with self._lock held
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, n=1):
+        '''Take n tokens if they are available now, returns True if they were taken'''
+        with self._lock:
+            self._refill()
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def acquire(self, n=1):
+        '''Take n tokens, sleeping until they are available'''
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                wait = (n - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    '''
+    One TokenBucket for each kind of request
+
+    quota = Dict of kind -> requests per minute, a missing kind isn't limited
+    name = Used in log messages
+    '''
+
+    def __init__(self, quota, name=''):
+        self.name = name
+        self.buckets = {kind: TokenBucket.per_minute(per_minute)
+                        for kind, per_minute in quota.items() if per_minute}
+
+    def acquire(self, kind):
+        bucket = self.buckets.get(kind)
+        if bucket is not None:
+            bucket.acquire()
+
+
+class BandwidthLimiter:
+    '''
+    Caps the bytes per second of range requests across every worker thread.
+
+    A request larger than the bucket still goes through, leaving it in debt,
+    and later requests wait until the debt is paid off. So the average rate
+    holds whatever the size of each request.
+
+    When requests are waiting, the one with the lowest rank goes first,
+    then the one which has waited longest.
+
+    rate = Bytes per second
+    burst = Seconds of bandwidth which can be used at once, after being idle
+    '''
+
+    def __init__(self, rate, burst=BANDWIDTH_BURST):
+        self.rate = rate
+        self.capacity = rate * burst
+
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._cond = threading.Condition()
+
+        # Heap of (rank, seq) of the waiting requests
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def _refill(self):
+        # Called with self._cond held
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, n_bytes, rank=0):
+        '''
+        Take n_bytes, sleeping until no request of a lower rank is waiting
+        and the bucket isn't in debt. Returns the seconds waited
+        '''
+        start = time.monotonic()
+        with self._cond:
+            entry = (rank, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    self._refill()
+                    first = self._waiting[0] == entry
+                    if first and self._tokens >= 0:
+                        break
+                    # Only the first waiter sleeps on the debt, the rest
+                    # wait for their turn
+                    self._cond.wait((-self._tokens / self.rate) if first else None)
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            self._tokens -= n_bytes
+            self._cond.notify_all()
+        return time.monotonic() - start
+
+    def credit(self, n_bytes):
+        '''Give back n_bytes taken by acquire(), eg. when a response was smaller than expected'''
+        with self._cond:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + n_bytes)
+            self._cond.notify_all()
+
+
+# Process wide bandwidth limiter, None if bandwidth isn't capped
+_bandwidth = None
+
+def set_bandwidth_limit(rate):
+    '''Cap range requests to rate bytes per second from now on, None to not cap them'''
+    global _bandwidth
+    _bandwidth = BandwidthLimiter(rate) if rate else None
+    if rate:
+        logger.debug('Bandwidth capped to ' + str(rate) + ' bytes/s')
+
+def get_bandwidth_limiter():
+    return _bandwidth
+
+
+# (scope, name) -> RateLimiter
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(scope, name):
+    '''
+    Return the process wide limiter for a project or account
+
+    scope = 'project' or 'account'
+    name = Project id, or service account email
+    '''
+    with _limiters_lock:
+        limiter = _limiters.get((scope, name))
+        if limiter is None:
+            quota = PROJECT_QUOTA if scope == 'project' else ACCOUNT_QUOTA
+            limiter = _limiters[(scope, name)] = RateLimiter(quota, scope + ' ' + name)
+            logger.debug('Created rate limiter for ' + limiter.name)
+        return limiter
+
+def configure_quota(project=None, account=None):
+    '''
+    Change the requests per minute of limiters created from now on.
+
+    project = Dict of kind -> quota for each project, eg. {'read': 300}
+    account = Dict of kind -> quota for each service account
+    '''
+    for quota, new in ((PROJECT_QUOTA, project), (ACCOUNT_QUOTA, account)):
+        for kind, per_minute in (new or {}).items():
+            if kind not in KINDS:
+                raise ValueError('Invalid request kind: ' + str(kind))
+            quota[kind] = per_minute
+
+def parse_quota(pairs):
+    '''Parse ['read=300', 'write=100'] into {'read': 300, 'write': 100}'''
+    quota = {}
+    for pair in pairs or ():
+        kind, _, value = pair.partition('=')
+        if kind not in KINDS or not value.isdigit():
+            raise ValueError('Quota must be KIND=N with KIND in '
+                             + ', '.join(KINDS) + ', not ' + pair)
+        quota[kind] = int(value)
+    return quota
+
+def classify(method, url):
+    '''Return the kind of an API request, None for requests which aren't limited'''
+    parts = urlsplit(url)
+    if parts.netloc == 'sheets.googleapis.com':
+        return 'read' if method.upper() == 'GET' else 'write'
+    if parts.path.startswith('/drive/'):
+        return 'drive'
+    return None
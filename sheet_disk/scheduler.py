@@ -0,0 +1,243 @@
+'''Scheduling of cell-range work shared by every transfer
+running in this process'''
+
+import threading, contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from .my_logging import get_logger
+
+logger = get_logger()
+
+# Default no. of files transferred at the same time by a batch
+MAX_FILES = 4
+
+# Priority classes of transfers, highest first
+PRIORITIES = ('interactive', 'normal', 'bulk')
+
+def priority_rank(priority):
+    '''Return the rank of a priority class, 0 is the highest'''
+    if priority not in PRIORITIES:
+        raise ValueError('Priority must be one of ' + ', '.join(PRIORITIES)
+                         + ', not ' + str(priority))
+    return PRIORITIES.index(priority)
+
+
+class Lane:
+    '''
+    Handle through which one transfer submits work to a WorkPool.
+
+    pool = The WorkPool which runs the submitted work
+    name = Name of the transfer, used in log messages
+    progress = Whether the transfer should print its own progress bar
+    report = Optional callable, called as
+            report(sheet_progress, completed_cells, total_cells)
+            whenever the transfer makes progress
+    priority = One of PRIORITIES. Work of higher priority lanes is run first,
+            and gets bandwidth first when it is capped
+    '''
+    __slots__ = 'pool', 'name', 'progress', 'report', 'cancelled', 'priority', 'rank'
+
+    def __init__(self, pool, name, progress=True, report=None, priority='normal'):
+        self.pool = pool
+        self.name = name
+        self.progress = progress
+        self.report = report
+        self.cancelled = False
+        self.priority = priority
+        self.rank = priority_rank(priority)
+
+    def submit(self, fn, *args):
+        '''Queue fn(*args) on the pool, returns a Future'''
+        return self.pool._submit(self, fn, args)
+
+
+class WorkPool:
+    '''
+    Fixed set of worker threads, which is the global concurrency budget
+    for all the transfers sharing it.
+
+    Work is queued per lane, and workers take one item from each lane
+    in turn, so a small file never waits behind every range of a huge one.
+    Lanes of a higher priority class are served before any lower one.
+
+    close() lets the workers exit once the queued work is done. It is called
+    at the end of a with block, which cancels the queued work if it raised.
+
+    n_workers = The number of worker threads
+    hedge = Optional HedgePolicy, used by downloads to hedge slow range reads
+    '''
+
+    def __init__(self, n_workers, hedge=None):
+        self.n_workers = n_workers
+        self.hedge = hedge
+
+        # lane -> deque of pending (future, fn, args, context)
+        self._pending = {}
+        # Lanes which have pending work, in round robin order,
+        # one deque for each priority class
+        self._ready = [deque() for _ in PRIORITIES]
+
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_trace):
+        self.close(cancel=exc_type is not None)
+
+    def close(self, wait=True, cancel=False):
+        '''
+        Stop taking work, and let the workers exit once the queued work is done.
+
+        wait = Block until the workers have exited
+        cancel = Cancel the queued work instead of running it
+        '''
+        queued = []
+        with self._cond:
+            self._closed = True
+            if cancel:
+                for queue in self._pending.values():
+                    queued.extend(queue)
+                self._pending.clear()
+                for ready in self._ready:
+                    ready.clear()
+            self._cond.notify_all()
+
+        for future, _, _, _ in queued:
+            future.cancel()
+
+        if wait:
+            current = threading.current_thread()
+            for t in self._threads:
+                # A worker can't wait for itself
+                if t is not current:
+                    t.join()
+
+    def lane(self, name, progress=True, report=None, priority='normal'):
+        return Lane(self, name, progress, report, priority)
+
+    def cancel(self, lane):
+        '''
+        Cancel the queued work of lane, and any work submitted to it later.
+        Work which has already started runs to completion.
+        '''
+        with self._cond:
+            lane.cancelled = True
+            queue = self._pending.pop(lane, ())
+            if queue:
+                self._ready[lane.rank].remove(lane)
+
+        for future, _, _, _ in queue:
+            future.cancel()
+        logger.debug('Cancelled ' + str(len(queue)) + ' items of ' + lane.name)
+
+    def _submit(self, lane, fn, args):
+        future = Future()
+        if lane.cancelled:
+            future.cancel()
+            return future
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Can\'t submit work to a closed WorkPool')
+
+            queue = self._pending.get(lane)
+            if queue is None:
+                queue = self._pending[lane] = deque()
+                self._ready[lane.rank].append(lane)
+            # Run in the context of the submitter, eg. to log with its file
+            queue.append((future, fn, args, contextvars.copy_context()))
+
+            if len(self._threads) < self.n_workers:
+                # Start workers lazily, one per queued item
+                t = threading.Thread(
+                        target=self._worker,
+                        name='Worker ' + str(len(self._threads)))
+                t.daemon = True
+                self._threads.append(t)
+                t.start()
+                logger.debug('Started ' + t.name)
+
+            self._cond.notify()
+        return future
+
+    def _next_item(self):
+        # Called with self._cond held, returns None once the pool is closed
+        # and no work is left
+        while not any(self._ready):
+            if self._closed:
+                return None
+            self._cond.wait()
+
+        # Highest priority class with pending work
+        ready = next(ready for ready in self._ready if ready)
+        lane = ready.popleft()
+        queue = self._pending[lane]
+        item = queue.popleft()
+
+        if queue:
+            # Send lane to the back of the line
+            ready.append(lane)
+        else:
+            del self._pending[lane]
+        return item
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                item = self._next_item()
+            if item is None:
+                return
+
+            future, fn, args, context = item
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = context.run(fn, *args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+# Pool used when a transfer isn't given one
+_default_pool = None
+_default_lock = threading.Lock()
+
+def get_default_pool(n_workers):
+    global _default_pool
+    with _default_lock:
+        if _default_pool is None:
+            _default_pool = WorkPool(n_workers)
+    return _default_pool
+
+
+def run_batch(jobs, max_files=MAX_FILES):
+    '''
+    Run every job, with at most max_files of them in flight at once.
+    Returns a list of (job, exception) for the jobs that failed.
+
+    jobs = List of (label, fn, args) tuples, fn(*args) transfers one file
+    max_files = The number of files transferred at the same time
+    '''
+
+    failed = []
+
+    def run(job):
+        label, fn, args = job
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(label + ' failed: ' + repr(e))
+            failed.append((job, e))
+        else:
+            logger.info(label + ' done')
+
+    with ThreadPoolExecutor(max_workers=max_files) as executor:
+        # list() so that every job has run before we return
+        list(executor.map(run, jobs))
+
+    return failed
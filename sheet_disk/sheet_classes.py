@@ -2,32 +2,77 @@
 to and from Google Sheets'''
 
 import os, sys, json
-from functools import partial
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed, CancelledError
 import base64
-from .my_logging import get_logger, MyConsoleHandler
+from .my_logging import get_logger, log_context, with_log_context
 from .__version__ import __version__
+from .client import as_client_pool
+from .manifest import (
+        Manifest, EXTENSIONS, cells_for, transfer_size, stored_size, sheets_needed,
+        upload_header)
+from .progress import lane_tracker
+from .metrics import timed, phase
+from .sparse import SparseReader, wrap_output, finish_output
+from . import erasure
 from .utils import (
         sheet_upload,
         sheet_download,
+        b64_bytes,
         CELL_CHAR_LIMIT,
         CELLS_PER_SHEET,
         CHAR_PER_SHEET,
+        BYTES_PER_SHEET,
+        N_THREADS,
         )
+from .scheduler import get_default_pool
 
 logger = get_logger()
 
 class SheetUpload:
-    def __init__(self, name, client, upload_file_path, json_file=None):
+    def __init__(self, name, client, upload_file_path, json_file=None, lane=None,
+                 json_dir=None, stripe=None, manifest_version=1, save_manifest=True,
+                 sparse=False):
 
         logger.debug('Start SheetUpload init')
         # Get client credentials for managing sheets
-        self.gc = client
+        # A ClientPool spreads the sheets over several accounts
+        self.clients = as_client_pool(client)
+
+        # Scheduler lane which runs the range requests
+        # None uses the default pool
+        self.lane = lane
 
         # Set file name
         self.name = name
 
         # Store file path, to retrieve data from when upload starts
+        # '-' reads from stdin, and a readable binary file object is read as is,
+        # the size of both isn't known until the end
         self.upload_file_path = upload_file_path
+        self.streaming = upload_file_path == '-' or hasattr(upload_file_path, 'read')
+
+        # Directory to save the JSON file in, None for current directory
+        self.json_dir = json_dir
+
+        # (k, m) to stripe the file over groups of k data sheets
+        # and m parity sheets, None to store it as is
+        self.stripe = stripe
+
+        # Format of the manifest file saved after the upload,
+        # 1 for JSON, 2 for the compact indexed format
+        self.manifest_version = manifest_version
+
+        # False only sets self.manifest, without writing a file
+        self.save_manifest = save_manifest
+
+        # Leave holes and runs of zeros out of the sheets,
+        # recording them in the manifest as zero_extents
+        self.sparse = sparse
+        self.zero_extents = []
+
+        # Size of the file being uploaded
+        self.file_size = None
 
         # List which stores keys of sheets
         self.key_list = None
@@ -37,41 +82,75 @@ class SheetUpload:
 
         # Latest key for sheet(which may get quit)
         self.last_key = None
+        self.last_account = None
+
+        # List which stores the account owning each key
+        self.account_list = None
 
         # Total cell count
         # Do not init from file,
         # since it will be incomplete
         self.cell_count = 0
 
+        # Manifest of the upload, set on exit
+        self.manifest = None
+
         # Dict that will hold the json file's attributes
         self.j_details = None
+        if json_file and self.streaming:
+            msg = 'An upload from a stream can\'t be resumed'
+            logger.error(msg)
+            raise ValueError(msg)
+
         if json_file:
             # Resumable upload section
             logger.info('Resume uploading of file...')
-            with open(json_file) as f:
-                self.j_details = json.load(f)
+            self.j_details = Manifest.load(json_file).to_dict()
 
             # Read key_list from j_details
             # Get the keys which were previously uploaded
             self.key_list = self.j_details['key_list']
 
+            # Files uploaded with a single account don't have account_list
+            self.account_list = self.j_details.get('account_list') or \
+                [self.clients.default_account] * len(self.key_list)
+
             # Get n_sheets from j_details
             self.n_sheets = self.j_details['n_sheets']
 
+            # Resume with the same layout
+            if 'stripe' in self.j_details:
+                self.stripe = (self.j_details['stripe']['k'], self.j_details['stripe']['m'])
+            else:
+                self.stripe = None
+            self.sparse = 'zero_extents' in self.j_details
+
         else:
             logger.info('Uploading a new file...')
 
             # Init list to empty for fresh upload
             self.key_list = []
+            self.account_list = []
+
+            if self.stripe:
+                erasure.check_params(*self.stripe)
+
+        if self.streaming:
+            # Counted while reading, n_sheets is set at the end of the input
+            self.file_size = 0
+        else:
+            self.file_size = os.stat(self.upload_file_path).st_size
+
+        if not json_file and not self.streaming and not self.sparse:
+            # Only calculate the no of sheets if it's a fresh upload,
+            # the zeros of a sparse upload are only known after reading it
+            self.n_sheets = sheets_needed(self.file_size, self.stripe)
 
-            # Only calculate the no of sheets if it's a fresh upload
-            input_size = os.stat(self.upload_file_path).st_size
-            from math import ceil
-            b64_size = 4 * ceil(input_size / 3)
-            self.n_sheets = ceil(b64_size / CHAR_PER_SHEET)
-        
         logger.debug('Key list size : ' + str(len(self.key_list)))
-        logger.info('Total sheets needed: ' + str(self.n_sheets))
+        if self.n_sheets is None:
+            logger.info('Total sheets needed: known at the end of the input')
+        else:
+            logger.info('Total sheets needed: ' + str(self.n_sheets))
 
 
         logger.debug('SheetUpload Init complete')
@@ -81,17 +160,9 @@ class SheetUpload:
 
     def __exit__(self, exc_type, exc_value, exc_trace):
 
-        MyConsoleHandler.restore_terminator()
-        # Reset terminator before exiting
-
         logger.info('')
         # Create space after uploading has finished
 
-        if not self.key_list:
-            # if key_list is empty then don't bother saving JSON
-            logger.debug('Key list is empty, so not saving JSON')
-            return
-
         if exc_type:
             # exception has occured, which means file may not have completely uploaded
             logger.info(str(exc_type) + ' Exception has occured.'
@@ -100,64 +171,162 @@ class SheetUpload:
         if exc_type and self.last_key:
             # if exception occurs, delete the last spreadsheet
             logger.debug('Deleting latest key, since exception has occured')
-            self.gc.del_spreadsheet(self.last_key)
+            try:
+                with timed('del_spreadsheet'):
+                    self.clients.get(self.last_account).del_spreadsheet(self.last_key)
+            except Exception as e:
+                # Still save the JSON file, gc can delete the sheet later
+                logger.error('Could not delete unfinished sheet ' + self.last_key
+                             + ': ' + repr(e))
+
+        if not self.key_list and self.save_manifest:
+            # if key_list is empty then don't bother saving JSON
+            logger.debug('Key list is empty, so not saving JSON')
+            return
 
         complete_upload = False
         if self.n_sheets == len(self.key_list):
             # File was completely uploaded
             complete_upload = True
 
-        import json
         json_obj = \
             {
                 'name' : self.name,
                 'complete_upload': complete_upload,
                 'n_sheets': self.n_sheets,
                 'version': __version__,
+                # Needed to find the bytes stored in each sheet
+                'file_size': self.file_size,
+                'account_list': self.account_list,
                 'key_list': self.key_list,
             }
 
         # include cell count only if file is complete
         if complete_upload:
             json_obj['cell_count'] = self.cell_count
-        
-        json_filename = self.name + '.json'
+
+        if self.sparse:
+            json_obj['zero_extents'] = self.zero_extents
+            json_obj['stored_size'] = self.file_size - sum(
+                    length for _, length in self.zero_extents)
+
+        if self.stripe:
+            json_obj['stripe'] = {
+                    'k': self.stripe[0],
+                    'm': self.stripe[1],
+                    'shard_size': BYTES_PER_SHEET,
+                    }
+
+        self.manifest = Manifest.from_dict(json_obj)
+        if not self.save_manifest:
+            return
+
+        extension = EXTENSIONS[self.manifest_version]
+        json_filename = os.path.join(self.json_dir or '', self.name + extension)
         if os.path.exists(json_filename):
             logger.debug('JSON file already exists, creating new with timestamp')
-            json_filename = json_filename.replace('.json', ' ' + right_now() + '.json')
-
-        # Store key_list in separate object
-        key_list = json_obj['key_list']
-        # Remove key_list from json_obj
-        del json_obj['key_list']
-        # Insert it at the end
-        json_obj['key_list'] = key_list
-        # Key list has been moved to the end of the json,
-        # so as to show other details before the key_list
-        # Key_list can be very long for large files, and user
-        # will need to scroll down a lot of lines,
-        # just to see the version, and other attributes.
-
-        with open(json_filename, 'w') as f:
-            logger.info('Creating JSON file!')
-            json.dump(json_obj, f, indent=4)
+            json_filename = os.path.join(self.json_dir or '',
+                                         self.name + ' ' + right_now() + extension)
+
+        # Manifest puts key_list at the end of a JSON file
+        logger.info('Creating ' + ('JSON' if self.manifest_version == 1 else 'manifest')
+                    + ' file!')
+        self.manifest.save(json_filename, self.manifest_version)
+
+    def _open_source(self):
+        if self.upload_file_path == '-':
+            # Don't close stdin
+            return nullcontext(sys.stdin.buffer)
+        if self.streaming:
+            # Closed by its owner
+            return nullcontext(self.upload_file_path)
+        return open(self.upload_file_path, 'rb')
+
+    def _read_chunks(self, f, chunk_size):
+        '''
+        Yield chunks of f, counting the bytes of a stream.
+        Zero regions of a sparse upload are left out, and added to self.zero_extents
+        '''
+        reader = None
+        if self.sparse:
+            reader = SparseReader(f, None if self.streaming else self.file_size)
+            self.zero_extents = reader.extents
+            chunks = reader.chunks(chunk_size)
+
+        while True:
+            with timed('read_file') as timer:
+                byte_chunk = next(chunks, b'') if reader else read_full(f, chunk_size)
+                timer.bytes = len(byte_chunk)
+            if self.streaming:
+                # Zeros are counted too
+                self.file_size = reader.position if reader else self.file_size + len(byte_chunk)
+            if not byte_chunk:
+                break
+            yield byte_chunk
 
     def gen_encoded(self):
-        with open(self.upload_file_path, 'rb') as f:
+        if self.stripe:
+            yield from self.gen_striped()
+            return
+
+        with self._open_source() as f:
             
             # Read in terms of total bytes we can fit in one sheet
             # b64 gives 4 bytes for input 3 bytes,
             # so calculate input size such that b64 is CHAR_PER_SHEET
             chunk_size =  CHAR_PER_SHEET // 4 * 3
 
-            for byte_chunk in iter(partial(f.read, chunk_size), b''):
+            for byte_chunk in self._read_chunks(f, chunk_size):
                 # Encode file bytes to base64
-                enc64 = base64.b64encode(byte_chunk)
+                with timed('b64encode', len(byte_chunk)):
+                    enc64 = base64.b64encode(byte_chunk)
 
                 # Get string from base64 bytes
                 yield enc64.decode('ascii')
 
+    def gen_striped(self):
+        '''
+        Yield the base64 content of every sheet, for each group
+        the k data shards and then the m parity shards.
+        '''
+        k, m = self.stripe
+        with self._open_source() as f:
+            for group in self._read_chunks(f, k * BYTES_PER_SHEET):
+                # Pad the last group so every shard has the same size
+                shard_len = -(-len(group) // k)
+                group = group.ljust(k * shard_len, b'\0')
+
+                data = [group[i*shard_len:(i+1)*shard_len] for i in range(k)]
+                del group
+
+                with timed('rs_encode', k * shard_len):
+                    parity = erasure.encode(data, m)
+
+                for shard in data + parity:
+                    with timed('b64encode', len(shard)):
+                        content = base64.b64encode(shard).decode('ascii')
+                    yield content
+
+    def _new_tracker(self):
+        '''Return the progress Tracker of the upload, with its size if it's known'''
+        total_bytes = total_cells = None
+        if not self.streaming and not self.sparse:
+            header = upload_header(self.file_size, self.stripe)
+            total_bytes, total_cells = transfer_size(header, self.n_sheets)
+        return lane_tracker(self.lane, self.name, 'upload',
+                            total_bytes, total_cells, self.n_sheets)
+
     def start_upload(self):
+        tracker = self._new_tracker()
+        try:
+            with phase('upload'), log_context(file=self.name):
+                self._upload_sheets(tracker)
+        except BaseException as e:
+            tracker.finish(e)
+            raise
+        tracker.finish()
+
+    def _upload_sheets(self, tracker):
         if self.j_details:
             # Get previously uploaded sheets
             prev_uploaded_sheets = len(self.j_details['key_list'])
@@ -177,22 +346,34 @@ class SheetUpload:
                 # Skipping sheet which previously exists
                 logger.info('Sheet ' + str(sheet_no) + ' already exists!')
                 logger.info('Skipping sheet ' + str(sheet_no))
+                tracker.skip(-(-len(wk_content) // CELL_CHAR_LIMIT), b64_bytes(wk_content))
                 continue
-
-            # Create a sheet for file
-            logger.debug('Creating sheet ' + str(sheet_no) + '/' + str(self.n_sheets) + '...')
-            sh = self.gc.create(self.name + ' ' + str(sheet_no) + ' ' + right_now())
+            # Create a sheet for file,
+            # with the account which has the most quota left
+            account = self.clients.pick()
+            n_sheets = self.n_sheets or '?'
+            logger.debug('Creating sheet ' + str(sheet_no) + '/' + str(n_sheets)
+                         + ' with ' + account + '...')
+            with timed('create'):
+                sh = self.clients.get(account).create(
+                        self.name + ' ' + str(sheet_no) + ' ' + right_now())
 
             # Share the file so others can also access
-            sh.share('None', 'anyone', 'reader')
+            with timed('share'):
+                sh.share('None', 'anyone', 'reader')
             self.last_key = sh.id
+            self.last_account = account
 
-            # Upload content to file
-            wks = sh.sheet1
-            logger.info('Uploading data to sheet ' + str(sheet_no) + '/' + str(self.n_sheets) + '...')
+            # Upload content to file.
+            # sheet1 fetches the metadata, the request open_by_key stands for
+            with timed('open_by_key'):
+                wks = sh.sheet1
+            logger.info('Uploading data to sheet ' + str(sheet_no) + '/' + str(n_sheets) + '...')
 
             wk_cell_count = sheet_upload(wks, wk_content, 
-                    sheet_progress=(sheet_no, self.n_sheets))
+                    sheet_progress=(sheet_no, self.n_sheets or 0),
+                    lane=self.lane,
+                    tracker=tracker)
 
             self.cell_count += wk_cell_count
 
@@ -200,11 +381,18 @@ class SheetUpload:
 
             # Store it's key after successful upload
             self.key_list.append(sh.id)
+            self.account_list.append(account)
             # Delete last_key since sheet was written successfully
             self.last_key = None
+            self.last_account = None
+
+        if self.n_sheets is None:
+            # End of the stream, or of a sparse file, was reached
+            self.n_sheets = len(self.key_list)
+            logger.debug('Upload needed ' + str(self.n_sheets) + ' sheets')
 
 class SheetDownload:
-    def __init__(self, client, download_path, json_dict):
+    def __init__(self, client, download_path, json_dict, lane=None):
 
         logger.debug('SheetDownload init start')
 
@@ -215,15 +403,35 @@ class SheetDownload:
             raise ValueError(msg)
 
 
-        self.gc = client
+        self.clients = as_client_pool(client)
+        self.lane = lane
         self.download_path = download_path
         self.key_list = json_dict['key_list']
+
+        # '-' writes the file to stdout, and a writable file object or buffer
+        # is written as is, in order and without temp files
+        self.streaming = not isinstance(download_path, str) or download_path == '-'
+
+        # Account owning each key, missing for files uploaded with one account
+        self.account_list = json_dict.get('account_list') or [None] * len(self.key_list)
         self.n_sheets = json_dict['n_sheets']
         self.cell_count = json_dict['cell_count']
 
-        self.quotient, self.remainder = divmod(self.cell_count, CELLS_PER_SHEET)
-        # Calculated here, instead of calculating inside function call
+        # Has the no of cells of each sheet
         # Use function get_cell_count(sheet_no) to find how many cells a sheet has
+        self.manifest = Manifest.from_dict(json_dict)
+
+        # Create list to hold temp files to store progress
+        self.sheet_files = []
+
+        # Boolean to signify if decoding is complete
+        # We use this to delete progress file
+        self.decoding_complete = False
+
+        if self.streaming:
+            logger.info('Total sheets needed: ' + str(self.n_sheets))
+            logger.debug('SheetDownload init complete')
+            return
 
         self.sheet_progress_file = download_path + '.progress' + '.b64'
         '''
@@ -250,9 +458,8 @@ class SheetDownload:
                 f.write('0' * self.n_sheets)
 
 
-        # Create list to hold temp files to store progress
-        self.sheet_files = []
         '''
+        self.sheet_files
         This list will contains paths of the files which are used to download
         sheets into,
         and status of the sheet, denoting whether sheet has been downloaded or not
@@ -269,10 +476,6 @@ class SheetDownload:
                 done = bool(int(f.read(1)))
 
                 self.sheet_files.append( (filename, done) )
-        
-        # Boolean to signify if decoding is complete
-        # We use this to delete progress file
-        self.decoding_complete = False
 
         logger.info('Total sheets needed: ' + str(self.n_sheets))
         logger.debug('SheetDownload init complete')
@@ -281,37 +484,30 @@ class SheetDownload:
         '''
         Return the no of cells in the given sheet_no (1-indexed)
 
-        Example:
-        >>> divmod(2423, 1000)
-        >>> (2, 423)
-        so for sheets 1 to 2, we should return 1000
-        but for sheet 3, we need to return 423
+        Every sheet is full, except the last one
         '''
-        if sheet_no <= 0 or sheet_no > self.quotient+1:
-            msg = 'Sheet no can only be between 1 and n_sheets=' + self.n_sheets
+        if sheet_no <= 0 or sheet_no > self.n_sheets:
+            msg = 'Sheet no can only be between 1 and n_sheets=' + str(self.n_sheets)
             logger.error(msg)
             raise ValueError(msg)
 
-        if sheet_no <= self.quotient:
-            return CELLS_PER_SHEET
-        if sheet_no == self.quotient + 1:
-            return self.remainder
-        
+        return self.manifest.sheet(sheet_no - 1).cells
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_trace):
 
-        MyConsoleHandler.restore_terminator()
-        # Reset terminator before exiting
-
         logger.info('')
         # Create space
 
-        with open(self.sheet_progress_file, 'r') as f:
-            # Get sheet file statuses from progress file
-            filestatus = [bool(int(i)) for i in f.read()]
+        if self.streaming:
+            # Nothing to clean up
+            filestatus = [True]
+        else:
+            with open(self.sheet_progress_file, 'r') as f:
+                # Get sheet file statuses from progress file
+                filestatus = [bool(int(i)) for i in f.read()]
 
         if not any(filestatus):
             # if any of the status is not true,
@@ -331,7 +527,7 @@ class SheetDownload:
                         logger.debug('Deleting sheet file' + str(fi))
                         os.remove(file)
 
-        elif all(filestatus):
+        elif all(filestatus) and not self.streaming:
             # If all files are downloaded
             # Check if all have been decoded
             if self.decoding_complete:
@@ -356,9 +552,77 @@ class SheetDownload:
             logger.info(str(exc_type) + ' Exception has occured.'
                         ' File may not have been downloaded completely.\n\n')
 
-    def start_download(self):
+    def _fetch_sheet(self, sheet_no, tracker):
+        '''Return the base64 content of sheet_no (1-indexed)'''
+        # open_by_key makes no request, sheet1 fetches the metadata
+        with timed('open_by_key'):
+            sh = self.clients.get(self.account_list[sheet_no - 1]).open_by_key(
+                    self.key_list[sheet_no - 1])
+            wks = sh.sheet1
+
+        logger.info('Downloading sheet ' + str(sheet_no) + '/' + str(self.n_sheets) + '...')
+        return ''.join(sheet_download(
+                wks,
+                sheet_progress=(sheet_no, self.n_sheets),
+                cell_count=self.get_cell_count(sheet_no),
+                lane=self.lane,
+                tracker=tracker))
+
+    def _stream_download(self, out, tracker):
+        '''
+        Write the decoded sheets to out in order, with the next
+        sheet being downloaded while the current one is written
+        '''
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            pending = [executor.submit(with_log_context(self._fetch_sheet), sheet_no, tracker)
+                       for sheet_no in range(1, min(2, self.n_sheets) + 1)]
+
+            for sheet_no in range(1, self.n_sheets + 1):
+                content = pending.pop(0).result()
+                if sheet_no + 2 <= self.n_sheets:
+                    pending.append(executor.submit(
+                            with_log_context(self._fetch_sheet), sheet_no + 2, tracker))
+
+                # Every sheet but the last holds a multiple of 3 bytes,
+                # so each can be decoded on its own
+                with timed('b64decode', len(content)):
+                    data = base64.b64decode(content)
+                with timed('write_file', len(data)):
+                    out.write(data)
+                    out.flush()
+                del data
+                del content
+                logger.debug('Sheet ' + str(sheet_no) + ' written')
+
+        self.decoding_complete = True
 
-        for sheet_no, key in enumerate(self.key_list, 1):
+    def start_download(self):
+        total_bytes, total_cells = transfer_size(self.manifest.header, self.n_sheets)
+        tracker = lane_tracker(self.lane, self.manifest.name, 'download',
+                               total_bytes, total_cells, self.n_sheets)
+        try:
+            if self.streaming:
+                with phase('download'), log_context(file=self.manifest.name), \
+                        open_output(self.download_path) as out:
+                    # Streams can't seek, zero regions are written out
+                    out = wrap_output(out, self.manifest.header)
+                    self._stream_download(out, tracker)
+                    finish_output(out)
+            else:
+                with phase('download'), log_context(file=self.manifest.name):
+                    self._download_sheets(tracker)
+
+                logger.debug('Now, starting decoding!')
+                with phase('decode'):
+                    self._decode_file()
+        except BaseException as e:
+            tracker.finish(e)
+            raise
+        tracker.finish()
+
+    def _download_sheets(self, tracker):
+
+        for sheet_no, (key, account) in enumerate(zip(self.key_list, self.account_list), 1):
             # Start sheet_no at 1
             # so output is 
             # 1/5 and not 0/5
@@ -373,18 +637,24 @@ class SheetDownload:
             if status:
                 logger.info('Sheet ' + str(sheet_no) + ' has already been downloaded!')
                 logger.info('Skipping sheet ' + str(sheet_no) + '/' + str(self.n_sheets))
+                record = self.manifest.sheet(sheet_no - 1)
+                tracker.skip(record.cells, record.length or 0)
                 continue
 
             logger.debug('Open sheet ' + str(sheet_no))
-            sh = self.gc.open_by_key(key)
-            wks = sh.sheet1
+            # open_by_key makes no request, sheet1 fetches the metadata
+            with timed('open_by_key'):
+                sh = self.clients.get(account).open_by_key(key)
+                wks = sh.sheet1
 
             logger.info('Downloading sheet ' + str(sheet_no) + '/' + str(self.n_sheets) + '...')
             sheet_content = \
                 sheet_download(
                     wks,
                     sheet_progress=(sheet_no, self.n_sheets),
-                    cell_count=self.get_cell_count(sheet_no)
+                    cell_count=self.get_cell_count(sheet_no),
+                    lane=self.lane,
+                    tracker=tracker
                     )
 
             # write the data into appropriate sheet file
@@ -392,7 +662,8 @@ class SheetDownload:
 
                 _first = False # Check if first iteration of loop
                 for one_cell in sheet_content:
-                    file_current.write(one_cell)
+                    with timed('write_file', len(one_cell)):
+                        file_current.write(one_cell)
                     if not _first:
                         # Display this message only after download has started
                         logger.debug('Writing downloaded content to sheet ' 
@@ -410,11 +681,12 @@ class SheetDownload:
 
 
         logger.debug('Encoded file(s) created!')
-        logger.debug('Now, starting decoding!')
-        self._decode_file()
 
     def _decode_file(self):
-        with open(self.download_path, 'wb') as down:
+        with open(self.download_path, 'wb') as f:
+            # Zero regions are left as holes
+            down = wrap_output(f, self.manifest.header, seek=True)
+
             # Read from encoded sheet file(s),
             # Convert to literal bytes and then to base64
             # And write to download_path
@@ -433,9 +705,13 @@ class SheetDownload:
                 bytes_b64 = bytes(chunk, 'ascii')
 
                 # Decode b64 back to original encoding
-                decoded_bytes = base64.b64decode(bytes_b64)
-                
-                down.write(decoded_bytes)
+                with timed('b64decode', len(bytes_b64)):
+                    decoded_bytes = base64.b64decode(bytes_b64)
+
+                with timed('write_file', len(decoded_bytes)):
+                    down.write(decoded_bytes)
+
+            finish_output(down)
 
         logger.debug('File has been decoded!')
         self.decoding_complete = True
@@ -483,7 +759,237 @@ class SheetDownload:
 
             yield data
 
-        
+
+class StripedDownload:
+    '''
+    Download a file striped over groups of k data sheets and m parity sheets.
+
+    All sheets of a group are read at once, and the group is rebuilt
+    as soon as any k of them have arrived. Reads of the other sheets
+    are cancelled, so slow or missing sheets don't hold up the download.
+    '''
+
+    def __init__(self, client, download_path, json_dict, lane=None):
+
+        logger.debug('StripedDownload init start')
+
+        if not json_dict['complete_upload']:
+            # Stop download if file isn't originally uploaded completely
+            msg = 'File encoded in JSON file wasn\'t uploaded completely!'
+            logger.error(msg)
+            raise ValueError(msg)
+
+        self.clients = as_client_pool(client)
+        self.lane = lane
+        self.download_path = download_path
+        # Used to name the scheduler lanes
+        self.label = download_path if isinstance(download_path, str) else 'stream'
+        self.key_list = json_dict['key_list']
+        self.account_list = json_dict.get('account_list') or [None] * len(self.key_list)
+
+        stripe = json_dict['stripe']
+        self.k = stripe['k']
+        self.m = stripe['m']
+        self.shard_size = stripe['shard_size']
+        # Shards hold the file without its zero regions, if it has any
+        self.file_size = stored_size(json_dict)
+        self.name = json_dict['name']
+        # Header of the manifest, to find the size of the transfer
+        self.header = {key: value for key, value in json_dict.items()
+                       if key not in ('key_list', 'account_list')}
+
+        self.n_groups = len(self.key_list) // (self.k + self.m)
+
+        logger.info('Total groups needed: ' + str(self.n_groups) + ' of '
+                    + str(self.k) + ' data + ' + str(self.m) + ' parity sheets')
+        logger.debug('StripedDownload init complete')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_trace):
+
+        logger.info('')
+        # Create space
+
+        if exc_type:
+            # if exception exists
+            logger.info(str(exc_type) + ' Exception has occured.'
+                        ' File may not have been downloaded completely.\n\n')
+
+    def get_shard_len(self, group_no):
+        '''Return the no of bytes in each shard of group_no (1-indexed)'''
+        remaining = self.file_size - (group_no - 1) * self.k * self.shard_size
+        return min(self.shard_size, -(-remaining // self.k))
+
+    def _fetch_shard(self, key, account, sheet_lane, sheet_no, shard_len):
+        if sheet_lane.cancelled:
+            raise CancelledError()
+
+        # open_by_key makes no request, sheet1 fetches the metadata
+        with timed('open_by_key'):
+            sh = self.clients.get(account).open_by_key(key)
+            wks = sh.sheet1
+
+        content = ''.join(sheet_download(
+                wks,
+                sheet_progress=(sheet_no, len(self.key_list)),
+                cell_count=cells_for(shard_len),
+                lane=sheet_lane))
+
+        with timed('b64decode', len(content)):
+            return base64.b64decode(content)
+
+    def start_download(self):
+        # Only the k shards a group is rebuilt from count as progress
+        total_bytes, total_cells = transfer_size(
+                self.header, len(self.key_list), data_only=True)
+        tracker = lane_tracker(self.lane, self.name, 'download',
+                               total_bytes, total_cells, self.n_groups, unit='Group')
+        try:
+            with phase('download'), log_context(file=self.name):
+                self._download_groups(tracker)
+        except BaseException as e:
+            tracker.finish(e)
+            raise
+        tracker.finish()
+
+    def _download_groups(self, tracker):
+        pool = self.lane.pool if self.lane else get_default_pool(N_THREADS)
+        width = self.k + self.m
+        remaining = self.file_size
+
+        with ThreadPoolExecutor(max_workers=width) as executor, \
+                open_output(self.download_path) as f:
+            # Only files opened here can seek over zero regions, leaving holes
+            seek = isinstance(self.download_path, str) and self.download_path != '-'
+            down = wrap_output(f, self.header, seek)
+
+            for group_no in range(1, self.n_groups + 1):
+                logger.info('')
+                logger.info('Downloading group ' + str(group_no) + '/' + str(self.n_groups) + '...')
+
+                first = (group_no - 1) * width
+                shard_len = self.get_shard_len(group_no)
+                shard_cells = cells_for(shard_len)
+                tracker.start_sheet(group_no, self.n_groups, self.k * shard_cells)
+
+                # One lane per sheet, so they all make progress
+                # and the fastest k finish first
+                lanes = []
+                futures = {}
+                for index in range(width):
+                    sheet_no = first + index + 1
+                    sheet_lane = pool.lane(self.label + ' sheet ' + str(sheet_no),
+                                           progress=False,
+                                           priority=self.lane.priority if self.lane else 'normal')
+                    lanes.append(sheet_lane)
+
+                    future = executor.submit(
+                            with_log_context(self._fetch_shard),
+                            self.key_list[first + index],
+                            self.account_list[first + index],
+                            sheet_lane, sheet_no, shard_len)
+                    futures[future] = index
+
+                shards = {}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        shards[index] = future.result()
+                    except Exception as e:
+                        logger.info('Sheet ' + str(first + index + 1) + ' failed: ' + repr(e))
+                        continue
+
+                    logger.debug('Got shard ' + str(index) + ' of group ' + str(group_no))
+                    tracker.add(shard_cells, shard_len)
+                    if len(shards) == self.k:
+                        break
+
+                # Stop reading the sheets which aren't needed
+                for sheet_lane in lanes:
+                    pool.cancel(sheet_lane)
+
+                if len(shards) < self.k:
+                    msg = 'Only ' + str(len(shards)) + ' of ' + str(width) + ' sheets of group ' \
+                          + str(group_no) + ' could be read, need ' + str(self.k)
+                    logger.error(msg)
+                    raise RuntimeError(msg)
+                tracker.end_sheet()
+
+                with timed('rs_decode', self.k * shard_len):
+                    data = erasure.decode(shards, self.k, self.m)
+                del shards
+
+                with timed('write_file', min(remaining, self.k * shard_len)):
+                    for shard in data:
+                        # The last shards are padded
+                        down.write(shard[:remaining])
+                        remaining -= min(remaining, len(shard))
+                    down.flush()
+
+                logger.info('Group ' + str(group_no) + ' rebuilt!')
+
+            finish_output(down)
+
+        logger.debug('File has been rebuilt!')
+
+
+class BufferWriter:
+    '''File like writer which fills a writable buffer, eg. a bytearray or memoryview'''
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        if self.view.readonly:
+            raise TypeError('Buffer is read only')
+        self.position = 0
+
+    def write(self, data):
+        end = self.position + len(data)
+        if end > len(self.view):
+            raise ValueError('Buffer is too small for the file, it has '
+                             + str(len(self.view)) + ' bytes')
+        self.view[self.position:end] = data
+        self.position = end
+        return len(data)
+
+    def flush(self):
+        pass
+
+def read_full(f, size):
+    '''
+    Read size bytes from f, fewer only at the end of the file.
+    One read of a raw stream, pipe or socket can return less than asked for
+    '''
+    chunk = f.read(size)
+    if not chunk or len(chunk) == size:
+        return chunk or b''
+
+    parts = [chunk]
+    remaining = size - len(chunk)
+    while remaining:
+        part = f.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+def open_output(path):
+    '''
+    Open path for writing the downloaded file. '-' gives stdout,
+    and a file object or writable buffer is used as is.
+    '''
+    if path == '-':
+        # Don't close stdout
+        return nullcontext(sys.stdout.buffer)
+    if hasattr(path, 'write'):
+        # Closed by its owner
+        return nullcontext(path)
+    if not isinstance(path, str):
+        return nullcontext(BufferWriter(path))
+    return open(path, 'wb')
+
 def right_now():
     '''Return Y:M:D H:M:S'''
     import datetime
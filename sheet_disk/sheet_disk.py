@@ -1,30 +1,23 @@
 '''Main file to run when running this program'''
 
 import os
-import json
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from .sheet_classes import SheetUpload, SheetDownload
-from .my_logging import get_logger
+from .sheet_classes import SheetUpload, SheetDownload, StripedDownload
+from .manifest import Manifest, EXTENSIONS
+from .scheduler import WorkPool, run_batch, MAX_FILES, PRIORITIES
+from .utils import N_THREADS
+from .ratelimit import configure_quota, parse_quota, set_bandwidth_limit
+from .hedge import HedgePolicy
+from .cleanup import delete_file, gc, MIN_AGE
+from .catalog import get_catalog, get_catalog_keys, set_catalog_keys, create_catalog
+from .client import get_client_pool, set_creds_files, configure_transport
+from .progress import set_progress_fd
+from .batching import set_request_size, parse_size, log_request_sizes
+from .metrics import get_metrics, serve_metrics, set_profile_dir
+from .planner import save_run, plan_paths, log_plan
+from .my_logging import get_logger, log_to_stderr, set_trace_file
 
 logger = get_logger()
 
-scope = ['https://spreadsheets.google.com/feeds',
-         'https://www.googleapis.com/auth/drive']
-
-# Get credentials file from environment variable
-creds_file = os.environ.get('SH_DISK_CREDS', None)
-
-if creds_file is None:
-    raise KeyError(
-        '''Set up environment variable: 'SH_DISK_CREDS' 
-        with the path to your Google Sheets API JSON file.
-
-        Refer to README.md for more info.''')
-
-creds = ServiceAccountCredentials.from_json_keyfile_name(creds_file, scope)
-gc = gspread.authorize(creds)
-
 def get_parser():
     import argparse
     parser = argparse.ArgumentParser()
@@ -35,45 +28,355 @@ def get_parser():
         metavar='action')
     subparsers.required = True
 
+    # Options shared by commands which use the catalog
+    catalog_parser = argparse.ArgumentParser(add_help=False)
+    catalog_parser.add_argument(
+        '--catalog',
+        help='Key of a catalog spreadsheet, can be given many times '
+             '(default: keys in $SH_DISK_CATALOG). Uploads are added to the first',
+        action='append')
+
+    # Options shared by commands which transfer files
+    transfer_parser = argparse.ArgumentParser(add_help=False, parents=[catalog_parser])
+    transfer_parser.add_argument(
+        '--concurrency',
+        help='Max no of range requests in flight, across all files '
+             '(default: %(default)s)',
+        type=int,
+        default=N_THREADS)
+    transfer_parser.add_argument(
+        '--max-files',
+        help='Max no of files transferred at the same time '
+             '(default: %(default)s)',
+        type=int,
+        default=MAX_FILES)
+    transfer_parser.add_argument(
+        '--creds',
+        help='Service account credentials file, can be given many times '
+             'to spread sheets over several accounts (default: $SH_DISK_CREDS)',
+        action='append')
+    transfer_parser.add_argument(
+        '--quota',
+        help='Requests per minute allowed for each service account, '
+             'KIND is read, write or drive, can be given many times '
+             '(default: read=60 write=60 drive=12000)',
+        metavar='KIND=N',
+        action='append')
+    transfer_parser.add_argument(
+        '--project-quota',
+        help='Requests per minute allowed for each Google Cloud project '
+             '(default: read=300 write=300 drive=12000)',
+        metavar='KIND=N',
+        action='append')
+    transfer_parser.add_argument(
+        '--hedge',
+        help='When downloading, send a duplicate read for ranges slower than '
+             'this percentile of recent reads, eg. 95',
+        metavar='PERCENTILE',
+        type=float)
+    transfer_parser.add_argument(
+        '--hedge-budget',
+        help='Max duplicate reads, as a fraction of all reads (default: %(default)s)',
+        type=float,
+        default=0.1)
+    transfer_parser.add_argument(
+        '--hedge-split',
+        help='Split each duplicate read into this many smaller ranges '
+             '(default: %(default)s)',
+        type=int,
+        default=1)
+    transfer_parser.add_argument(
+        '--http2',
+        help='Multiplex requests over HTTP/2 connections (needs httpx[http2])',
+        action='store_true')
+    transfer_parser.add_argument(
+        '--request-size',
+        help='Bytes of cells sent or read by each range request, eg. 2M, '
+             'auto tunes it while transferring (default: %(default)s)',
+        metavar='SIZE',
+        default='auto')
+    transfer_parser.add_argument(
+        '--limit-rate',
+        help='Max bytes per second sent and received by range requests, '
+             'across all files, eg. 2M or 500K',
+        metavar='RATE')
+    transfer_parser.add_argument(
+        '--metrics',
+        help='Print the calls, errors, time and bytes of every API call '
+             'and stage at the end',
+        action='store_true')
+    transfer_parser.add_argument(
+        '--metrics-file',
+        help='Save metrics in the Prometheus text format to this file at the end, '
+             'eg. for the node_exporter textfile collector. '
+             'The daemon saves it after every job',
+        metavar='PATH')
+    transfer_parser.add_argument(
+        '--metrics-port',
+        help='Serve metrics on http://127.0.0.1:PORT/metrics while running',
+        metavar='PORT',
+        type=int)
+    transfer_parser.add_argument(
+        '--profile',
+        help='Save a cProfile profile and the top memory allocations '
+             '(tracemalloc) of every upload/download/decode phase in DIR',
+        metavar='DIR')
+    transfer_parser.add_argument(
+        '--trace',
+        help='Write every log record, with its file, sheet and range, and the '
+             'time of every API call and stage, as JSON lines to FILE',
+        metavar='FILE')
+    transfer_parser.add_argument(
+        '--progress-fd',
+        help='Write progress events as JSON lines to this file descriptor, '
+             'eg. 3 with 3>progress.jsonl',
+        metavar='FD',
+        type=int)
+
+    # Priority of the jobs of a command
+    priority_parser = argparse.ArgumentParser(add_help=False)
+    priority_parser.add_argument(
+        '--priority',
+        help='Priority class of the transfers, higher classes get workers and '
+             'bandwidth first (default: %(default)s)',
+        choices=PRIORITIES,
+        default='normal')
+
+    # How uploads are laid out in sheets
+    layout_parser = argparse.ArgumentParser(add_help=False)
+    layout_parser.add_argument(
+        '--stripe',
+        help='Stripe the file over groups of K data sheets and M parity sheets, '
+             'so any K sheets of a group are enough to download it, eg. 4+2',
+        metavar='K+M',
+        type=parse_stripe)
+    layout_parser.add_argument(
+        '--sparse',
+        help='Leave holes and runs of zeros out of the sheets, eg. of disk images, '
+             'and recreate them on download. Needs this version or later to download',
+        action='store_true')
+
     # Upload
     parser_upload = subparsers.add_parser(
         'upload', 
-        help='Upload a file to Google Sheets')
+        help='Upload file(s) to Google Sheets',
+        parents=[transfer_parser, priority_parser, layout_parser])
 
     parser_upload.add_argument(
         'upload_file',
-        help='File to be uploaded')
+        help='File(s) to be uploaded, - reads a single file from stdin',
+        nargs='+')
 
     parser_upload.add_argument(
-        'upload_json',
-        help='JSON file to be passed for resuming an upload',
-        nargs='?')
+        '--name',
+        help='Name stored for the file, only valid with a single file '
+             '(default: the file\'s name, or "stdin")')
+
+
+    parser_upload.add_argument(
+        '--resume',
+        dest='upload_json',
+        help='JSON file to be passed for resuming an upload, '
+             'only valid with a single file')
+
+    parser_upload.add_argument(
+        '--manifest-version',
+        help='Format of the file saved after uploading, 1 for JSON, '
+             '2 for a compact indexed file (default: %(default)s)',
+        type=int,
+        choices=sorted(EXTENSIONS),
+        default=1)
 
 
     # Download
     parser_download = subparsers.add_parser(
         'download',
-        help='Download a file from Google Sheets')
+        help='Download file(s) from Google Sheets',
+        parents=[transfer_parser, priority_parser])
 
     parser_download.add_argument(
-        'download_file',
-        help='Path where file is to be downloaded')
+        'download_args',
+        help='<download_file> <download_json> (- as download_file writes to stdout), '
+             'or with --output-dir, '
+             'one or more JSON files which contain file details. '
+             'Names of files in the catalog can be used instead of JSON files, '
+             'and a single name downloads it to the current directory',
+        metavar='path',
+        nargs='+')
 
     parser_download.add_argument(
-        'download_json',
-        help='Path to JSON file which contains file details')
+        '-d', '--output-dir',
+        help='Directory to download every file into, '
+             'using the name stored in its JSON file')
+
+    # Batch
+    parser_batch = subparsers.add_parser(
+        'batch',
+        help='Run every upload/download listed in a job file',
+        parents=[transfer_parser, priority_parser])
+
+    parser_batch.add_argument(
+        'job_file',
+        help='File with one job per line, either '
+             '"upload <file> [json]" or "download <file> <json>", '
+             'optionally followed by priority=CLASS')
+
+    # Plan
+    parser_plan = subparsers.add_parser(
+        'plan',
+        help='Estimate the sheets, requests, quota and time of uploads/downloads, '
+             'without connecting to Google',
+        parents=[transfer_parser, layout_parser])
+
+    parser_plan.add_argument(
+        'paths',
+        help='Files to upload, or JSON/manifest files of files to download',
+        metavar='path',
+        nargs='+')
+
+    parser_plan.add_argument(
+        '--json',
+        help='Print the plans as JSON',
+        action='store_true')
+
+    # Daemon
+    socket_parser = argparse.ArgumentParser(add_help=False)
+    socket_parser.add_argument(
+        '--socket',
+        help='Path of the daemon\'s Unix socket '
+             '(default: $SH_DISK_SOCKET, or .sheet_disk.sock in '
+             '$XDG_RUNTIME_DIR or the home directory)')
+
+    subparsers.add_parser(
+        'serve',
+        help='Run a daemon which accepts jobs over a Unix socket',
+        parents=[transfer_parser, socket_parser])
+
+    parser_submit = subparsers.add_parser(
+        'submit',
+        help='Submit an upload/download job to the daemon',
+        parents=[socket_parser, priority_parser])
+    parser_submit.add_argument(
+        'job_action',
+        choices=['upload', 'download'])
+    parser_submit.add_argument(
+        'user_file',
+        help='File to be uploaded, or path where file is to be downloaded')
+    parser_submit.add_argument(
+        'json_file',
+        help='JSON file for resuming an upload, '
+             'or JSON file which contains file details for a download',
+        nargs='?')
+    parser_submit.add_argument(
+        '--wait',
+        help='Show progress until the job is done',
+        action='store_true')
+
+    parser_status = subparsers.add_parser(
+        'status',
+        help='Show the status of jobs in the daemon',
+        parents=[socket_parser])
+    parser_status.add_argument(
+        'job_id',
+        help='Only show this job',
+        type=int,
+        nargs='?')
+
+    subparsers.add_parser(
+        'stop',
+        help='Stop the daemon, after its running jobs are done',
+        parents=[socket_parser])
+
+    # Catalog
+    subparsers.add_parser(
+        'catalog-init',
+        help='Create a catalog spreadsheet, for listing and finding uploaded files',
+        parents=[catalog_parser])
+
+    subparsers.add_parser(
+        'list',
+        help='List the files in the catalog',
+        parents=[catalog_parser])
+
+    parser_search = subparsers.add_parser(
+        'search',
+        help='Search the catalog for files by name',
+        parents=[catalog_parser])
+    parser_search.add_argument(
+        'pattern',
+        help='Part of the name, or a shell style pattern like \'*.zip\'')
+
+    # Manifest
+    parser_convert = subparsers.add_parser(
+        'convert',
+        help='Convert a JSON/manifest file to another manifest version')
+    parser_convert.add_argument(
+        'json_file',
+        help='JSON/manifest file to convert')
+    parser_convert.add_argument(
+        'output',
+        help='Path of the converted file')
+    parser_convert.add_argument(
+        '--manifest-version',
+        help='Manifest version to convert to (default: %(default)s)',
+        type=int,
+        choices=sorted(EXTENSIONS),
+        default=2)
+
+    parser_locate = subparsers.add_parser(
+        'locate',
+        help='Show the sheet and cell which store a byte offset of a file')
+    parser_locate.add_argument(
+        'json_file',
+        help='JSON/manifest file which contains details of the file')
+    parser_locate.add_argument(
+        'offset',
+        help='Byte offset in the file',
+        type=int)
 
     # Delete
     parser_delete = subparsers.add_parser(
             'delete', 
-            help='(Not implemented) Delete a file from Google Sheets')
+            help='Delete file(s) from Google Sheets',
+            parents=[transfer_parser])
     parser_delete.add_argument(
             'json_file',
-            help='JSON file which contains details of the file')
+            help='JSON file(s) which contain details of the files, '
+                 'or names of files in the catalog',
+            nargs='+')
+
+    parser_gc = subparsers.add_parser(
+            'gc',
+            help='Delete sheets of your accounts which no JSON file or catalog uses',
+            parents=[transfer_parser])
+    parser_gc.add_argument(
+            'manifest_paths',
+            help='JSON files, or directories holding them, whose sheets are kept',
+            metavar='path',
+            nargs='*')
+    parser_gc.add_argument(
+            '--min-age',
+            help='Only delete sheets created at least this many hours ago '
+                 '(default: %(default)s)',
+            type=float,
+            default=MIN_AGE)
+    parser_gc.add_argument(
+            '--dry-run',
+            help='Only show the sheets which would be deleted',
+            action='store_true')
 
     return parser
 
-def upload(user_file, json_file=None):
+def parse_stripe(value):
+    '''Parse 'K+M' into (k, m)'''
+    import argparse
+    k, _, m = value.partition('+')
+    if not (k.isdigit() and m.isdigit()) or int(k) < 1:
+        raise argparse.ArgumentTypeError('Stripe must be K+M, eg. 4+2, not ' + value)
+    return int(k), int(m)
+
+def upload(user_file, json_file=None, client=None, lane=None, json_dir=None, stripe=None,
+           manifest_version=1, name=None, sparse=False):
     # When uploading a file
     # if JSON file is specified,
     # then file upload is to be resumed
@@ -84,28 +387,223 @@ def upload(user_file, json_file=None):
     #logger.info('Performing Fresh Upload!')
 
     # Get basename for user file
-    base_name = os.path.basename(user_file)
+    # '-' is stdin, which has no name
+    base_name = name or ('stdin' if user_file == '-' else os.path.basename(user_file))
 
     with SheetUpload(
             name=base_name,
-            client=gc, 
+            client=client or get_client_pool(), 
             upload_file_path=user_file, 
-            json_file=json_file) as sheet:
+            json_file=json_file,
+            lane=lane,
+            json_dir=json_dir,
+            stripe=stripe,
+            manifest_version=manifest_version,
+            sparse=sparse) as sheet:
         sheet.start_upload()
 
+    # None if no sheet was uploaded
+    return sheet.manifest
 
-def download(user_file, json_file):
+
+def download(user_file, json_file, client=None, lane=None):
     # Download file via JSON data
     # user_file is path of the downloaded file
+    # json_file can also be a Manifest, eg. from the catalog
 
-    with open(json_file) as f:
-        json_dict = json.load(f)
+    if isinstance(json_file, Manifest):
+        json_dict = json_file.to_dict()
+    else:
+        # Either manifest version
+        json_dict = Manifest.load(json_file).to_dict()
 
     # Create sheet file from json
-    with SheetDownload(client=gc,
-        download_path=user_file, json_dict=json_dict) as f:
+    download_class = StripedDownload if 'stripe' in json_dict else SheetDownload
+    with download_class(client=client or get_client_pool(),
+        download_path=user_file, json_dict=json_dict, lane=lane) as f:
         f.start_download()
 
+def upload_from(source, name, client=None, lane=None, stripe=None, sparse=False):
+    '''
+    Upload from memory, without touching the filesystem.
+    Returns the manifest as a dict, the same as the JSON file written by upload().
+    If the upload fails, the sheets already uploaded are deleted.
+
+    source = Readable binary file object, or a bytes-like object
+    name = Name stored for the file
+    client = gspread client or ClientPool, defaults to get_client_pool()
+    lane = Optional scheduler Lane to run the range requests on
+    stripe = Optional (k, m) to stripe the file with
+    sparse = Leave runs of zeros out of the sheets
+    '''
+    if not hasattr(source, 'read'):
+        import io
+        source = io.BytesIO(source)
+
+    client = client or get_client_pool()
+    sheet = SheetUpload(
+            name=name,
+            client=client,
+            upload_file_path=source,
+            lane=lane,
+            stripe=stripe,
+            sparse=sparse,
+            save_manifest=False)
+    try:
+        with sheet:
+            sheet.start_upload()
+    except BaseException:
+        # Can't be resumed without a manifest, so don't leave sheets behind
+        if sheet.key_list:
+            from .cleanup import delete_sheets
+            delete_sheets(zip(sheet.key_list, sheet.account_list), client)
+        raise
+
+    return sheet.manifest.to_dict()
+
+def download_into(manifest, target, client=None, lane=None):
+    '''
+    Download a file into memory, without touching the filesystem.
+
+    manifest = Manifest dict, eg. from upload_from() or a JSON file, or a Manifest
+    target = Writable binary file object, or a writable buffer like a bytearray
+            or memoryview, which must hold at least file_size bytes
+    '''
+    json_dict = manifest.to_dict() if isinstance(manifest, Manifest) else manifest
+
+    download_class = StripedDownload if 'stripe' in json_dict else SheetDownload
+    with download_class(client=client or get_client_pool(),
+        download_path=target, json_dict=json_dict, lane=lane) as f:
+        f.start_download()
+
+def download_bytes(manifest, client=None, lane=None):
+    '''Download a file, and return its contents as bytes'''
+    import io
+    out = io.BytesIO()
+    download_into(manifest, out, client, lane)
+    return out.getvalue()
+
+def batch(jobs, concurrency=N_THREADS, max_files=MAX_FILES, client=None, hedge=None,
+          stripe=None, manifest_version=1, catalog=None, sparse=False, priority='normal'):
+    '''
+    Upload/download many files with one client.
+
+    All range requests share a single pool of concurrency workers,
+    and ranges of different files are interleaved.
+    Returns a list of (job, exception) for the jobs that failed.
+
+    jobs = List of (action, user_file, json_file) tuples,
+            where action is 'upload' or 'download'.
+            A 4th item sets the priority class of the job, if it isn't None
+    concurrency = Max no of range requests in flight, across all files
+    max_files = Max no of files transferred at the same time
+    client = gspread client or ClientPool to use, defaults to get_client_pool()
+    hedge = Optional HedgePolicy for the range reads of downloads
+    stripe = Optional (k, m) to stripe fresh uploads with
+    manifest_version = Format of the files saved after uploads
+    catalog = Optional Catalog, complete uploads are added to it at the end
+    sparse = Leave zero regions out of fresh uploads
+    priority = Priority class of the jobs, one of PRIORITIES
+    '''
+    pool = WorkPool(concurrency, hedge)
+    client = client or get_client_pool()
+
+    uploaded = []
+    def upload_job(*args):
+        uploaded.append(upload(*args, stripe=stripe, manifest_version=manifest_version,
+                               sparse=sparse))
+
+    run_list = []
+    for action, user_file, json_file, *job_priority in jobs:
+        lane = pool.lane(user_file, progress=False,
+                         priority=job_priority[0] if job_priority and job_priority[0] else priority)
+        fn = upload_job if action == 'upload' else download
+        label = action.capitalize() + ' ' + user_file
+        run_list.append((label, fn, (user_file, json_file, client, lane)))
+
+    # Higher priority jobs start first, the sort keeps the order within a class
+    run_list.sort(key=lambda job: job[2][3].rank)
+
+    # Closed at the end, so its worker threads exit
+    with pool:
+        failed = run_batch(run_list, max_files=max_files)
+
+    if catalog:
+        # One request for all the files
+        catalog.add([m for m in uploaded if m and m.complete_upload])
+
+    return failed
+
+def read_job_file(job_file):
+    '''
+    Parse a job file into a list of (action, user_file, json_file, priority),
+    priority is None if the line doesn't give one
+    '''
+    import shlex
+
+    jobs = []
+    with open(job_file) as f:
+        for line_no, line in enumerate(f, 1):
+            parts = shlex.split(line, comments=True)
+            if not parts:
+                continue
+
+            priority = None
+            if parts[-1].startswith('priority='):
+                priority = parts.pop()[len('priority='):]
+
+            action = parts[0]
+            job = None
+            if priority is not None and priority not in PRIORITIES:
+                pass
+            elif action == 'upload' and len(parts) in (2, 3):
+                job = ('upload', parts[1], parts[2] if len(parts) == 3 else None, priority)
+            elif action == 'download' and len(parts) == 3:
+                job = ('download', parts[1], parts[2], priority)
+
+            if job is None:
+                msg = job_file + ':' + str(line_no) + ' is not a valid job: ' + line.strip()
+                logger.error(msg)
+                raise ValueError(msg)
+            jobs.append(job)
+    return jobs
+
+def _is_manifest(path):
+    '''Return True if path is a JSON/manifest file created by sheet_disk'''
+    if not path.endswith(tuple(EXTENSIONS.values())):
+        return False
+    return Manifest.is_manifest(path)
+
+def _check_manifest(json_file):
+    '''Raise an error if json_file is missing or not a valid JSON/manifest file'''
+    if isinstance(json_file, Manifest):
+        # From the catalog
+        return
+
+    if not os.path.exists(json_file):
+        logger.error(json_file + ' file doesn\'t exist!')
+        raise FileNotFoundError(json_file)
+
+    # Will throw an error if file is not valid
+    try: Manifest.load(json_file)
+    except (ValueError, KeyError, TypeError, AttributeError) as j:
+        logger.error(json_file + ' is not a valid JSON/manifest file')
+        raise j
+
+def check_job(action, user_file, json_file):
+    '''Raise an error if the files of a job are missing or invalid'''
+    if action == 'upload':
+        if user_file != '-' and not os.path.exists(user_file):
+            logger.error(user_file + ' file doesn\'t exist!')
+            raise FileNotFoundError(user_file)
+
+        if json_file:
+            # Only enter this block, if 'upload_json' exists
+            _check_manifest(json_file)
+
+    if action == 'download':
+        _check_manifest(json_file)
+
 def main(raw_args=None):
     '''This method is the public interface to sheet_disk functions'''
 
@@ -119,73 +617,368 @@ def main(raw_args=None):
     logger.debug('Args have been parsed')
     dargs = vars(args)
 
-    # Error handling
-    logger.debug('Start error handling')
+    if 'concurrency' in dargs:
+        if dargs['trace']:
+            set_trace_file(dargs['trace'])
+        # Size the connection pool to the no of requests in flight
+        configure_transport(pool_size=dargs['concurrency'], http2=dargs['http2'])
+        set_creds_files(dargs['creds'])
+        configure_quota(
+            project=parse_quota(dargs['project_quota']),
+            account=parse_quota(dargs['quota']))
+        set_progress_fd(dargs['progress_fd'])
+        set_request_size(parse_size(dargs['request_size']))
+        if dargs['limit_rate']:
+            set_bandwidth_limit(parse_size(dargs['limit_rate'], 'Rate'))
+        set_profile_dir(dargs['profile'])
+        if dargs['metrics_port'] is not None:
+            serve_metrics(dargs['metrics_port'])
+
+    hedge = None
+    if dargs.get('hedge'):
+        hedge = HedgePolicy(
+            dargs['hedge'],
+            budget=dargs['hedge_budget'],
+            split=dargs['hedge_split'])
+
+    if 'catalog' in dargs:
+        set_catalog_keys(dargs['catalog'])
+
+    if dargs['action'] in ('serve', 'submit', 'status', 'stop'):
+        return run_daemon_action(dargs, hedge)
+
+    if dargs['action'] == 'plan':
+        return run_plan_action(dargs)
+
+    if dargs['action'] in ('catalog-init', 'list', 'search'):
+        return run_catalog_action(dargs)
+
+    # Build list of (action, user_file, json_file)
+    jobs = []
     if dargs['action'] == 'upload':
-        if not os.path.exists(dargs['upload_file']):
-            logger.error(dargs['upload_file'] + ' file doesn\'t exist!')
-            raise FileNotFoundError(dargs['upload_file'])
+        up_files = dargs['upload_file']
+        up_json = dargs['upload_json']
 
-        if dargs.get('upload_json', False):
-            # Only enter this block, if 'upload_json' exists
-            if not os.path.exists(dargs['upload_json']):
-                logger.error(dargs['upload_json'] + 'doesn\'t exist!')
-                raise FileNotFoundError(dargs['upload_json'])
-            with open(dargs['upload_json']) as f:
-                # Will throw json error if file is not valid
-                try: json.load(f)
-                except json.JSONDecodeError as j:
-                    logger.error(dargs['upload_json'] + ' is not a valid JSON file')
-                    raise j
-
-    if dargs['action'] == 'download':
-
-        if not os.path.exists(dargs['download_json']):
-            logger.error(dargs['download_json'] + ' file doesn\'t exist!')
-            raise FileNotFoundError(dargs['download_json'])
-
-        with open(dargs['download_json']) as f:
-            try: json.load(f)
-            except JSON.JSONDecodeError as j:
-                logger.error(dargs['download_json'] + ' is not a valid JSON file')
-                raise j
+        if not up_json and len(up_files) == 2 and _is_manifest(up_files[1]):
+            # Old style: upload <file> <json>
+            up_files, up_json = up_files[:1], up_files[1]
 
-    if dargs['action'] == 'delete':
-        raise NotImplementedError()
+        if up_json and len(up_files) > 1:
+            parser.error('--resume can only be used with a single file')
+
+        if '-' in up_files and (len(up_files) > 1 or up_json):
+            parser.error('- can only be uploaded on its own, and can\'t be resumed')
+
+        if dargs['name'] and len(up_files) > 1:
+            parser.error('--name can only be used with a single file')
+
+        jobs = [('upload', up_file, up_json) for up_file in up_files]
+
+    elif dargs['action'] == 'download':
+        down_args = dargs['download_args']
+
+        if dargs['output_dir']:
+            for down_json in down_args:
+                down_json = _find_manifest(down_json)
+                check_job('download', None, down_json)
+                if not isinstance(down_json, Manifest):
+                    down_json = Manifest.load(down_json)
+                jobs.append(('download', os.path.join(dargs['output_dir'], down_json.name),
+                             down_json))
+        elif len(down_args) == 2:
+            jobs = [('download', down_args[0], _find_manifest(down_args[1]))]
+        elif len(down_args) == 1 and not os.path.exists(down_args[0]) and get_catalog_keys():
+            # download <name>
+            down_json = _find_manifest(down_args[0])
+            jobs = [('download', down_json.name, down_json)]
+        else:
+            parser.error('download needs <download_file> <download_json>, '
+                         'or --output-dir with JSON file(s)')
+
+    elif dargs['action'] == 'batch':
+        jobs = [(action, user_file,
+                 _find_manifest(json_file) if action == 'download' else json_file, priority)
+                for action, user_file, json_file, priority in read_job_file(dargs['job_file'])]
+
+    elif dargs['action'] in ('convert', 'locate'):
+        return run_manifest_action(dargs)
+
+    elif dargs['action'] in ('delete', 'gc'):
+        return run_cleanup_action(dargs)
+
+    else:
+        raise ValueError('Invalid parameters')
+
+    if any(job[1] == '-' for job in jobs):
+        if len(jobs) > 1:
+            parser.error('- can only be used for a single file')
+        if jobs[0][0] == 'download':
+            # Keep stdout for the file
+            log_to_stderr()
+
+    # Error handling
+    logger.debug('Start error handling')
+    for job in jobs:
+        check_job(*job[:3])
 
     logger.debug('No errors found')
 
     # MAIN START
-    
-    if dargs['action'] == 'upload':
+    succeeded = False
+    try:
+        run_jobs(jobs, dargs, hedge)
+        succeeded = True
+    finally:
+        export_metrics(dargs, succeeded)
+
+def run_jobs(jobs, dargs, hedge=None):
+    '''Run the checked (action, user_file, json_file) jobs of an upload/download/batch command'''
+    if len(jobs) == 1 and dargs['action'] != 'batch':
+        action, user_file, json_file = jobs[0]
+
         logger.info('')
         # Create space
 
-        logger.info('Starting upload...')
-
-        up_file = dargs['upload_file']
-        up_json = dargs['upload_json']
-
-        upload(up_file, up_json)
-        logger.info('File upload is complete!')
+        logger.info('Starting ' + action + '...')
+
+        with WorkPool(dargs['concurrency'], hedge) as pool:
+            lane = pool.lane(user_file, priority=dargs.get('priority', 'normal'))
+            if action == 'upload':
+                manifest = upload(user_file, json_file, lane=lane, stripe=dargs.get('stripe'),
+                                  manifest_version=dargs.get('manifest_version', 1),
+                                  name=dargs.get('name'), sparse=dargs.get('sparse', False))
+            else:
+                download(user_file, json_file, lane=lane)
+
+        if action == 'upload':
+            catalog = get_catalog()
+            if catalog and manifest and manifest.complete_upload:
+                catalog.add([manifest])
+            logger.info('File upload is complete!')
+        else:
+            logger.info('File download is complete!')
 
-    elif dargs['action'] == 'download':
+    else:
         logger.info('')
-        # Create space
+        logger.info('Starting batch of ' + str(len(jobs)) + ' jobs...')
+
+        failed = batch(
+            jobs,
+            concurrency=dargs['concurrency'],
+            max_files=dargs['max_files'],
+            hedge=hedge,
+            stripe=dargs.get('stripe'),
+            manifest_version=dargs.get('manifest_version', 1),
+            catalog=get_catalog(),
+            sparse=dargs.get('sparse', False),
+            priority=dargs.get('priority', 'normal'))
+
+        if failed:
+            msg = str(len(failed)) + '/' + str(len(jobs)) + ' jobs failed'
+            logger.error(msg)
+            raise RuntimeError(msg)
+        logger.info('All ' + str(len(jobs)) + ' jobs are complete!')
+
+    if hedge:
+        hedge.log_stats()
+    log_request_sizes()
+
+    from .transport import log_transport_stats
+    log_transport_stats(get_client_pool())
+
+def export_metrics(dargs, succeeded=False):
+    '''
+    Log and save the metrics of the run, as asked for by the command line.
+    The throughput of the run is saved for plan only if it succeeded,
+    failed and cancelled runs would skew its estimates
+    '''
+    metrics = get_metrics()
+    if dargs.get('metrics'):
+        metrics.log_summary()
+    if dargs.get('metrics_file'):
+        metrics.write_textfile(dargs['metrics_file'])
+
+    if not succeeded:
+        return
+
+    # For plan
+    try:
+        save_run(dargs['concurrency'])
+    except OSError as e:
+        logger.debug('Could not save the throughput of the run: ' + repr(e))
+
+def _find_manifest(name):
+    '''
+    Return name if it is a JSON/manifest file, otherwise the Manifest of
+    the latest upload called name in the catalog
+    '''
+    catalog = get_catalog()
+    if catalog is None or Manifest.is_manifest(name):
+        # check_job will report a missing or invalid file
+        return name
+
+    manifest = catalog.find(name)
+    if manifest is None:
+        msg = name + ' is neither a file, nor a file in the catalog'
+        logger.error(msg)
+        raise FileNotFoundError(msg)
+    return manifest
+
+def run_catalog_action(dargs):
+    '''Run the catalog-init/list/search commands'''
+    action = dargs['action']
+
+    if action == 'catalog-init':
+        key = create_catalog()
+        logger.info('Created catalog ' + key)
+        logger.info('Set SH_DISK_CATALOG=' + key + ', or pass --catalog ' + key
+                    + ', to add uploads to it')
+        return
+
+    catalog = get_catalog()
+    if catalog is None:
+        msg = 'No catalog given, use --catalog or SH_DISK_CATALOG'
+        logger.error(msg)
+        raise ValueError(msg)
+
+    if action == 'list':
+        entries = catalog.entries()
+    else:
+        entries = catalog.search(dargs['pattern'])
 
-        logger.info('Starting download...')
+    f_str = '{:19s} | {:>15} | {}'
+    for entry in entries:
+        file_size = '' if entry['file_size'] is None else str(entry['file_size'])
+        logger.info(f_str.format(entry['uploaded'], file_size, entry['name']))
+    logger.info(str(len(entries)) + ' file(s)')
 
-        down_file = dargs['download_file']
-        down_json = dargs['download_json']
+def run_cleanup_action(dargs):
+    '''Run the delete/gc commands'''
+    catalog = get_catalog()
 
-        download(down_file, down_json)
-        logger.info('File download is complete!')
+    if dargs['action'] == 'delete':
+        targets = [_find_manifest(json_file) for json_file in dargs['json_file']]
+        for target in targets:
+            _check_manifest(target)
 
-    elif dargs['action'] == 'delete':
-        raise NotImplementedError()
+        failed = []
+        for target in targets:
+            failed += delete_file(target, concurrency=dargs['concurrency'], catalog=catalog)
 
     else:
-        raise ValueError('Invalid parameters')
+        _, failed = gc(
+            dargs['manifest_paths'],
+            concurrency=dargs['concurrency'],
+            catalog=catalog,
+            min_age=dargs['min_age'],
+            dry_run=dargs['dry_run'])
+
+    if failed:
+        msg = str(len(failed)) + ' sheets could not be deleted'
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+def run_manifest_action(dargs):
+    '''Run the convert/locate commands'''
+    _check_manifest(dargs['json_file'])
+    manifest = Manifest.load(dargs['json_file'])
+
+    if dargs['action'] == 'convert':
+        manifest.save(dargs['output'], dargs['manifest_version'])
+        logger.info('Saved ' + dargs['output'] + ' as manifest version '
+                    + str(dargs['manifest_version']))
+
+    elif dargs['action'] == 'locate':
+        record, cell_no, offset_in_cell = manifest.locate(dargs['offset'])
+        logger.info('Offset ' + str(dargs['offset']) + ' is in sheet '
+                    + str(record.index + 1) + '/' + str(manifest.n_sheets)
+                    + ', cell A' + str(cell_no) + ', byte ' + str(offset_in_cell)
+                    + ' of the cell')
+        logger.info('Key: ' + record.key)
+        if record.account:
+            logger.info('Account: ' + record.account)
+
+def run_plan_action(dargs):
+    '''Run the plan command'''
+    if dargs['json']:
+        # Keep stdout for the JSON
+        log_to_stderr()
+
+    for path in dargs['paths']:
+        if not os.path.isfile(path):
+            logger.error(path + ' file doesn\'t exist!')
+            raise FileNotFoundError(path)
+
+    plans, total = plan_paths(
+        dargs['paths'],
+        concurrency=dargs['concurrency'],
+        max_files=dargs['max_files'],
+        stripe=dargs['stripe'],
+        sparse=dargs['sparse'])
+
+    if dargs['json']:
+        import sys, json
+        json.dump({'plans': plans, 'total': total}, sys.stdout, indent=4)
+        sys.stdout.write('\n')
+        return
+
+    for plan in plans:
+        log_plan(plan)
+    if len(plans) > 1:
+        log_plan(total)
+
+def run_daemon_action(dargs, hedge=None):
+    '''Run the serve/submit/status/stop commands'''
+    from . import daemon
+
+    action = dargs['action']
+    socket_path = dargs['socket']
+
+    if action == 'serve':
+        daemon.serve(
+            socket_path,
+            concurrency=dargs['concurrency'],
+            max_files=dargs['max_files'],
+            hedge=hedge,
+            metrics_file=dargs['metrics_file'])
+
+    elif action == 'submit':
+        if dargs['job_action'] == 'download' and not dargs['json_file']:
+            msg = 'A download job needs a JSON file'
+            logger.error(msg)
+            raise ValueError(msg)
+
+        if dargs['user_file'] == '-':
+            msg = 'The daemon can\'t read from stdin or write to stdout'
+            logger.error(msg)
+            raise ValueError(msg)
+
+        daemon.submit(
+            dargs['job_action'],
+            dargs['user_file'],
+            dargs['json_file'],
+            wait=dargs['wait'],
+            priority=dargs['priority'],
+            socket_path=socket_path)
+
+    elif action == 'status':
+        f_str = '{:>4} | {:8s} | {:7s} | Sheet {:d}/{:d} | {:d}/{:d} cells | {}'
+        request = {'op': 'status', 'job_id': dargs['job_id']}
+        response = daemon.send_request(request, socket_path)
+        for job in response['jobs']:
+            logger.info(f_str.format(
+                job['id'], job['action'], job['state'],
+                *(job['sheet'] + job['cells']),
+                job['error'] or job['user_file']))
+
+        stats = response.get('transport')
+        if stats:
+            logger.info('Daemon has sent ' + str(stats['requests']) + ' requests over '
+                        + str(stats['connections']) + ' connections')
+
+    elif action == 'stop':
+        daemon.send_request({'op': 'shutdown'}, socket_path)
+        logger.info('Daemon is stopping')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,240 @@
+'''Leaving the zero regions of files out of uploads, eg. the holes of
+sparse disk images, or the empty pages of preallocated database files.
+
+While uploading, holes (found with SEEK_DATA/SEEK_HOLE where the OS has
+them) and runs of zeros at least one cell long are recorded as extents
+of the file, and only the rest of the file is stored in sheets. Downloads
+put the zeros back, as holes when writing to a file.
+
+The manifest of such a file has:
+    zero_extents = [[offset, length], ...] of the zero regions, in file order
+    stored_size = Bytes stored in sheets, file_size minus the zeros'''
+
+import os, errno
+from collections import deque
+from .utils import BYTES_PER_CELL
+from .my_logging import get_logger
+
+logger = get_logger()
+
+# Zero runs shorter than a cell are cheaper to store than to describe
+MIN_ZERO_RUN = BYTES_PER_CELL
+
+# Files are checked for zeros in blocks of this size
+BLOCK_SIZE = BYTES_PER_CELL
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+# Max bytes of zeros written at once, when holes can't be seeked over
+ZERO_CHUNK = bytes(2 ** 20)
+
+
+def data_regions(f, file_size=None):
+    '''
+    Return the list of (start, end) of the regions of f which may hold data,
+    from SEEK_DATA/SEEK_HOLE. Everything else is a hole.
+    Without them, or for streams, the whole file is one region, with end None.
+    '''
+    seek_data = getattr(os, 'SEEK_DATA', None)
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError, ValueError):
+        fd = None
+    if seek_data is None or fd is None or file_size is None:
+        return [(0, None)]
+
+    regions = []
+    position = 0
+    try:
+        while position < file_size:
+            try:
+                start = os.lseek(fd, position, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Only a hole from position to the end
+                    break
+                raise
+            end = min(file_size, os.lseek(fd, start, os.SEEK_HOLE))
+            regions.append((start, end))
+            position = end
+    except OSError as e:
+        # eg. a pipe, or a filesystem without SEEK_DATA
+        logger.debug('Can\'t find holes: ' + repr(e))
+        return [(0, None)]
+    finally:
+        # lseek moved the file position under f
+        f.seek(0)
+
+    return regions
+
+
+class SparseReader:
+    '''
+    Reads a file without its zero regions, recording them as extents
+
+    f = Readable binary file object
+    file_size = Size of the file, None for a stream
+    min_run = Shortest run of zeros which is left out
+    '''
+
+    def __init__(self, f, file_size=None, min_run=MIN_ZERO_RUN):
+        self.f = f
+        self.file_size = file_size
+        self.min_run = min_run
+
+        # [[offset, length], ...] of the zero regions found so far
+        self.extents = []
+        # Bytes of the file read so far, including zeros
+        self.position = 0
+        # Bytes returned, ie. without the zeros
+        self.stored = 0
+
+        # Zero run being collected
+        self._run_start = 0
+        self._run_length = 0
+
+    def _zeros(self, start, length):
+        '''Add length zero bytes at start to the current run'''
+        if not self._run_length:
+            self._run_start = start
+        self._run_length += length
+
+    def _end_run(self):
+        '''Return the current zero run as data if it is too short to leave out'''
+        start, length = self._run_start, self._run_length
+        self._run_length = 0
+        if not length:
+            return b''
+        if length < self.min_run:
+            return bytes(length)
+
+        if self.extents and sum(self.extents[-1]) == start:
+            self.extents[-1][1] += length
+        else:
+            self.extents.append([start, length])
+        return b''
+
+    def _blocks(self):
+        '''Yield the data of the file, leaving out its zero runs'''
+        position = 0
+        for start, end in data_regions(self.f, self.file_size):
+            if start > position:
+                # Hole before the region
+                self._zeros(position, start - position)
+                position = start
+            if end is not None:
+                self.f.seek(start)
+
+            while end is None or position < end:
+                size = BLOCK_SIZE if end is None else min(BLOCK_SIZE, end - position)
+                block = self.f.read(size)
+                if not block:
+                    break
+
+                if block == ZERO_BLOCK[:len(block)]:
+                    self._zeros(position, len(block))
+                else:
+                    yield self._end_run() + block
+                position += len(block)
+                self.position = position
+
+        if self.file_size is not None and self.file_size > position:
+            # Hole at the end
+            self._zeros(position, self.file_size - position)
+            position = self.file_size
+        self.position = position
+
+        tail = self._end_run()
+        if tail:
+            yield tail
+
+    def chunks(self, chunk_size):
+        '''Yield the data of the file without its zero runs, in chunks of chunk_size'''
+        buf = bytearray()
+        for data in self._blocks():
+            buf += data
+            while len(buf) >= chunk_size:
+                chunk = bytes(buf[:chunk_size])
+                del buf[:chunk_size]
+                self.stored += len(chunk)
+                yield chunk
+        if buf:
+            self.stored += len(buf)
+            yield bytes(buf)
+
+        logger.debug('Left out ' + str(self.position - self.stored) + ' bytes of zeros in '
+                     + str(len(self.extents)) + ' extents')
+
+
+class SparseWriter:
+    '''
+    File like writer which takes the stored data of a file,
+    and writes it to out with the zero extents put back
+
+    out = Binary file object to write the file to
+    extents = [[offset, length], ...] of the zero regions
+    file_size = Size of the whole file
+    seek = Seek over the zero regions, leaving holes, instead of writing zeros.
+            Only for files opened by us, where seeking from the start is safe
+    '''
+
+    def __init__(self, out, extents, file_size, seek=False):
+        self.out = out
+        self.extents = deque(extents)
+        self.file_size = file_size
+        self.seek = seek
+        self.position = 0
+
+    def _skip(self, length):
+        if self.seek:
+            self.out.seek(length, os.SEEK_CUR)
+        else:
+            remaining = length
+            while remaining:
+                n = min(remaining, len(ZERO_CHUNK))
+                self.out.write(ZERO_CHUNK[:n])
+                remaining -= n
+        self.position += length
+
+    def _skip_extents(self):
+        while self.extents and self.extents[0][0] <= self.position:
+            offset, length = self.extents.popleft()
+            self._skip(offset + length - self.position)
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            self._skip_extents()
+            limit = self.extents[0][0] - self.position if self.extents else len(view)
+            part = view[:limit]
+            self.out.write(part)
+            self.position += len(part)
+            view = view[len(part):]
+        return len(data)
+
+    def flush(self):
+        self.out.flush()
+
+    def finish(self):
+        '''Write the zero regions at the end of the file, call after the last write'''
+        self._skip_extents()
+        if self.seek:
+            # Extend the file over a hole at the end
+            self.out.truncate(self.position)
+        if self.position != self.file_size:
+            msg = 'Rebuilt ' + str(self.position) + ' bytes, but the file has ' \
+                  + str(self.file_size)
+            logger.error(msg)
+            raise ValueError(msg)
+
+
+def wrap_output(out, header, seek=False):
+    '''Return out, or a SparseWriter over it if the file has zero extents'''
+    extents = header.get('zero_extents')
+    if not extents:
+        return out
+    return SparseWriter(out, extents, header['file_size'], seek)
+
+def finish_output(out):
+    '''Finish an output from wrap_output()'''
+    if isinstance(out, SparseWriter):
+        out.finish()
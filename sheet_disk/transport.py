@@ -0,0 +1,323 @@
+'''HTTP transport used by the gspread clients.
+
+Connections are kept alive and pooled, and the pool is sized to the
+number of requests which can be in flight at once.'''
+
+import threading, time, random, contextvars
+from collections import deque
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from .my_logging import get_logger
+from .ratelimit import classify
+from .metrics import get_metrics
+
+logger = get_logger()
+
+# Responses which are retried, after waiting
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# The server may have done the work of a request which got a server error,
+# so those are only retried for methods which can be sent twice.
+# A create or share POST fails up to the caller instead of making a duplicate
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT')
+MAX_RETRIES = 5
+# Max seconds to wait before a retry
+MAX_BACKOFF = 64
+
+# Exchange of the calling http_exchange() block, None outside of one
+_exchange = contextvars.ContextVar('http_exchange', default=None)
+
+
+class UsageWindow:
+    '''
+    Counts the requests sent in the last window seconds,
+    used to spread work across accounts.
+    '''
+
+    def __init__(self, window=60):
+        self.window = window
+        self._times = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self._times and self._times[0] <= now - self.window:
+            self._times.popleft()
+
+    def add(self):
+        now = time.monotonic()
+        with self._lock:
+            self._times.append(now)
+            self._trim(now)
+
+    def count(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return len(self._times)
+
+
+class Exchange:
+    '''
+    seconds = Time spent sending requests and reading their responses,
+            without rate limiter waits, backoff or refused attempts
+    '''
+
+    def __init__(self):
+        self.seconds = 0.0
+
+@contextmanager
+def http_exchange():
+    '''
+    Measure the HTTP exchanges of the requests sent in the with block,
+    by the calling thread or work it runs with copy_context()
+    '''
+    exchange = Exchange()
+    token = _exchange.set(exchange)
+    try:
+        yield exchange
+    finally:
+        _exchange.reset(token)
+
+
+def send_throttled(session, send, method, url, **kwargs):
+    '''
+    Send a request with send(method, url, **kwargs), after taking a token
+    from each of the session's rate limiters.
+    Quota errors, and server errors of IDEMPOTENT_METHODS, are retried with
+    exponential backoff. A refused access token is refreshed with
+    session.reauthorize, and the request retried once.
+    '''
+    kind = classify(method, url)
+    metrics = get_metrics()
+    reauthorized = False
+
+    for attempt in range(MAX_RETRIES + 1):
+        start = time.perf_counter()
+        for limiter in session.limiters:
+            limiter.acquire(kind)
+        session.usage.add()
+
+        sent = time.perf_counter()
+        metrics.rate_wait(kind, sent - start)
+        # Header the request is sent with, to tell if another thread refreshed it
+        auth = session.headers.get('Authorization')
+        try:
+            response = send(method, url, **kwargs)
+        except Exception:
+            metrics.http_response(kind, 0, time.perf_counter() - sent, 0)
+            raise
+        seconds = time.perf_counter() - sent
+        metrics.http_response(kind, response.status_code, seconds,
+                              len(response.content or b''))
+
+        if response.status_code == 401 and session.reauthorize and not reauthorized:
+            # The cached token expired, or was revoked, during the transfer
+            logger.debug('Got 401 for ' + method.upper() + ' ' + url + ', refreshing the token')
+            reauthorized = True
+            session.reauthorize(auth)
+            continue
+
+        retry = response.status_code == 429 or (
+            response.status_code in RETRY_STATUS and method.upper() in IDEMPOTENT_METHODS)
+        if not retry or attempt == MAX_RETRIES:
+            exchange = _exchange.get()
+            if exchange is not None:
+                exchange.seconds += seconds
+            return response
+        metrics.retry(kind)
+
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            wait = int(retry_after)
+        else:
+            wait = min(MAX_BACKOFF, 2 ** attempt) + random.random()
+        logger.debug('Got ' + str(response.status_code) + ' for ' + method.upper()
+                     + ' ' + url + ', retrying in ' + '{:.1f}'.format(wait) + 's')
+        time.sleep(wait)
+
+
+class PooledSession(requests.Session):
+    '''
+    requests Session with a keep-alive connection pool of pool_size
+    connections per host.
+
+    pool_size = Max no of connections kept open to each host
+    limiters = RateLimiters every request has to go through
+    reauthorize = Called with the refused Authorization header after a 401,
+            to update the session's headers, None to not retry 401s
+    '''
+
+    def __init__(self, pool_size, limiters=()):
+        super().__init__()
+        self.pool_size = pool_size
+        self.limiters = list(limiters)
+        self.reauthorize = None
+
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+        self.usage = UsageWindow()
+
+    def request(self, method, url, **kwargs):
+        return send_throttled(self, super().request, method, url, **kwargs)
+
+    def stats(self):
+        '''Return {'requests': int, 'connections': int, 'http2': False}'''
+        n_requests = n_connections = 0
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                n_requests += pool.num_requests
+                n_connections += pool.num_connections
+
+        return {'requests': n_requests, 'connections': n_connections, 'http2': False}
+
+
+class HTTP2Session(requests.Session):
+    '''
+    requests compatible Session which sends requests with httpx,
+    so that requests to a host are multiplexed on HTTP/2 connections.
+
+    Needs the httpx package, installed with the http2 extra.
+
+    pool_size = Max no of connections kept open
+    limiters = RateLimiters every request has to go through
+    reauthorize = Called with the refused Authorization header after a 401,
+            to update the session's headers, None to not retry 401s
+    '''
+
+    def __init__(self, pool_size, limiters=()):
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError('HTTP/2 needs httpx, install it with: '
+                              'pip install httpx[http2]')
+
+        super().__init__()
+        self.pool_size = pool_size
+        self.limiters = list(limiters)
+        self.reauthorize = None
+        self._client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size))
+
+        self._lock = threading.Lock()
+        self._n_requests = 0
+        # ids of the network streams responses came on
+        self._streams = set()
+        self._http2 = False
+
+        self.usage = UsageWindow()
+
+    def request(self, method, url, **kwargs):
+        return send_throttled(self, self._send, method, url, **kwargs)
+
+    def _send(self, method, url, params=None, data=None, headers=None,
+              files=None, json=None, **kwargs):
+        # Session headers hold the Authorization header
+        merged = dict(self.headers)
+        merged.update(headers or {})
+
+        body = {}
+        if isinstance(data, (bytes, str)):
+            body['content'] = data
+        elif data is not None:
+            body['data'] = data
+
+        r = self._client.request(
+            method, url,
+            params=params,
+            headers=merged,
+            files=files,
+            json=json,
+            **body)
+
+        with self._lock:
+            self._n_requests += 1
+            stream = r.extensions.get('network_stream')
+            if stream is not None:
+                self._streams.add(id(stream))
+            if r.http_version == 'HTTP/2':
+                self._http2 = True
+
+        return _to_requests_response(r)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self._n_requests,
+                'connections': len(self._streams),
+                'http2': self._http2,
+            }
+
+    def close(self):
+        self._client.close()
+        super().close()
+
+
+def _to_requests_response(r):
+    '''Wrap a httpx response as a requests Response, for gspread'''
+    response = requests.Response()
+    response.status_code = r.status_code
+    response.reason = r.reason_phrase
+    response.headers.update(r.headers)
+    response.url = str(r.url)
+    response.encoding = r.encoding
+    response._content = r.content
+    return response
+
+
+def make_session(pool_size, http2=False, limiters=()):
+    '''Return a PooledSession, or a HTTP2Session if http2 is True'''
+    logger.debug('Creating ' + ('HTTP/2' if http2 else 'HTTP/1.1')
+                 + ' session with ' + str(pool_size) + ' connections')
+    if http2:
+        return HTTP2Session(pool_size, limiters)
+    return PooledSession(pool_size, limiters)
+
+
+def transport_stats(client):
+    '''
+    Return the stats of the client's session, None if it has no stats.
+    For a ClientPool, the stats of every account are added up.
+    '''
+    if hasattr(client, 'clients'):
+        total = None
+        for one in client.clients.values():
+            stats = transport_stats(one)
+            if stats is None:
+                continue
+            if total is None:
+                total = dict(stats)
+            else:
+                total['requests'] += stats['requests']
+                total['connections'] += stats['connections']
+                total['http2'] = total['http2'] or stats['http2']
+        return total
+
+    session = getattr(client, 'session', None)
+    if not hasattr(session, 'stats'):
+        return None
+    return session.stats()
+
+
+def log_transport_stats(client):
+    '''Log how many requests were sent, and over how many connections'''
+    stats = transport_stats(client)
+    if stats is None:
+        return
+
+    msg = str(stats['requests']) + ' requests sent over ' + \
+          str(stats['connections']) + ' connections'
+    if stats['http2']:
+        msg += ' (HTTP/2)'
+    logger.info(msg)
+
+    if len(getattr(client, 'clients', ())) > 1:
+        for account, one in client.clients.items():
+            stats = transport_stats(one)
+            if stats:
+                logger.info('    ' + account + ': ' + str(stats['requests']) + ' requests')
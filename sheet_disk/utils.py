@@ -1,9 +1,13 @@
 '''This file contains the main interfacing
 functions that are needed to access google sheets'''
 
-import threading, time
-from queue import Queue, Empty as queueEmpty
-from .my_logging import MyConsoleHandler, get_logger
+import threading
+from concurrent.futures import wait
+from .my_logging import get_logger, log_context
+from .metrics import timed, get_metrics
+from .scheduler import get_default_pool
+from .ratelimit import get_bandwidth_limiter
+from .transport import http_exchange
 logger = get_logger()
 
 # Chars allowed in each cell
@@ -20,6 +24,11 @@ WKS_RANGE = 'A1:A1000'
 # Characters allowed in one sheet
 CHAR_PER_SHEET = CELL_CHAR_LIMIT * CELLS_PER_SHEET
 
+# Bytes of the file stored in one cell, and one sheet
+# b64 gives 4 bytes for input 3 bytes
+BYTES_PER_CELL = CELL_CHAR_LIMIT // 4 * 3
+BYTES_PER_SHEET = CHAR_PER_SHEET // 4 * 3
+
 # No. of threads to use
 N_THREADS = 11
 
@@ -27,7 +36,23 @@ def chunk_cell(string, cell_size):
     return (string[i:i+cell_size]
             for i in range(0, len(string), cell_size))
 
-def sheet_upload(worksheet, content, sheet_progress):
+def get_lane(lane, name):
+    '''Return lane, or a lane on the default pool if lane is None'''
+    if lane is None:
+        lane = get_default_pool(N_THREADS).lane(name)
+    return lane
+
+def use_bandwidth(n_bytes, lane):
+    '''
+    Wait until n_bytes can be sent or received under the bandwidth cap,
+    before lower priority lanes. Returns the limiter, None if there is no cap
+    '''
+    limiter = get_bandwidth_limiter()
+    if limiter is not None:
+        get_metrics().rate_wait('bandwidth', limiter.acquire(n_bytes, lane.rank))
+    return limiter
+
+def sheet_upload(worksheet, content, sheet_progress, lane=None, tracker=None):
     '''
     Upload the given content to passed Worksheet instance.
     Returns total cells written in the worksheet
@@ -36,11 +61,17 @@ def sheet_upload(worksheet, content, sheet_progress):
     content = The content which we need to write in the worksheet
     sheet_progress = A 2-tuple indicating 
             * current sheet being uploaded  (int)
-            * total sheets to be used       (int)
+            * total sheets to be used       (int), 0 if not known yet
+    lane = The scheduler Lane to run the range requests on,
+            uses the default pool if None
+    tracker = The progress.Tracker of the file, told about every range
+            as it is written, None to not track progress
     '''
+    lane = get_lane(lane, 'upload')
 
     wks = worksheet
-    all_cells = wks.range(WKS_RANGE)
+    with timed('range'):
+        all_cells = wks.range(WKS_RANGE)
     # Very inexpensive, quick operation 
     # since wks is empty for new file
 
@@ -52,110 +83,124 @@ def sheet_upload(worksheet, content, sheet_progress):
 
     total_cells_written = i + 1
 
-    data_count_queue = Queue()
-    # this queue is used to get the number of cells
-    # completed by a thread
-    # Threads will put (no of cells done) in queue
-    # progress bar print will get them and increment counter
+    if tracker:
+        tracker.start_sheet(*sheet_progress, total_cells_written)
+
+    # Not at the top, since batching needs the constants of this module
+    from .batching import get_sizer
+
+    # Cells per request, fixed for the sheet
+    sizer = get_sizer('write')
+    planned = sizer.cells
 
     thread_details ={
         'wks': wks,
-        'data_count_queue': data_count_queue,
+        'lane': lane,
+        'tracker': tracker,
+        'sizer': sizer,
+        'planned': planned,
     }
 
-    n_threads = N_THREADS
-    thread_list = []
-
-    for t_no, start, end in work_divider(
-                    no_of_cells=total_cells_written,
-                    n_threads=n_threads
-                    ):
-
-        t = threading.Thread(
-                target=worker_upload,
-                name='Thread ' + str(t_no),
-                args=(all_cells[start-1:end], thread_details)
-                )
-        # start-1, since start is 1-index, all_cells is 0-indexed
-        t.daemon = True
-        logger.debug('Created thread ' + t.name)
-        thread_list.append(t)
+    future_list = []
+
+    # Work submitted to the lane logs with the sheet it is for
+    with log_context(sheet=sheet_progress[0]):
+        for t_no, start, end in sizer.split(total_cells_written, planned):
+
+            f = lane.submit(worker_upload, start, end, all_cells[start-1:end], thread_details)
+            # start-1, since start is 1-index, all_cells is 0-indexed
+            logger.debug('Queued range %d-%d', start, end)
+            future_list.append(f)
         
     # HANDLE ALL THREADING STUFF
-    thread_runner_factory(
-        thread_list, 
-        data_count_queue, 
-        sheet_progress,
-        total_cells=total_cells_written)
+    thread_runner_factory(future_list)
+    if tracker:
+        tracker.end_sheet()
 
     return total_cells_written
 
-def worker_upload(cell_list, thread_details):
+def worker_upload(start, end, cell_list, thread_details):
+    with log_context(range=str(start) + '-' + str(end)):
+        _worker_upload(cell_list, thread_details)
+
+def _worker_upload(cell_list, thread_details):
 
     wks = thread_details['wks']
-    data_count_queue = thread_details['data_count_queue']
-    name = threading.current_thread().name
+    tracker = thread_details['tracker']
+
+    # -1 for the quote character
+    n_bytes = sum(b64_bytes(cell.value[1:]) for cell in cell_list)
+
+    # The cap is on the base64 text sent
+    use_bandwidth(sum(len(cell.value) for cell in cell_list), thread_details['lane'])
+
+    logger.debug('Starting upload')
+    with timed('update_cells', n_bytes), http_exchange() as exchange:
+        wks.update_cells(cell_list)
+    logger.debug('Done upload')
 
-    logger.debug(name + ': Starting upload')
-    wks.update_cells(cell_list)
-    logger.debug(name + ': Done upload')
+    # Only the exchange, quota waits and backoff say nothing about the size
+    thread_details['sizer'].record(
+        thread_details['planned'], len(cell_list), n_bytes, exchange.seconds)
 
-    total_cells_done = len(cell_list)
-    data_count_queue.put(total_cells_done)
-    logger.debug(name + ' has put progress to queue')
+    if tracker:
+        tracker.add(len(cell_list), n_bytes)
 
-    logger.debug(name + ': end function')
+    logger.debug('End function')
 
-def sheet_download(worksheet, sheet_progress, cell_count):
+def sheet_download(worksheet, sheet_progress, cell_count, lane=None, tracker=None):
     '''
     Download content from given worksheet instance
 
     worksheet = The worksheet object from which we are downloading data
-    instance_sheetdownload = an instance of the SheetDownload class being
-        used to download the sheet
     sheet_progress = A 2-tuple indicating 
             * current sheet being uploaded  (int)
             * total sheets to be used       (int)
+    cell_count = The no of cells stored in the worksheet
+    lane = The scheduler Lane to run the range requests on,
+            uses the default pool if None
+    tracker = The progress.Tracker of the file, told about every range
+            as it is read, None to not track progress
     '''
     wks = worksheet
+    lane = get_lane(lane, 'download')
 
-    n_threads = N_THREADS
-    data_list = [None] * n_threads
+    if tracker:
+        tracker.start_sheet(*sheet_progress, cell_count)
+
+    from .batching import get_sizer
+
+    # Cells per request, fixed for the sheet
+    sizer = get_sizer('read')
+    planned = sizer.cells
+    ranges = list(sizer.split(cell_count, planned))
+
+    data_list = [None] * len(ranges)
     data_lock = threading.Lock()
-    data_count_queue = Queue()
-    # this queue is used to get the number of cells
-    # completed by a thread
-    # Threads will put (no of cells done) in queue
-    # progress bar print will get them and increment counter
 
     thread_details = {
         'wks': wks,
+        'lane': lane,
+        'hedge': lane.pool.hedge,
         'data_list': data_list,
         'data_lock': data_lock,
-        'data_count_queue': data_count_queue,
+        'tracker': tracker,
+        'sizer': sizer,
+        'planned': planned,
     }
 
-    thread_list = []
-    for t_no, start, end in work_divider(
-                    no_of_cells=cell_count,
-                    n_threads=n_threads
-                    ):
-
-        t = threading.Thread(
-                target=worker_download,
-                name='Thread ' + str(t_no),
-                args=(t_no, start, end, thread_details),
-                )
-        t.daemon = True
-        logger.debug('Created thread ' + t.name)
-        thread_list.append(t)
+    future_list = []
+    with log_context(sheet=sheet_progress[0]):
+        for t_no, start, end in ranges:
+
+            f = lane.submit(worker_download, t_no, start, end, thread_details)
+            logger.debug('Queued range %d-%d', start, end)
+            future_list.append(f)
 
     # HANDLE ALL THREADING STUFF
-    thread_runner_factory(
-            thread_list, 
-            data_count_queue, 
-            sheet_progress,
-            total_cells=cell_count)
+    thread_runner_factory(future_list)
+    if tracker:
+        tracker.end_sheet()
     # the threads assign data to data_list, which is
     # passed as argument to each thread
     # Each thread can access data_list using data_lock
@@ -167,138 +212,61 @@ def sheet_download(worksheet, sheet_progress, cell_count):
 
 
 def worker_download(thread_no, start, end, thread_details):
+    with log_context(range=str(start) + '-' + str(end)):
+        _worker_download(thread_no, start, end, thread_details)
+
+def _worker_download(thread_no, start, end, thread_details):
     wks = thread_details['wks']
     data_list = thread_details['data_list']
     data_lock = thread_details['data_lock']
-    data_count_queue = thread_details['data_count_queue']
+    tracker = thread_details['tracker']
+
+    # Size of the response isn't known yet, so the cap takes full cells,
+    # and gets back what wasn't used
+    expected = (end - start + 1) * (CELL_CHAR_LIMIT + 1)
+    limiter = use_bandwidth(expected, thread_details['lane'])
+
+    logger.debug('Starting download')
+    hedge = thread_details['hedge']
+    with timed('range') as timer, http_exchange() as exchange:
+        if hedge:
+            t_cells = hedge.fetch(wks, start, end)
+        else:
+            t_cells = wks.range('A' + str(start) + ':A' + str(end))
+        n_bytes = timer.bytes = sum(b64_bytes(cell.value[1:]) for cell in t_cells)
+    logger.debug('Done download')
 
-    name = threading.current_thread().name
+    if limiter is not None:
+        limiter.credit(max(0, expected - sum(len(cell.value) for cell in t_cells)))
 
-    logger.debug(name + ': Starting download')
-    t_cells = wks.range('A' + str(start) + ':A' + str(end))
-    logger.debug(name + ': done download')
+    thread_details['sizer'].record(
+        thread_details['planned'], end - start + 1, n_bytes, exchange.seconds)
 
     with data_lock:
         data_list[thread_no] = t_cells
-    logger.debug(name + ' has assigned data to data_list')
+    logger.debug('Assigned data to data_list')
 
-    total_cells_done = end - start + 1
-    data_count_queue.put(total_cells_done)
+    if tracker:
+        tracker.add(end - start + 1, n_bytes)
 
-    logger.debug(name + ' has put progress to queue')
-    logger.debug(name + ' end: Returned data')
+    logger.debug('End: Returned data')
 
-def thread_runner_factory(thread_list, data_count_queue, sheet_progress, total_cells):
-    '''
-    Takes a list of threads, and manages their concurrency and also 
-    prints appropriate progress bars.
+def b64_bytes(string):
+    '''No of bytes encoded by a base64 string'''
+    return len(string) // 4 * 3 - string[-2:].count('=')
 
-    thread_list = List of thread objects
-    data_count_queue = Queue object, 
-            to which the threads put their progress as ints
-    sheet_progress = A 2-tuple indicating 
-            * current sheet being uploaded  (int)
-            * total sheets to be used       (int)
+def thread_runner_factory(future_list):
     '''
+    Takes a list of futures for work queued on a WorkPool, and waits for them.
+    Raises the first exception raised by any of the workers.
 
-    sh_cur = sheet_progress[0]
-    sh_total = sheet_progress[1]
-
-    for t in thread_list:
-        t.start()
-        logger.debug('Started thread ' + t.name)
-
-    interval = 0.4 # sec
-    counter = 1
-    length = 20
-    completed_cells = 0
-    latest_done_cells = 0 # re init for each sheet
-    
-    f_str = 'Sheet {:d}/{:d} | {:' + str(length) + 's} | {:d}/{:d} cells done'
-
-    MyConsoleHandler.change_terminator('\r')
-
-    while any( t.is_alive() for t in thread_list ) or not data_count_queue.empty():
-        # While any of the threads is alive
-        # ie while atleast one thread is alive
-        # or
-        # while queue is not empty
-
-        prog = '#' * (counter%(length+1)) + '-' * (length - (counter%(length+1)))
-        try:
-            latest_done_cells = data_count_queue.get_nowait()
-            # Using nowait since during upload,
-            # queue takes time to fill up
-            # And normal get, blocks until queue gets an item
-            # get_nowait either gives a value or an exception
-        except queueEmpty as q:
-            pass
-        else:
-            # Only execute if queueEmpty error doesn't occur
-            completed_cells += latest_done_cells
-
-        msg = f_str.format(sh_cur, sh_total, prog, completed_cells, total_cells)
-        logger.info(msg)
-
-        if not any( t.is_alive() for t in thread_list ):
-            # if all threads are dead
-            # empty the queue quickly and break out
-            logger.debug('All threads are unalive so emptying the queue and breaking out')
-            while not data_count_queue.empty():
-                completed_cells += data_count_queue.get()
-                # Not using get_nowait() here, since
-                # at this line, either queue will have items or
-                # it will be empty
+    Progress is reported by the workers themselves, as each range completes.
 
-            # Break out after queue is emptied
-            break 
-
-        counter += 1
-        time.sleep(interval)
-
-
-    # Print 100% message
-    MyConsoleHandler.restore_terminator()
-    prog = '#' * length
-    msg = f_str.format(sh_cur, sh_total, prog, completed_cells, total_cells)
-    logger.info(msg)
-
-    logger.debug("All threads are aliven't!")
-
-    for t in thread_list:
-        # Making certain all threads are stopped
-        t.join()
-        logger.debug(t.name + ' joined')
-
-
-def work_divider(no_of_cells, n_threads):
-    '''Divide the no of cells almost equally among n_threads
-
-    no_of_cells = The number of cells we need to divide among threads
-    n_threads = The number of threads among which we divide the cells
+    future_list = List of Future objects
     '''
+    wait(future_list)
+    logger.debug("All workers are done!")
 
-    # https://math.stackexchange.com/a/1081099
-    
-    N = no_of_cells
-    M = n_threads
-    for i, k in enumerate(range(M)):
-        start_index = (N * k) // M + 1 # +1 since cells are 1-indexed
-        inc = (N *(k+1))//M - start_index 
-        end_index = start_index + inc
-
-        if end_index - start_index < 0:
-            # there is no valid range between the indices
-            # this will usually happen when file is really small
-            # or when remaining data is really small
-            # as compared to a single cell content and n_threads
-            # for example,
-            # there's only 2 cells worth of data, and we are using 10 threads
-            # then only 2 threads will run properly and others will throw exceptions
-            # hence, skip this thread
-            i = i - 1 # this will be incremented in next iteration
-            # don't yield this pair of start_index and end_index
-            continue
-        
-        # i is the thread number
-        yield i, start_index, end_index
+    for f in future_list:
+        # Re-raise any exception from the workers
+        f.result()
@@ -0,0 +1,15 @@
+import pytest
+import sheet_disk
+from .fake_gspread import FakeClient
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    '''A FakeClient used as the default client, in a temporary working directory'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('SH_DISK_CACHE', str(tmp_path / 'cache'))
+
+    fake = FakeClient()
+    sheet_disk.set_client(fake)
+    yield fake
+    sheet_disk.set_client(None)
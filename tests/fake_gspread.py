@@ -0,0 +1,83 @@
+'''In-memory stand-in for a gspread client, so transfers can be tested
+without the network. Each spreadsheet is a dict of row -> cell value.'''
+
+import threading, re, itertools
+from collections import Counter
+from gspread.models import Cell
+
+
+class FakeWorksheet:
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+
+    def _cells(self):
+        if self.key not in self.client.sheets:
+            raise KeyError('No spreadsheet ' + self.key)
+        return self.client.sheets[self.key]
+
+    def range(self, name):
+        self.client.count('read')
+        start, end = (int(n) for n in re.findall(r'\d+', name))
+        cells = self._cells()
+        return [Cell(row, 1, cells.get(row, '')) for row in range(start, end + 1)]
+
+    def update_cells(self, cell_list):
+        self.client.count('write')
+        cells = self._cells()
+        with self.client.lock:
+            for cell in cell_list:
+                cells[cell.row] = cell.value
+
+
+class FakeSpreadsheet:
+
+    def __init__(self, client, key, title=''):
+        self.client = client
+        self.id = key
+        self.title = title
+
+    def share(self, value, perm_type, role):
+        self.client.count('share')
+
+    @property
+    def sheet1(self):
+        # The metadata request, open_by_key makes none
+        self.client.count('open')
+        return FakeWorksheet(self.client, self.id)
+
+
+class FakeClient:
+    '''
+    sheets = Dict of key -> {row: value} of every spreadsheet,
+            delete a key to lose a sheet
+    requests = Counter of the requests gspread would send, by the
+            kinds of the planner: create, share, open, read, write
+    '''
+
+    def __init__(self):
+        self.sheets = {}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self._keys = itertools.count(1)
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] += 1
+
+    def create(self, title):
+        self.count('create')
+        with self.lock:
+            key = 'key' + str(next(self._keys))
+            self.sheets[key] = {}
+        return FakeSpreadsheet(self, key, title)
+
+    def open_by_key(self, key):
+        if key not in self.sheets:
+            raise KeyError('No spreadsheet ' + key)
+        return FakeSpreadsheet(self, key)
+
+    def del_spreadsheet(self, key):
+        with self.lock:
+            del self.sheets[key]
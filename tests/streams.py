@@ -0,0 +1,32 @@
+import io
+
+
+class ShortReader(io.RawIOBase):
+    '''Raw stream returning at most max_read bytes from each read, like a pipe'''
+
+    def __init__(self, data, max_read=65536):
+        self.data = memoryview(data)
+        self.max_read = max_read
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        n = min(len(buf), self.max_read, len(self.data) - self.position)
+        buf[:n] = self.data[self.position:self.position + n]
+        self.position += n
+        return n
+
+
+class FakeStdio:
+    '''Stands in for sys.stdin/sys.stdout, with a binary buffer'''
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
@@ -0,0 +1,21 @@
+import os
+import sheet_disk
+from sheet_disk.client import ClientPool
+from sheet_disk.utils import BYTES_PER_SHEET
+from .fake_gspread import FakeClient
+
+
+def test_sheets_are_spread_over_accounts(client):
+    other = FakeClient()
+    pool = ClientPool([client, other])
+
+    data = os.urandom(3 * BYTES_PER_SHEET)
+    manifest = sheet_disk.upload_from(data, 'a.bin', client=pool)
+
+    # Each sheet is owned by the account which created it
+    assert set(manifest['account_list']) == set(pool.clients)
+    assert len(client.sheets) + len(other.sheets) == 3
+    for key, account in zip(manifest['key_list'], manifest['account_list']):
+        assert key in pool.get(account).sheets
+
+    assert sheet_disk.download_bytes(manifest, client=pool) == data
@@ -0,0 +1,25 @@
+import os, threading
+import sheet_disk
+
+
+def test_batch_round_trip_leaves_no_workers(client):
+    data = {name: os.urandom(size) for name, size in (('a.bin', 100000), ('b.bin', 5000))}
+    for name, content in data.items():
+        with open(name, 'wb') as f:
+            f.write(content)
+
+    threads = threading.active_count()
+
+    failed = sheet_disk.batch([('upload', name, None) for name in data], concurrency=4)
+    assert failed == []
+
+    failed = sheet_disk.batch(
+            [('download', 'out_' + name, name + '.json') for name in data], concurrency=4)
+    assert failed == []
+
+    for name, content in data.items():
+        with open('out_' + name, 'rb') as f:
+            assert f.read() == content
+
+    # The workers of both batches have exited
+    assert threading.active_count() == threads
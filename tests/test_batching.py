@@ -0,0 +1,31 @@
+import pytest
+from sheet_disk.batching import RequestSizer, parse_size, cells_for_bytes
+
+
+@pytest.mark.parametrize('no_of_cells, cells', [(1, 64), (1000, 64), (1000, 1000), (65, 64)])
+def test_split_covers_every_cell_once(no_of_cells, cells):
+    ranges = list(RequestSizer('read').split(no_of_cells, cells))
+    assert [r[0] for r in ranges] == list(range(len(ranges)))
+    assert ranges[0][1] == 1 and ranges[-1][2] == no_of_cells
+    for (_, _, end), (_, start, _) in zip(ranges, ranges[1:]):
+        assert start == end + 1
+
+    # As even as possible, so the last range isn't tiny
+    sizes = [end - start + 1 for _, start, end in ranges]
+    assert max(sizes) - min(sizes) <= 1 and max(sizes) <= cells
+
+
+def test_fixed_request_size():
+    sizer = RequestSizer('write', parse_size('4M'))
+    assert sizer.cells == cells_for_bytes(4 * 10 ** 6)
+    # Requests of the size don't change it
+    for _ in range(20):
+        sizer.record(sizer.cells, sizer.cells, 10 ** 6, 1.0)
+    assert sizer.cells == cells_for_bytes(4 * 10 ** 6)
+
+
+def test_parse_size():
+    assert parse_size('auto') is None
+    assert parse_size('512K') == 512000
+    with pytest.raises(ValueError, match='Rate must be'):
+        parse_size('fast', 'Rate')
@@ -0,0 +1,21 @@
+import os
+import sheet_disk
+from sheet_disk.cleanup import delete_file, delete_sheets
+from sheet_disk.utils import BYTES_PER_SHEET
+
+
+def test_delete_file(client):
+    with open('a.bin', 'wb') as f:
+        f.write(os.urandom(BYTES_PER_SHEET + 10))
+    sheet_disk.upload('a.bin')
+    assert len(client.sheets) == 2
+
+    assert delete_file('a.bin.json') == []
+    assert client.sheets == {}
+
+
+def test_failed_deletes_are_reported(client):
+    key = client.create('x').id
+    failed = delete_sheets([(key, None), ('nokey', None)])
+    assert key not in client.sheets
+    assert failed == [('nokey', None)]
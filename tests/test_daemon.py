@@ -0,0 +1,60 @@
+import os, threading, tempfile, shutil
+import pytest
+from sheet_disk import daemon
+
+
+@pytest.fixture
+def socket_path(client):
+    # tmp_path can be longer than a Unix socket path may be
+    directory = tempfile.mkdtemp(dir='/tmp')
+    path = os.path.join(directory, 'sd.sock')
+
+    server = threading.Thread(target=daemon.serve, args=(path,),
+                              kwargs={'concurrency': 3, 'client': client})
+    server.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        threading.Event().wait(0.05)
+
+    yield path
+
+    daemon.send_request({'op': 'shutdown'}, path)
+    server.join(10)
+    shutil.rmtree(directory)
+    assert not server.is_alive()
+
+
+def test_submit_upload_and_download(socket_path):
+    data = os.urandom(60000)
+    with open('a.bin', 'wb') as f:
+        f.write(data)
+
+    job = daemon.submit('upload', 'a.bin', wait=True, socket_path=socket_path)
+    assert job['state'] == 'done'
+
+    job = daemon.submit('download', 'b.bin', 'a.bin.json', wait=True, socket_path=socket_path)
+    assert job['state'] == 'done' and job['cells'][0] == job['cells'][1]
+    with open('b.bin', 'rb') as f:
+        assert f.read() == data
+
+    jobs = daemon.send_request({'op': 'status'}, socket_path)['jobs']
+    assert [j['action'] for j in jobs] == ['upload', 'download']
+
+
+def test_bad_requests(socket_path):
+    with open('a.bin', 'wb') as f:
+        f.write(b'data')
+
+    with pytest.raises(RuntimeError, match='Daemon error'):
+        daemon.send_request({'op': 'nope'}, socket_path)
+    with pytest.raises(RuntimeError, match='Daemon error'):
+        daemon.submit('download', 'b.bin', 'missing.json', socket_path=socket_path)
+    with pytest.raises(RuntimeError, match='Daemon error'):
+        daemon.submit('upload', 'a.bin', socket_path=socket_path, priority='urgent')
+    assert daemon.send_request({'op': 'status'}, socket_path)['jobs'] == []
+
+
+def test_socket_is_private(socket_path):
+    # Only the owner may connect
+    assert os.stat(socket_path).st_mode & 0o077 == 0
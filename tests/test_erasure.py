@@ -0,0 +1,27 @@
+import os, itertools
+import pytest
+from sheet_disk import erasure
+
+
+@pytest.mark.parametrize('k, m', [(1, 1), (3, 2), (4, 4)])
+def test_any_k_shards_rebuild_the_data(k, m):
+    data = [os.urandom(1000) for _ in range(k)]
+    shards = dict(enumerate(data + erasure.encode(data, m)))
+    assert len(shards) == k + m
+
+    for kept in itertools.combinations(range(k + m), k):
+        assert erasure.decode({i: shards[i] for i in kept}, k, m) == data
+
+
+def test_too_few_shards():
+    data = [os.urandom(10) for _ in range(3)]
+    parity = erasure.encode(data, 2)
+    with pytest.raises(ValueError):
+        erasure.decode({0: data[0], 3: parity[0]}, 3, 2)
+
+
+def test_invalid_params():
+    with pytest.raises(ValueError):
+        erasure.check_params(0, 1)
+    with pytest.raises(ValueError):
+        erasure.check_params(200, 100)
@@ -0,0 +1,108 @@
+import io, json, time, threading, logging
+import pytest
+import sheet_disk
+from sheet_disk import my_logging
+from sheet_disk.my_logging import (
+    get_logger, log_context, flush_logs, write_console, set_trace_file, MyConsoleHandler)
+from sheet_disk.progress import Tracker
+
+logger = get_logger()
+
+
+class BlockingHandler(logging.Handler):
+    '''Handler which blocks the logging thread until released'''
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.unblock = threading.Event()
+
+    def emit(self, record):
+        self.unblock.wait(5)
+
+
+@pytest.fixture
+def handlers():
+    '''Swap the handlers of the logging thread, restoring them afterwards'''
+    listener = my_logging._listener
+    saved = listener.handlers
+    yield listener
+    flush_logs()
+    for handler in listener.handlers:
+        if handler not in saved:
+            handler.close()
+    listener.handlers = saved
+    my_logging._update_level()
+
+
+@pytest.fixture
+def console(handlers):
+    '''StringIO the console writes to'''
+    flush_logs()
+    out = io.StringIO()
+    handler = MyConsoleHandler(out)
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handlers.handlers = (handler,)
+    return out
+
+
+def test_slow_console_doesnt_block_progress(handlers, console):
+    blocking = BlockingHandler()
+    handlers.handlers = handlers.handlers + (blocking,)
+
+    tracker = Tracker('a.bin', 'upload', total_bytes=100, total_cells=10, n_sheets=1)
+    tracker.start_sheet(1, 1, 10)
+    logger.info('first')
+
+    start = time.monotonic()
+    for _ in range(20):
+        logger.info('more')
+        tracker.add(1, 10)
+        # Draws at most every CONSOLE_INTERVAL
+        tracker._draw(force=True)
+    assert time.monotonic() - start < 1
+
+    blocking.unblock.set()
+    flush_logs()
+    # Each line is written in the order it was logged or drawn
+    text = console.getvalue()
+    assert text.startswith('first\n')
+    assert text.index('more\n') < text.index('\rSheet 1/1')
+
+
+def test_write_console_is_ordered_with_records(console):
+    logger.info('a')
+    write_console('\rbar')
+    logger.info('b')
+    flush_logs()
+    assert console.getvalue() == 'a\n\rbarb\n'
+
+
+def test_debug_records_arent_created_without_a_trace():
+    assert logger.level == logging.INFO
+
+    class Expensive:
+        def __str__(self):
+            raise AssertionError('formatted')
+
+    logger.debug('%s', Expensive())
+
+
+def test_trace_has_context_and_timings(client, handlers, tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    set_trace_file(path)
+    assert logger.level == logging.DEBUG
+
+    with log_context(job=7):
+        manifest = sheet_disk.upload_from(bytes(range(256)) * 1000, 'a.bin')
+        assert sheet_disk.download_bytes(manifest) == bytes(range(256)) * 1000
+    flush_logs()
+
+    with open(path) as f:
+        events = [json.loads(line) for line in f]
+    ranges = [e for e in events if e.get('op') in ('range', 'update_cells') and 'range' in e]
+    assert {e['op'] for e in ranges} == {'range', 'update_cells'}
+    for event in ranges:
+        # Context of the submitting thread, carried over to the workers
+        assert event['job'] == 7 and event['sheet'] == 1
+        assert event['seconds'] >= 0 and event['bytes'] > 0
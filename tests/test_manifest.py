@@ -0,0 +1,86 @@
+import os, json
+import pytest
+import sheet_disk
+from sheet_disk.manifest import Manifest
+from sheet_disk.utils import BYTES_PER_SHEET, BYTES_PER_CELL
+
+
+def uploaded(keys, size, **kwargs):
+    '''Manifest dict of an upload of size bytes, with its keys replaced by keys'''
+    manifest = sheet_disk.upload_from(os.urandom(size), 'a.bin', **kwargs)
+    assert len(manifest['key_list']) == len(keys)
+    manifest['key_list'] = keys
+    return manifest
+
+
+def round_trip(manifest, version):
+    Manifest.from_dict(manifest).save('a.sdm', manifest_version=version)
+    return Manifest.load('a.sdm')
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_save_load_with_unequal_keys(client, version):
+    keys = ['abc', 'abcdef', 'a']
+    manifest = uploaded(keys, 2 * BYTES_PER_SHEET + 5)
+
+    loaded = round_trip(manifest, version)
+    assert [r.key for r in loaded.records()] == keys
+    assert loaded.sheet(1).key == 'abcdef'
+    assert loaded.sheet(2).offset == 2 * BYTES_PER_SHEET
+    assert loaded.to_dict()['key_list'] == keys
+
+
+def test_locate_v2(client):
+    keys = ['abcdef', 'abc', 'ab']
+    loaded = round_trip(uploaded(keys, 2 * BYTES_PER_SHEET + 5), 2)
+
+    record, cell_no, offset_in_cell = loaded.locate(0)
+    assert (record.key, cell_no, offset_in_cell) == ('abcdef', 1, 0)
+
+    record, cell_no, offset_in_cell = loaded.locate(BYTES_PER_SHEET + 3 * BYTES_PER_CELL + 7)
+    assert (record.key, cell_no, offset_in_cell) == ('abc', 4, 7)
+
+    record, cell_no, _ = loaded.locate(2 * BYTES_PER_SHEET + 4)
+    assert (record.key, cell_no) == ('ab', 1)
+
+    with pytest.raises(ValueError):
+        loaded.locate(2 * BYTES_PER_SHEET + 5)
+
+
+def test_locate_striped_v2(client):
+    # 2 data and 1 parity sheet per group, two groups
+    keys = ['d0', 'd1xx', 'parity0', 'd2xxxxxx', 'd3', 'p1']
+    loaded = round_trip(uploaded(keys, 3 * BYTES_PER_SHEET, stripe=(2, 1)), 2)
+
+    assert [r.kind for r in loaded.records()] == ['D', 'D', 'P', 'D', 'D', 'P']
+    assert [r.key for r in loaded.records()] == keys
+
+    # Data sheets are found by offset, skipping the parity sheets
+    assert loaded.locate(BYTES_PER_SHEET)[0].key == 'd1xx'
+    assert loaded.locate(2 * BYTES_PER_SHEET)[0].key == 'd2xxxxxx'
+
+
+def test_v2_download(client):
+    data = os.urandom(100000)
+    manifest = sheet_disk.upload_from(data, 'a.bin')
+    Manifest.from_dict(manifest).save('a.sdm', manifest_version=2)
+
+    sheet_disk.download('b.bin', 'a.sdm')
+    with open('b.bin', 'rb') as f:
+        assert f.read() == data
+
+
+def test_convert_legacy_then_locate(client):
+    # Uploaded before file_size was recorded, only cell_count is known
+    manifest = uploaded(['k0', 'k1', 'k2'], 2 * BYTES_PER_SHEET + 5)
+    del manifest['file_size']
+    with open('legacy.json', 'w') as f:
+        json.dump(manifest, f)
+
+    sheet_disk.main(['convert', 'legacy.json', 'legacy.sdm'])
+    loaded = Manifest.load('legacy.sdm')
+    assert [r.length for r in loaded.records()] == [None] * 3
+
+    offset = BYTES_PER_SHEET + 7
+    assert loaded.locate(offset) == Manifest.load('legacy.json').locate(offset)
+    sheet_disk.main(['locate', 'legacy.sdm', str(offset)])
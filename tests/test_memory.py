@@ -0,0 +1,62 @@
+import os, io
+import pytest
+import sheet_disk
+from sheet_disk.utils import BYTES_PER_SHEET
+from .streams import ShortReader
+
+
+def test_upload_from_short_read_stream(client):
+    data = os.urandom(200000)
+    manifest = sheet_disk.upload_from(ShortReader(data), 'a.bin')
+    assert manifest['n_sheets'] == 1 and manifest['complete_upload']
+    assert sheet_disk.download_bytes(manifest) == data
+
+
+def test_upload_from_short_reads_over_many_sheets(client):
+    data = os.urandom(BYTES_PER_SHEET + 100000)
+    manifest = sheet_disk.upload_from(ShortReader(data, 1 << 20), 'a.bin', stripe=(2, 1))
+    assert sheet_disk.download_bytes(manifest) == data
+
+
+def test_bytes_round_trip_into_buffers(client):
+    data = os.urandom(100000)
+    manifest = sheet_disk.upload_from(data, 'a.bin')
+
+    buf = bytearray(len(data))
+    sheet_disk.download_into(manifest, buf)
+    assert buf == data
+
+    buf = bytearray(len(data) + 10)
+    sheet_disk.download_into(manifest, memoryview(buf)[5:])
+    assert buf[5:-5] == data
+
+    out = io.BytesIO()
+    sheet_disk.download_into(manifest, out)
+    assert out.getvalue() == data
+
+    with pytest.raises(ValueError):
+        sheet_disk.download_into(manifest, bytearray(10))
+
+
+def test_empty_upload(client):
+    manifest = sheet_disk.upload_from(b'', 'empty')
+    assert sheet_disk.download_bytes(manifest) == b''
+
+
+def test_failed_upload_deletes_its_sheets(client):
+    class Failing(io.RawIOBase):
+        reads = 0
+
+        def readable(self):
+            return True
+
+        def readinto(self, buf):
+            self.reads += 1
+            if self.reads > 40:
+                raise IOError('boom')
+            buf[:] = os.urandom(len(buf))
+            return len(buf)
+
+    with pytest.raises(IOError):
+        sheet_disk.upload_from(io.BufferedReader(Failing(), 1 << 20), 'bad')
+    assert client.sheets == {}
@@ -0,0 +1,80 @@
+import os, threading, tracemalloc
+import pytest
+import sheet_disk
+from sheet_disk.metrics import Metrics, phase, set_profile_dir
+
+
+def test_timed_records_calls_bytes_and_errors():
+    metrics = Metrics()
+    with metrics.timed('range', 10) as timer:
+        timer.bytes = 100
+    with pytest.raises(KeyError):
+        with metrics.timed('range'):
+            raise KeyError('x')
+
+    ops = metrics.snapshot()['ops']
+    assert ops['range']['count'] == 2
+    assert ops['range']['errors'] == 1
+    assert ops['range']['bytes'] == 100
+
+
+@pytest.fixture
+def profile_dir(tmp_path):
+    tracing = tracemalloc.is_tracing()
+    set_profile_dir(str(tmp_path / 'profile'))
+    yield tmp_path / 'profile'
+    set_profile_dir(None)
+    if not tracing:
+        tracemalloc.stop()
+
+
+def test_concurrent_phases_profile_one_at_a_time(profile_dir):
+    inside = threading.Barrier(3)
+
+    def run():
+        with phase('upload'):
+            inside.wait()
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with phase('outer'):
+        with phase('inner'):
+            pass
+
+    names = sorted(os.listdir(profile_dir))
+    assert names == ['001-upload.mem.txt', '001-upload.prof',
+                     '002-outer.mem.txt', '002-outer.prof']
+
+
+def test_profiled_batch(client, profile_dir):
+    for name in ('a.bin', 'b.bin', 'c.bin'):
+        with open(name, 'wb') as f:
+            f.write(os.urandom(50000))
+
+    failed = sheet_disk.batch([('upload', name, None) for name in ('a.bin', 'b.bin', 'c.bin')])
+    assert failed == []
+    assert any(name.endswith('.prof') for name in os.listdir(profile_dir))
+
+
+def test_opening_a_sheet_times_its_metadata_request(client, monkeypatch):
+    from sheet_disk.metrics import get_metrics
+    from .fake_gspread import FakeSpreadsheet, FakeWorksheet
+
+    # open_by_key makes no request in gspread, sheet1 does
+    def sheet1(self):
+        threading.Event().wait(0.05)
+        return FakeWorksheet(self.client, self.id)
+    monkeypatch.setattr(FakeSpreadsheet, 'sheet1', property(sheet1))
+
+    get_metrics().reset()
+    manifest = sheet_disk.upload_from(os.urandom(1000), 'a.bin')
+    sheet_disk.download_bytes(manifest)
+
+    opened = get_metrics().snapshot()['ops']['open_by_key']
+    # Once for the upload, once for the download
+    assert opened['count'] == 2
+    assert opened['seconds'] >= 0.1
@@ -0,0 +1,58 @@
+import os, json
+import pytest
+import sheet_disk
+from sheet_disk.metrics import get_metrics
+from sheet_disk.planner import load_history, plan_paths
+from sheet_disk.utils import BYTES_PER_SHEET
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics():
+    get_metrics().reset()
+
+
+def write(name, size):
+    with open(name, 'wb') as f:
+        f.write(os.urandom(size))
+
+
+def test_successful_runs_are_saved(client):
+    write('a.bin', 100000)
+    sheet_disk.main(['upload', 'a.bin'])
+    sheet_disk.main(['download', 'b.bin', 'a.bin.json'])
+
+    runs = load_history()
+    assert [('write' in run, 'read' in run) for run in runs] == [(True, False), (True, True)]
+
+
+def test_failed_runs_are_not_saved(client):
+    write('a.bin', 100000)
+    sheet_disk.main(['upload', 'a.bin'])
+    with open('a.bin.json') as f:
+        key = json.load(f)['key_list'][0]
+    del client.sheets[key]
+
+    with pytest.raises(Exception):
+        sheet_disk.main(['download', 'b.bin', 'a.bin.json'])
+    assert len(load_history()) == 1
+
+
+def test_plan_matches_the_upload(client):
+    write('a.bin', BYTES_PER_SHEET + 1000)
+    (upload_plan,), _ = plan_paths(['a.bin'], concurrency=4)
+
+    sheet_disk.main(['upload', 'a.bin'])
+    (download_plan,), _ = plan_paths(['a.bin.json'], concurrency=4)
+
+    with open('a.bin.json') as f:
+        manifest = json.load(f)
+    assert upload_plan['sheets'] == download_plan['sheets'] == manifest['n_sheets'] == 2
+    assert upload_plan['cells'] == download_plan['cells'] == manifest['cell_count']
+
+
+def test_planned_requests_match_the_upload(client):
+    write('a.bin', 2 * BYTES_PER_SHEET + 1000)
+    (plan,), _ = plan_paths(['a.bin'], concurrency=4)
+
+    sheet_disk.main(['upload', 'a.bin'])
+    assert plan['requests'] == dict(client.requests)
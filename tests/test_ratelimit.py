@@ -0,0 +1,91 @@
+import time, threading
+import pytest
+from sheet_disk.ratelimit import (
+    TokenBucket, RateLimiter, BandwidthLimiter, parse_quota, classify)
+
+
+def test_bucket_allows_burst_then_refills():
+    bucket = TokenBucket(rate=20, capacity=5)
+    assert all(bucket.try_acquire() for _ in range(5))
+    assert not bucket.try_acquire()
+
+    time.sleep(0.1)
+    # 2 tokens were added
+    assert bucket.try_acquire(2)
+    assert not bucket.try_acquire()
+
+
+def test_acquire_waits_for_tokens():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # The first token was there, the other 5 take 0.02 s each
+    assert 0.09 <= time.monotonic() - start < 0.5
+
+
+def test_per_minute_stays_under_quota():
+    quota = 60
+    bucket = TokenBucket.per_minute(quota)
+    # The burst plus one minute of refill
+    assert bucket.capacity + bucket.rate * 60 <= quota
+
+
+def test_limiter_skips_unlimited_kinds():
+    limiter = RateLimiter({'read': 60, 'write': 0})
+    assert set(limiter.buckets) == {'read'}
+    start = time.monotonic()
+    for _ in range(100):
+        limiter.acquire('write')
+    assert time.monotonic() - start < 0.1
+
+
+def test_parse_quota_and_classify():
+    assert parse_quota(['read=300', 'write=100']) == {'read': 300, 'write': 100}
+    with pytest.raises(ValueError):
+        parse_quota(['reads=1'])
+
+    assert classify('GET', 'https://sheets.googleapis.com/v4/spreadsheets/k') == 'read'
+    assert classify('POST', 'https://sheets.googleapis.com/v4/spreadsheets/k') == 'write'
+    assert classify('DELETE', 'https://www.googleapis.com/drive/v3/files/k') == 'drive'
+    assert classify('POST', 'https://oauth2.googleapis.com/token') is None
+
+
+def test_bandwidth_limiter_holds_the_rate():
+    limiter = BandwidthLimiter(rate=100000, burst=0.1)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire(10000)
+    # The bucket holds 10000 bytes, and the debt of the last request is
+    # paid off after it, so 30000 bytes are waited for at 100000/s
+    assert 0.28 <= time.monotonic() - start < 0.7
+
+
+def test_bandwidth_debt_and_credit():
+    limiter = BandwidthLimiter(rate=100000, burst=0.1)
+    # Larger than the bucket, so it goes through and leaves it in debt
+    assert limiter.acquire(50000) < 0.05
+    # Giving back what wasn't used pays the debt off
+    limiter.credit(40000)
+    assert limiter.acquire(1000) < 0.05
+
+
+def test_bandwidth_goes_to_the_lowest_rank_first():
+    limiter = BandwidthLimiter(rate=100000, burst=0.1)
+    limiter.acquire(30000)
+    order = []
+
+    def take(rank, label):
+        limiter.acquire(1000, rank)
+        order.append(label)
+
+    threads = [threading.Thread(target=take, args=(2, 'bulk'))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=take, args=(0, 'interactive')))
+    threads[1].start()
+    for t in threads:
+        t.join()
+
+    # Both waited on the debt, and the interactive one went first
+    assert order == ['interactive', 'bulk']
@@ -0,0 +1,98 @@
+import threading
+import pytest
+from sheet_disk.scheduler import WorkPool
+
+
+def run_blocked(pool, submit):
+    '''
+    Queue work with the only worker busy, then let it run.
+    Returns the order the work ran in.
+    '''
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    blocker = pool.lane('blocker')
+    blocker.submit(lambda: (started.set(), release.wait()))
+    started.wait()
+
+    futures = submit(order.append)
+    release.set()
+    for f in futures:
+        f.result()
+    return order
+
+
+def test_lanes_take_turns():
+    with WorkPool(1) as pool:
+        big, small = pool.lane('big'), pool.lane('small')
+
+        def submit(record):
+            futures = [big.submit(record, 'big') for _ in range(4)]
+            futures.append(small.submit(record, 'small'))
+            return futures
+
+        order = run_blocked(pool, submit)
+
+    # The small file doesn't wait behind every range of the big one
+    assert order == ['big', 'small', 'big', 'big', 'big']
+
+
+def test_close_stops_workers():
+    pool = WorkPool(3)
+    lane = pool.lane('a')
+    assert [lane.submit(pow, 2, i).result() for i in range(5)] == [1, 2, 4, 8, 16]
+
+    threads = list(pool._threads)
+    pool.close()
+    assert threads and not any(t.is_alive() for t in threads)
+
+    with pytest.raises(RuntimeError):
+        lane.submit(pow, 2, 2)
+
+
+def test_close_runs_queued_work():
+    pool = WorkPool(1)
+    lane = pool.lane('a')
+    futures = [lane.submit(pow, 2, i) for i in range(20)]
+    pool.close()
+    assert [f.result() for f in futures] == [2 ** i for i in range(20)]
+
+
+def test_with_block_cancels_queued_work_on_error():
+    started = threading.Event()
+    release = threading.Event()
+
+    with pytest.raises(ValueError):
+        with WorkPool(1) as pool:
+            lane = pool.lane('a')
+            first = lane.submit(lambda: (started.set(), release.wait()))
+            queued = lane.submit(pow, 2, 3)
+            started.wait()
+            # Lets the running item finish while close() waits on it
+            threading.Timer(0.1, release.set).start()
+            raise ValueError('transfer failed')
+
+    assert first.done() and queued.cancelled()
+
+
+def test_higher_priority_lanes_run_first():
+    with WorkPool(1) as pool:
+        bulk = pool.lane('bulk', priority='bulk')
+        normal = pool.lane('normal')
+        interactive = pool.lane('interactive', priority='interactive')
+
+        def submit(record):
+            futures = [bulk.submit(record, 'bulk') for _ in range(2)]
+            futures += [normal.submit(record, 'normal') for _ in range(2)]
+            futures.append(interactive.submit(record, 'interactive'))
+            return futures
+
+        order = run_blocked(pool, submit)
+
+    assert order == ['interactive', 'normal', 'normal', 'bulk', 'bulk']
+
+
+def test_invalid_priority():
+    with pytest.raises(ValueError):
+        WorkPool(1).lane('a', priority='urgent')
@@ -0,0 +1,65 @@
+import os, io
+import sheet_disk
+from sheet_disk.sparse import SparseReader, SparseWriter
+from sheet_disk.utils import BYTES_PER_CELL
+
+
+def sparse_file(path):
+    '''Write a file with data, a hole, a run of zeros and a hole at the end'''
+    # Zeros are found in blocks of one cell from the start of the file
+    parts = [os.urandom(BYTES_PER_CELL), bytes(3 * BYTES_PER_CELL), os.urandom(100), bytes(10)]
+    with open(path, 'wb') as f:
+        f.write(parts[0])
+        # Hole
+        f.seek(4 * BYTES_PER_CELL, os.SEEK_CUR)
+        f.write(parts[1] + parts[2] + parts[3])
+        f.truncate(f.tell() + 2 * BYTES_PER_CELL)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_reader_leaves_out_zero_runs():
+    data = os.urandom(BYTES_PER_CELL) + bytes(2 * BYTES_PER_CELL) + b'\1' + bytes(10)
+    reader = SparseReader(io.BytesIO(data))
+    stored = b''.join(reader.chunks(1000))
+
+    # The short run is kept, the long one is an extent
+    assert reader.extents == [[BYTES_PER_CELL, 2 * BYTES_PER_CELL]]
+    assert stored == data[:BYTES_PER_CELL] + b'\1' + bytes(10)
+    assert reader.position == len(data)
+
+    out = io.BytesIO()
+    writer = SparseWriter(out, reader.extents, len(data))
+    writer.write(stored)
+    writer.finish()
+    assert out.getvalue() == data
+
+
+def test_sparse_file_round_trip(client):
+    data = sparse_file('a.img')
+    manifest = sheet_disk.upload('a.img', sparse=True).to_dict()
+
+    assert manifest['file_size'] == len(data) == 10 * BYTES_PER_CELL + 110
+    # The first cell, and the cell with the last data
+    assert manifest['stored_size'] <= 3 * BYTES_PER_CELL
+    assert sum(length for _, length in manifest['zero_extents']) \
+           == len(data) - manifest['stored_size']
+
+    sheet_disk.download('b.img', 'a.img.json')
+    with open('b.img', 'rb') as f:
+        assert f.read() == data
+    assert sheet_disk.download_bytes(manifest) == data
+
+
+def test_sparse_stream_round_trip(client):
+    data = os.urandom(BYTES_PER_CELL) + bytes(5 * BYTES_PER_CELL) + os.urandom(1000)
+    manifest = sheet_disk.upload_from(io.BytesIO(data), 'a.bin', sparse=True)
+    assert manifest['zero_extents'] == [[BYTES_PER_CELL, 5 * BYTES_PER_CELL]]
+    assert sheet_disk.download_bytes(manifest) == data
+
+
+def test_sparse_striped_round_trip(client):
+    data = sparse_file('a.img')
+    manifest = sheet_disk.upload('a.img', sparse=True, stripe=(2, 1)).to_dict()
+    del client.sheets[manifest['key_list'][0]]
+    assert sheet_disk.download_bytes(manifest) == data
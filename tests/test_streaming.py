@@ -0,0 +1,24 @@
+import os, io, sys, json
+import pytest
+import sheet_disk
+from sheet_disk.utils import BYTES_PER_SHEET
+from .streams import ShortReader, FakeStdio
+
+
+@pytest.mark.parametrize('stripe', [None, (2, 1)])
+def test_stdin_to_stdout_with_short_reads(client, monkeypatch, stripe):
+    # A mid-stream group of a striped upload, or a sheet, is filled from many reads
+    data = os.urandom(3 * BYTES_PER_SHEET + 1000)
+    monkeypatch.setattr(sys, 'stdin', FakeStdio(ShortReader(data)))
+
+    sheet_disk.upload('-', name='a.bin', stripe=stripe)
+    with open('a.bin.json') as f:
+        manifest = json.load(f)
+    assert manifest['file_size'] == len(data)
+    assert manifest['n_sheets'] == (6 if stripe else 4)
+
+    out = io.BytesIO()
+    monkeypatch.setattr(sys, 'stdout', FakeStdio(out))
+    sheet_disk.download('-', 'a.bin.json')
+    assert out.getvalue() == data
+
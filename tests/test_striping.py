@@ -0,0 +1,37 @@
+import os
+import pytest
+import sheet_disk
+from sheet_disk.utils import BYTES_PER_SHEET
+
+
+def upload_file(data, name='a.bin', **kwargs):
+    with open(name, 'wb') as f:
+        f.write(data)
+    manifest = sheet_disk.upload(name, **kwargs)
+    return manifest.to_dict()
+
+
+def test_striped_round_trip_with_lost_sheets(client):
+    # Two groups of 2 data and 1 parity sheet, the second one short
+    data = os.urandom(2 * BYTES_PER_SHEET + 12345)
+    manifest = upload_file(data, stripe=(2, 1))
+    keys = manifest['key_list']
+    assert len(keys) == 6
+
+    # One sheet of each group, a data sheet and a parity sheet
+    del client.sheets[keys[0]]
+    del client.sheets[keys[5]]
+
+    sheet_disk.download('b.bin', 'a.bin.json')
+    with open('b.bin', 'rb') as f:
+        assert f.read() == data
+
+
+def test_striped_download_fails_without_enough_sheets(client):
+    data = os.urandom(5000)
+    manifest = upload_file(data, stripe=(2, 1))
+    for key in manifest['key_list'][:2]:
+        del client.sheets[key]
+
+    with pytest.raises(RuntimeError):
+        sheet_disk.download_bytes(manifest)
@@ -0,0 +1,135 @@
+import datetime, time
+import requests
+from sheet_disk import client as client_module
+from sheet_disk.transport import PooledSession, send_throttled, http_exchange
+
+
+def response(status):
+    r = requests.Response()
+    r.status_code = status
+    r._content = b'{}'
+    # Retried right away
+    r.headers['Retry-After'] = '0'
+    return r
+
+
+class Sender:
+    '''Answers requests with statuses, in order, remembering what was sent'''
+
+    def __init__(self, session, *statuses):
+        self.session = session
+        self.statuses = list(statuses)
+        self.sent = []
+
+    def __call__(self, method, url, **kwargs):
+        self.sent.append((method, self.session.headers.get('Authorization')))
+        return response(self.statuses.pop(0))
+
+
+def test_401_refreshes_the_token_once():
+    session = PooledSession(2)
+    session.headers['Authorization'] = 'Bearer old'
+    refused = []
+
+    def reauthorize(header):
+        refused.append(header)
+        session.headers['Authorization'] = 'Bearer new'
+    session.reauthorize = reauthorize
+
+    send = Sender(session, 401, 200)
+    assert send_throttled(session, send, 'get', 'https://x/values').status_code == 200
+    assert refused == ['Bearer old']
+    assert send.sent == [('get', 'Bearer old'), ('get', 'Bearer new')]
+
+    # A token which is refused again isn't refreshed in a loop
+    send = Sender(session, 401, 401)
+    assert send_throttled(session, send, 'get', 'https://x/values').status_code == 401
+    assert len(send.sent) == 2
+
+
+def test_401_without_reauthorize_is_returned():
+    session = PooledSession(2)
+    send = Sender(session, 401)
+    assert send_throttled(session, send, 'get', 'https://x/values').status_code == 401
+
+
+def test_server_errors_are_retried_for_idempotent_methods_only():
+    session = PooledSession(2)
+
+    send = Sender(session, 503, 200)
+    assert send_throttled(session, send, 'put', 'https://x/values').status_code == 200
+    assert len(send.sent) == 2
+
+    # The spreadsheet may have been made, a retry could make another one
+    send = Sender(session, 503, 200)
+    assert send_throttled(session, send, 'post', 'https://x/files').status_code == 503
+    assert len(send.sent) == 1
+
+    # Quota errors are refused before any work is done
+    send = Sender(session, 429, 200)
+    assert send_throttled(session, send, 'post', 'https://x/files').status_code == 200
+
+
+class SlowLimiter:
+    def acquire(self, kind):
+        time.sleep(0.2)
+
+
+def test_exchange_leaves_out_quota_waits_and_retries():
+    session = PooledSession(2)
+    session.limiters = [SlowLimiter()]
+
+    def send(method, url, **kwargs):
+        if statuses[0] == 429:
+            # A refused attempt, as slow as the limiter
+            time.sleep(0.2)
+        return response(statuses.pop(0))
+
+    statuses = [429, 200]
+    start = time.perf_counter()
+    with http_exchange() as exchange:
+        send_throttled(session, send, 'put', 'https://x/values')
+    assert time.perf_counter() - start >= 0.6
+    assert 0 < exchange.seconds < 0.1
+
+    # Requests outside of the block aren't added to it
+    measured = exchange.seconds
+    statuses = [200]
+    send_throttled(session, send, 'put', 'https://x/values')
+    assert exchange.seconds == measured
+
+
+class FakeCreds:
+    service_account_email = 'a@b.c'
+
+    def __init__(self):
+        self.access_token = 'old'
+        self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.n_refreshes = 0
+
+    def refresh(self, http):
+        self.n_refreshes += 1
+        self.access_token = 'new' + str(self.n_refreshes)
+
+
+class AuthClient:
+    def __init__(self):
+        self.auth = FakeCreds()
+        self.session = PooledSession(2)
+        self.login()
+
+    def login(self):
+        self.session.headers['Authorization'] = 'Bearer ' + self.auth.access_token
+
+
+def test_reauthorize_fetches_one_token(client):
+    auth_client = AuthClient()
+    # The token still looks valid in the cache, but the server refused it
+    client_module.save_token(auth_client.auth)
+
+    client_module.reauthorize(auth_client, 'Bearer old')
+    assert auth_client.session.headers['Authorization'] == 'Bearer new1'
+
+    # Another request refused with the old token doesn't fetch another one
+    client_module.reauthorize(auth_client, 'Bearer old')
+    assert auth_client.auth.n_refreshes == 1